@@ -1,8 +1,137 @@
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from scipy import sparse
 from scipy.ndimage.interpolation import rotate
+from scipy.sparse.linalg import LinearOperator, aslinearoperator, cg, lsqr, svds
+
+
+# G may be a dense array, a scipy.sparse matrix or a LinearOperator such as response.GridProjector. Dense arrays default
+# to the direct normal-equation solves, anything else to LSQR on the stacked least-squares problem.
+def _stack(G, L=None):
+    """[G; L] as one operator, L may be None."""
+    G = aslinearoperator(G)
+    if L is None:
+        return G
+    L = aslinearoperator(L)
+    n_g = G.shape[0]
+
+    return LinearOperator((n_g + L.shape[0], G.shape[1]), dtype=np.double,
+                          matvec=lambda m: np.concatenate((G.matvec(m), L.matvec(m))),
+                          rmatvec=lambda r: G.rmatvec(r[:n_g]) + L.rmatvec(r[n_g:]))
+
+
+def _regularized_system(d, G, L=None, alpha=0):
+    """A, b with ||A m - b||^2 = ||G m - d||^2 + alpha^2 ||L m||^2, L defaults to the identity."""
+    if not alpha:
+        return aslinearoperator(G), np.asarray(d, dtype=np.double)
+    if L is None:
+        L = sparse.identity(G.shape[1], format='csr')
+
+    A = _stack(G, alpha * L)
+    return A, np.concatenate((d, np.zeros(A.shape[0] - len(d))))
+
+
+def solve_cgls(d, G, L=None, alpha=0, x0=None, tol=1e-8, residual_tol=None, max_iterations=None, callback=None):
+    """Minimize ||G m - d||^2 + alpha^2 ||L m||^2 with conjugate gradients on the least-squares problem.
+
+    Stops when the normal-equation residual falls below tol relative to its value at m = 0, or when residual_tol is
+    given and ||G m - d|| <= residual_tol (discrepancy principle). x0 warm starts from a previous estimate.
+    callback(iteration, m, residual_norm) is called after every iteration.
+    """
+    A, b = _regularized_system(d, G, L, alpha)
+    if max_iterations is None:
+        max_iterations = A.shape[1]
+
+    if x0 is None:
+        m = np.zeros(A.shape[1])
+        r = b.copy()
+        s = A.rmatvec(r)
+        reference_norm = np.linalg.norm(s)
+    else:
+        m = np.array(x0, dtype=np.double).reshape(-1)
+        r = b - A.matvec(m)
+        s = A.rmatvec(r)
+        reference_norm = np.linalg.norm(A.rmatvec(b))
+
+    p = s.copy()
+    gamma = s @ s
+
+    for iteration in range(max_iterations):
+        if np.sqrt(gamma) <= tol * reference_norm:
+            break
+        if residual_tol is not None and np.linalg.norm(r[:len(d)]) <= residual_tol:
+            break
+
+        q = A.matvec(p)
+        delta = q @ q
+        if delta <= 0:
+            break
+
+        step = gamma / delta
+        m += step * p
+        r -= step * q
+
+        s = A.rmatvec(r)
+        gamma_next = s @ s
+        p *= gamma_next / gamma
+        p += s
+        gamma = gamma_next
+
+        if callback is not None:
+            callback(iteration, m, np.linalg.norm(r[:len(d)]))
+
+    return m
+
+
+def solve_lsqr(d, G, L=None, alpha=0, x0=None, tol=1e-8, max_iterations=None):
+    """Minimize ||G m - d||^2 + alpha^2 ||L m||^2 with LSQR, tol is the scipy atol / btol residual tolerance.
+
+    x0 warm starts from a previous estimate.
+    """
+    # scipy damps the step from x0 rather than m, so a warm start solves the stacked system instead
+    if L is None and x0 is None:
+        A, b, damp = aslinearoperator(G), np.asarray(d, dtype=np.double), alpha
+    else:
+        (A, b), damp = _regularized_system(d, G, L, alpha), 0.0
+    if max_iterations is None:
+        max_iterations = max(10 * A.shape[1], 100)
+
+    return lsqr(A, b, damp=damp, atol=tol, btol=tol, iter_lim=max_iterations, x0=x0)[0]
+
+
+_iterative_solvers = {'lsqr': solve_lsqr, 'cgls': solve_cgls}
+
+
+def _solve_method(G, method):
+    if method is None:
+        method = 'direct' if isinstance(G, np.ndarray) else 'lsqr'
+    if method != 'direct' and method not in _iterative_solvers:
+        raise ValueError(f'unknown method {method}')
+    if method == 'direct' and not isinstance(G, np.ndarray):
+        raise TypeError('the direct solve needs G as an array')
+    return method
+
+
+def _column_sums(G):
+    if isinstance(G, np.ndarray):
+        return G.sum(axis=0)
+    return G.T @ np.ones(G.shape[0])
+
 
+def _rows(G, subset):
+    if isinstance(G, (np.ndarray, sparse.spmatrix)):
+        return G[subset, :]
+    return G.rows(subset)
+
+
+def solve_direct(d, G, method=None):
+    method = _solve_method(G, method)
+    if method != 'direct':
+        return _iterative_solvers[method](d, G, tol=1e-12)
 
-def solve_direct(d, G):
     lhs = G.T @ G
     rhs = G.T @ d
     m = np.linalg.solve(lhs, rhs)
@@ -10,7 +139,11 @@ def solve_direct(d, G):
     return m
 
 
-def solve_tikhonov(d, G, alpha=0):
+def solve_tikhonov(d, G, alpha=0, method=None):
+    method = _solve_method(G, method)
+    if method != 'direct':
+        return _iterative_solvers[method](d, G, alpha=alpha, tol=1e-12)
+
     gamma = alpha * np.identity(np.size(G, 1))
 
     lhs = G.T @ G + gamma.T @ gamma
@@ -20,7 +153,11 @@ def solve_tikhonov(d, G, alpha=0):
     return m
 
 
-def solve_higher_tikhonov(d, G, L, alpha=0):
+def solve_higher_tikhonov(d, G, L, alpha=0, method=None):
+    method = _solve_method(G, method)
+    if method != 'direct':
+        return _iterative_solvers[method](d, G, L, alpha, tol=1e-12)
+
     L2 = alpha * L
 
     lhs = G.T @ G + L2.T @ L2
@@ -30,13 +167,19 @@ def solve_higher_tikhonov(d, G, L, alpha=0):
     return m
 
 
-def solve_higher_tikhonov_L1(d, G, L, iterations=10, epsilon=0.1, alpha=0):
-    m = np.ones(np.size(G, 1))
+def solve_higher_tikhonov_L1(d, G, L, iterations=10, epsilon=0.1, alpha=0, method=None):
+    method = _solve_method(G, method)
+    m = np.ones(G.shape[1])
 
     for i in range(iterations):
         y = L @ m
         y = np.abs(y)
         y[y < epsilon] = epsilon
+        if method != 'direct':
+            # same normal equations as below scaled by 1 / 2, warm started from the previous iterate
+            m = _iterative_solvers[method](d, G, sparse.diags(1 / np.sqrt(y)) @ L, np.sqrt(alpha / 2), x0=m,
+                                           tol=1e-12)
+            continue
         W = np.diag(1 / y)
 
         lhs = 2 * G.T @ G + alpha * L.T @ W @ L
@@ -46,20 +189,77 @@ def solve_higher_tikhonov_L1(d, G, L, iterations=10, epsilon=0.1, alpha=0):
     return m
 
 
+def first_difference_operator(shape):
+    """Sparse forward differences along both axes of a C ordered image of shape (ny, nx), stacked [D_x; D_y]."""
+    ny, nx = shape
+
+    def difference(n):
+        return sparse.diags([-np.ones(n - 1), np.ones(n - 1)], [0, 1], shape=(n - 1, n))
+
+    D_x = sparse.kron(sparse.identity(ny), difference(nx))
+    D_y = sparse.kron(difference(ny), sparse.identity(nx))
+    return sparse.vstack((D_x, D_y)).tocsr()
+
+
+def solve_irls_l1(d, G, L, alpha=0, epsilon=0.1, x0=None, tol=1e-4, max_iterations=50, cg_tol=1e-6,
+                  cg_iterations=200, callback=None):
+    """Minimize ||G m - d||^2 + alpha / 2 ||L m||_1 by iteratively reweighted least squares.
+
+    Same reweighting as solve_higher_tikhonov_L1, but L stays sparse, W = 1 / max(|L m|, epsilon) is applied as an
+    elementwise scaling and each reweighted system (2 G^T G + alpha L^T W L) m = 2 G^T d is solved by CG warm started
+    from the previous iterate. Stops when the relative change in m is below tol. G may be dense, sparse or an operator,
+    with first_difference_operator as L this is anisotropic TV. callback(iteration, m, change) after every iteration.
+    An inner solve stopped by cg_iterations before reaching cg_tol warns with a RuntimeWarning.
+    """
+    G = aslinearoperator(G)
+    L = sparse.csr_matrix(L) if not isinstance(L, LinearOperator) else L
+    n = G.shape[1]
+    m = np.ones(n) if x0 is None else np.array(x0, dtype=np.double)
+    rhs = 2 * G.rmatvec(np.asarray(d, dtype=np.double))
+    weights = np.empty(L.shape[0])
+
+    def normal_matvec(v):
+        return 2 * G.rmatvec(G.matvec(v)) + alpha * (L.T @ (weights * (L @ v)))
+
+    lhs = LinearOperator((n, n), matvec=normal_matvec, dtype=np.double)
+
+    for iteration in range(max_iterations):
+        np.abs(L @ m, out=weights)
+        np.maximum(weights, epsilon, out=weights)
+        np.divide(1, weights, out=weights)
+
+        m_next, info = cg(lhs, rhs, x0=m, rtol=cg_tol, atol=0, maxiter=cg_iterations)
+        if info != 0:
+            warnings.warn(f'CG did not reach cg_tol={cg_tol} within {cg_iterations} iterations at IRLS iteration '
+                          f'{iteration}', RuntimeWarning, stacklevel=2)
+        change = np.linalg.norm(m_next - m) / max(np.linalg.norm(m_next), np.finfo(np.double).tiny)
+        m = m_next
+
+        if callback is not None:
+            callback(iteration, m, change)
+        if change <= tol:
+            break
+
+    return m
+
+
 def mlem(d, G, n_steps, initial_estimate=None):
     if initial_estimate is None:
-        m_old = np.ones(np.size(G, 1))
+        m_old = np.ones(G.shape[1])
     else:
         m_old = initial_estimate
 
-    sensitivity = G.sum(axis=0)
+    sensitivity = _column_sums(G)
 
     old_settings = np.seterr(divide='ignore', invalid='ignore')
 
     for step in range(n_steps):
         back_projection = G @ m_old
         relative_back_projection = np.nan_to_num(d / back_projection)
-        correction_factor = (relative_back_projection @ G)
+        if isinstance(G, np.ndarray):
+            correction_factor = (relative_back_projection @ G)
+        else:
+            correction_factor = G.T @ relative_back_projection
         m_new = m_old / sensitivity * correction_factor
         m_old = m_new
 
@@ -70,7 +270,7 @@ def mlem(d, G, n_steps, initial_estimate=None):
 
 def osem(d, G, n_steps, subset_masks, initial_estimate=None):
     if initial_estimate is None:
-        m_old = np.ones(np.size(G, 1))
+        m_old = np.ones(G.shape[1])
     else:
         m_old = initial_estimate
 
@@ -80,9 +280,13 @@ def osem(d, G, n_steps, subset_masks, initial_estimate=None):
 
     for step in range(n_steps):
         for i, subset in enumerate(subset_masks):
-            mu_i_t = G[subset, :] @ m_old
-            denominator = G[subset, :].sum(axis=0)
-            numerator = np.nan_to_num((d[subset] * G[subset, :].T) / mu_i_t).sum(axis=1)
+            G_subset = _rows(G, subset)
+            mu_i_t = G_subset @ m_old
+            denominator = _column_sums(G_subset)
+            if isinstance(G, np.ndarray):
+                numerator = np.nan_to_num((d[subset] * G_subset.T) / mu_i_t).sum(axis=1)
+            else:
+                numerator = G_subset.T @ np.nan_to_num(d[subset] / mu_i_t)
             nan_mask = np.where(denominator > 0)
             m_new[nan_mask] = m_old[nan_mask] * numerator[nan_mask] / denominator[nan_mask]
             m_old[:] = m_new
@@ -92,7 +296,94 @@ def osem(d, G, n_steps, subset_masks, initial_estimate=None):
     return m_new
 
 
+class OrderedSubsetEM(object):
+    """MLEM / OSEM with the subset blocks of G split off once.
+
+    G is a dense array, a CSR matrix or a LinearOperator with rows (response.GridProjector). subset_masks are boolean
+    masks or index arrays over the rows of G, None runs MLEM with a single subset. Each subset is further split into
+    num_threads row blocks whose expectation steps run in a thread pool (None for every core). Rays with zero forward
+    projection contribute nothing and cells with zero sensitivity are left unchanged.
+    """
+
+    def __init__(self, G, subset_masks=None, num_threads=1):
+        if subset_masks is None:
+            subset_masks = [np.arange(G.shape[0])]
+        self.num_threads = os.cpu_count() if num_threads is None else num_threads
+        self.shape = G.shape
+
+        self._subsets = []
+        for subset in subset_masks:
+            subset = np.asarray(subset)
+            rows = np.flatnonzero(subset) if subset.dtype == bool else subset
+            blocks = []
+            for block_rows in np.array_split(rows, self.num_threads):
+                if len(block_rows) == 0:
+                    continue
+                block = _rows(G, block_rows)
+                if sparse.issparse(block):
+                    block = block.tocsr()
+                    block_t = block.T.tocsr()
+                else:
+                    block_t = block.T
+                blocks.append((block_rows, block, block_t, np.empty(len(block_rows)), np.empty(G.shape[1])))
+
+            sensitivity = np.zeros(G.shape[1])
+            for _, block, _, _, _ in blocks:
+                sensitivity += _column_sums(block)
+            sensitive = sensitivity > 0
+            inverse_sensitivity = np.zeros(G.shape[1])
+            np.divide(1, sensitivity, out=inverse_sensitivity, where=sensitive)
+            self._subsets.append((blocks, inverse_sensitivity, sensitive, np.empty(G.shape[1])))
+
+    @staticmethod
+    def _expectation(block, block_t, d_block, projection, correction, m):
+        # correction = block.T @ (d / (block @ m)), projections of zero give a ratio of zero
+        if isinstance(block, np.ndarray):
+            np.dot(block, m, out=projection)
+        else:
+            projection[:] = block @ m
+        np.divide(d_block, projection, out=projection, where=projection > 0)
+
+        if isinstance(block_t, np.ndarray):
+            np.dot(block_t, projection, out=correction)
+        else:
+            correction[:] = block_t @ projection
+
+    def run(self, d, n_steps, initial_estimate=None):
+        m = np.ones(self.shape[1]) if initial_estimate is None else np.array(initial_estimate, dtype=np.double)
+        d = np.asarray(d, dtype=np.double)
+        d_blocks = [[d[block[0]] for block in blocks] for blocks, _, _, _ in self._subsets]
+
+        pool = ThreadPoolExecutor(self.num_threads) if self.num_threads > 1 else None
+        try:
+            for step in range(n_steps):
+                for (blocks, inverse_sensitivity, sensitive, correction), d_subset in zip(self._subsets, d_blocks):
+                    tasks = [(block, block_t, d_block, projection, block_correction, m)
+                             for (_, block, block_t, projection, block_correction), d_block in zip(blocks, d_subset)]
+                    if pool is None:
+                        for task in tasks:
+                            self._expectation(*task)
+                    else:
+                        list(pool.map(lambda task: self._expectation(*task), tasks))
+
+                    correction[:] = blocks[0][4]
+                    for block in blocks[1:]:
+                        correction += block[4]
+                    correction *= inverse_sensitivity
+                    np.multiply(m, correction, out=m, where=sensitive)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        return m
+
+
 def generalized_cross_validation(d, G, alpha):
+    if sparse.issparse(G):
+        G = G.toarray()
+    elif not isinstance(G, np.ndarray):
+        raise TypeError('generalized_cross_validation needs G as an array or sparse matrix')
+
     m = np.size(G, 0)
     L = np.identity(np.size(G, 1))
 
@@ -117,6 +408,74 @@ def trace_lcurve(d, G, alphas):
     return norms, residuals
 
 
+class TikhonovSweep(object):
+    """Tikhonov solutions, L-curve and GCV for many alphas from one SVD of G.
+
+    The SVD is full for dense (or densified sparse) G, or truncated to the largest rank singular values when rank is
+    given, which also works for LinearOperators. Every quantity is then closed form in the filter factors
+    s^2 / (s^2 + alpha^2), with alpha as in solve_tikhonov.
+    """
+
+    def __init__(self, G, rank=None):
+        self.shape = G.shape
+        if rank is None:
+            if sparse.issparse(G):
+                G = G.toarray()
+            elif not isinstance(G, np.ndarray):
+                raise TypeError('a full SVD needs G as an array or sparse matrix, pass rank for a truncated one')
+            self.U, self.s, self.Vt = np.linalg.svd(G, full_matrices=False)
+        else:
+            U, s, Vt = svds(aslinearoperator(G), k=rank)
+            order = np.argsort(s)[::-1]
+            self.U, self.s, self.Vt = U[:, order], s[order], Vt[order]
+
+        self._d = None
+        self._projection = None
+
+    def _project(self, d):
+        # U^T d and the part of ||d||^2 outside the range of U, cached for the last data vector
+        if self._d is None or not np.array_equal(self._d, d):
+            self._d = np.array(d, dtype=np.double)
+            self._projection = self.U.T @ self._d
+            self._outside = max(self._d @ self._d - self._projection @ self._projection, 0.)
+        return self._projection
+
+    def _filters(self, alphas):
+        alphas = np.atleast_1d(np.asarray(alphas, dtype=np.double))
+        s2 = self.s ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            filters = np.nan_to_num(s2 / (s2 + alphas[:, None] ** 2))
+        return filters
+
+    def solution(self, d, alpha):
+        beta = self._project(d)
+        filters = self._filters(alpha)[0]
+        nonzero = self.s > 0
+        return self.Vt[nonzero].T @ (filters[nonzero] * beta[nonzero] / self.s[nonzero])
+
+    def lcurve(self, d, alphas):
+        """Solution and residual norms for every alpha, as trace_lcurve."""
+        beta = self._project(d)
+        filters = self._filters(alphas)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coefficients = np.nan_to_num(beta / self.s)
+        norms = np.sqrt(((filters * coefficients) ** 2).sum(axis=1))
+        residuals = np.sqrt((((1 - filters) * beta) ** 2).sum(axis=1) + self._outside)
+        return norms, residuals
+
+    def gcv(self, d, alphas):
+        """generalized_cross_validation for every alpha."""
+        _, residuals = self.lcurve(d, alphas)
+        m = self.shape[0]
+        return m * residuals ** 2 / (m - self._filters(alphas).sum(axis=1)) ** 2
+
+    def curvature(self, d, alphas):
+        """lcurve_curvature of the L-curve over alphas."""
+        alphas = np.asarray(alphas, dtype=np.double)
+        norms, residuals = self.lcurve(d, alphas)
+        return lcurve_curvature(alphas, norms, residuals)
+
+
 def diff_central(x, y):
     """Calculate central derivative, return derivative values excluding endpoints."""
     x0 = x[:-2]
@@ -168,7 +527,106 @@ def filtered_back_projection(sinogram, radians):
         filtered = np.real(np.fft.ifft(
             np.fft.fft(np.pad(sinogram[:, i], (pre_pad, post_pad), 'constant', constant_values=(0, 0))) * ramp_filter))[
                    pre_pad:-post_pad]
-        back_projection = rotate(np.tile(filtered, (np.size(sinogram, 0), 1)), sinogram, reshape=False, mode='constant')
+        back_projection = rotate(np.tile(filtered, (np.size(sinogram, 0), 1)), np.rad2deg(radian), reshape=False,
+                                 mode='constant')
         reconstruction_image += back_projection * 2 * np.pi / len(radians)
 
     return reconstruction_image
+
+
+# ramp filter spectra by (geometry, padded size, detector spacing)
+_ramp_filters = {}
+
+
+def _ramp_filter(kind, padded_size, spacing):
+    key = (kind, padded_size, spacing)
+    if key not in _ramp_filters:
+        # band limited ramp kernel sampled in space (Kak & Slaney), so the filter has no DC offset
+        k = np.fft.fftfreq(padded_size, 1. / padded_size)
+        kernel = np.zeros(padded_size)
+        odd = k % 2 == 1
+        if kind == 'parallel':
+            kernel[0] = 1 / (4 * spacing ** 2)
+            kernel[odd] = -1 / (np.pi * k[odd] * spacing) ** 2
+        else:
+            kernel[0] = 1 / (8 * spacing ** 2)
+            kernel[odd] = -1 / (2 * (np.pi * np.sin(k[odd] * spacing)) ** 2)
+        _ramp_filters[key] = np.fft.rfft(kernel).real * spacing
+
+    return _ramp_filters[key]
+
+
+def _filter_projections(sinogram, kind, spacing):
+    """Ramp filter every column (angle) of sinogram with one batched rfft along the detector axis."""
+    n = np.size(sinogram, 0)
+    padded_size = int(2 ** np.ceil(np.log2(2 * n)))
+    spectrum = np.fft.rfft(sinogram, n=padded_size, axis=0)
+    spectrum *= _ramp_filter(kind, padded_size, spacing)[:, None]
+    return np.fft.irfft(spectrum, n=padded_size, axis=0)[:n]
+
+
+def _interpolate_columns(filtered, positions, columns):
+    """Linear interpolation of filtered[:, columns] at fractional detector positions, zero outside the detector."""
+    low = np.floor(positions).astype(np.intp)
+    fraction = positions - low
+    valid = (low >= 0) & (low < np.size(filtered, 0) - 1)
+    low[~valid] = 0
+    values = filtered[low, columns] * (1 - fraction) + filtered[low + 1, columns] * fraction
+    values[~valid] = 0
+    return values
+
+
+def filtered_back_projection_parallel(sinogram, height, radians, xs, ys, block_size=16):
+    """Filtered back projection of a geometry.parallel_beam_paths sinogram (detectors, angles) onto pixels xs, ys.
+
+    radians should evenly cover a half turn. Returns the (len(ys), len(xs)) image and its extent like the other image
+    functions. Angles are backprojected block_size at a time, vectorized over every pixel.
+    """
+    n_detectors = np.size(sinogram, 0)
+    spacing = height / n_detectors
+    filtered = _filter_projections(np.asarray(sinogram, dtype=np.double), 'parallel', spacing)
+
+    x, y = np.meshgrid(xs, ys)
+    x, y = x.reshape(-1, 1), y.reshape(-1, 1)
+    image = np.zeros(x.shape[0])
+
+    for begin in range(0, len(radians), block_size):
+        angles = np.asarray(radians[begin:begin + block_size])
+        columns = np.arange(begin, begin + len(angles))
+        # detector coordinate of each pixel, the rays of angle theta have normal (sin, cos)
+        t = x * np.sin(angles) + y * np.cos(angles)
+        positions = (t + height / 2) / spacing - 0.5
+        image += _interpolate_columns(filtered, positions, columns).sum(axis=1)
+
+    image *= np.pi / len(radians)
+    return image.reshape(len(ys), len(xs)), [xs[0], xs[-1], ys[0], ys[-1]]
+
+
+def filtered_back_projection_fan(sinogram, diameter, arc_radians, radians, xs, ys, block_size=16):
+    """Filtered back projection of a geometry.fan_beam_paths sinogram (arc angles, angles) onto pixels xs, ys.
+
+    Equiangular fan beam reconstruction, radians should evenly cover a full turn. Returns the (len(ys), len(xs)) image
+    and its extent.
+    """
+    source_distance = diameter / 2
+    arc_radians = np.asarray(arc_radians, dtype=np.double)
+    spacing = (arc_radians[-1] - arc_radians[0]) / (len(arc_radians) - 1)
+    weighted = np.asarray(sinogram, dtype=np.double) * (source_distance * np.cos(arc_radians))[:, None]
+    filtered = _filter_projections(weighted, 'fan', spacing)
+
+    x, y = np.meshgrid(xs, ys)
+    x, y = x.reshape(-1, 1), y.reshape(-1, 1)
+    image = np.zeros(x.shape[0])
+
+    for begin in range(0, len(radians), block_size):
+        angles = np.asarray(radians[begin:begin + block_size])
+        columns = np.arange(begin, begin + len(angles))
+        # source of angle beta sits at (-cos, sin) * R with its central ray pointing at the origin
+        dx = x + source_distance * np.cos(angles)
+        dy = y - source_distance * np.sin(angles)
+        gamma = np.mod(np.arctan2(dy, dx) + angles + np.pi, 2 * np.pi) - np.pi
+        positions = (gamma - arc_radians[0]) / spacing
+        image += (_interpolate_columns(filtered, positions, columns) / (dx ** 2 + dy ** 2)).sum(axis=1)
+
+    image *= 2 * np.pi / len(radians)
+    return image.reshape(len(ys), len(xs)), [xs[0], xs[-1], ys[0], ys[-1]]
@@ -1,3 +1,5 @@
+from collections import namedtuple, OrderedDict
+
 import numpy as np
 from . import geometry as geo
 from . import transmission
@@ -9,113 +11,275 @@ _fission_segment_cache = np.empty((100, 2, 2), dtype=np.double)
 _fission_value_cache = np.empty(100, dtype=np.double)
 _array1D_cache = np.empty(100, dtype=np.double)
 
+# probability_detect sampled on a regular grid, values[i, j] is at x = linspace(bounds[0], bounds[2])[i] and
+# y = linspace(bounds[1], bounds[3])[j]
+DetectorField = namedtuple('DetectorField', 'bounds values')
+
+_detector_fields = OrderedDict()
+_detector_fields_size = 32
+
+_gauss_legendre_rules = {}
+_binomial_tables = {}
+
 
-def fissionval_at_point(point, flat_geom):
-    return transmission_c.absorbance_at_point(point[0], point[1], flat_geom.segments, flat_geom.fission)
+def fissionval_at_point(point, flat_geom, grid=None):
+    return transmission_c.absorbance_at_point(point[0], point[1], flat_geom.segments, flat_geom.fission,
+                                              *transmission._grid_arrays(grid))
 
 
-def fissionval_image(xs, ys, flat_geom):
+def fissionval_image(xs, ys, flat_geom, grid=None, scanline=False, bvh=None):
     image = np.zeros((np.size(xs, 0), np.size(ys, 0)), dtype=np.double)
     extent = [xs[0], xs[-1], ys[0], ys[-1]]
 
-    transmission_c.absorbance_image(image, xs, ys, flat_geom.segments, flat_geom.fission)
+    if scanline:
+        transmission._check_scanline(xs)
+        transmission_c.absorbance_image_scanline(image, xs, ys, flat_geom.segments, flat_geom.fission,
+                                                 *transmission._bvh_arrays(bvh), *transmission._grid_arrays(grid))
+    else:
+        transmission_c.absorbance_image(image, xs, ys, flat_geom.segments, flat_geom.fission,
+                                        *transmission._grid_arrays(grid))
 
     return image.T, extent
 
 
-# TODO Cython
-def find_fission_segments(start, end, flat_geom, fission_segments=None, fission_values=None):
+def _reserve_fission_cache(capacity):
+    global _fission_segment_cache, _fission_value_cache
+
+    if capacity > len(_fission_segment_cache):
+        capacity = max(capacity, 2 * len(_fission_segment_cache))
+        _fission_segment_cache = np.empty((capacity, 2, 2), dtype=np.double)
+        _fission_value_cache = np.empty(capacity, dtype=np.double)
+
+
+def find_fission_segments(start, end, flat_geom, fission_segments=None, fission_values=None, bvh=None,
+                          compiled=None):
+    # n crossings split the path into at most n + 1 fission segments, and n is at most the segment count
+    if fission_segments is None or fission_values is None:
+        _reserve_fission_cache(np.size(flat_geom.segments, 0) + 1)
     if fission_segments is None:
         fission_segments = _fission_segment_cache
     if fission_values is None:
         fission_values = _fission_value_cache
 
-    def point_is_outer_segment_side(x, y, segments):
-        return (x - segments[:, 0, 0]) * (segments[:, 0, 1] - segments[:, 1, 1]) + (y - segments[:, 0, 1]) * (
-            segments[:, 1, 0] - segments[:, 0, 0]) > 0
-
-    segment_count = 0
-    intersects, indexes = transmission.intersections(np.copy(start), np.copy(end), flat_geom.segments)
-    if np.size(intersects, 0) == 0:
-        return fission_segments[:0], fission_values[:0]
-
-    # sort intercepts by distance
-    distances = np.sum((intersects - start) ** 2, axis=1)
-    distance_order = np.argsort(distances)
-    intersects = intersects[distance_order]
-    indexes = indexes[distance_order]
-    value = flat_geom.fission[indexes]
-    start_on_outer_side = point_is_outer_segment_side(start[0], start[1], flat_geom.segments[indexes])
-
-    # test if [start, intersect[0]] is fissionable path
-    if start_on_outer_side[0] and value[0, 1] > 0:
-        fission_segments[segment_count] = [start, intersects[0]]
-        fission_values[segment_count] = value[0, 0]
-        segment_count += 1
-    elif not start_on_outer_side[0] and value[0, 0] > 0:
-        fission_segments[segment_count] = [start, intersects[0]]
-        fission_values[segment_count] = value[0, 1]
-        segment_count += 1
-
-    # test all intervening segments
-    for i in range(np.size(intersects, 0) - 1):
-        if start_on_outer_side[i] and value[i, 0] > 0:
-            if start_on_outer_side[i + 1] and value[i + 1, 1] > 0:
-                fission_segments[segment_count] = [intersects[i], intersects[i + 1]]
-                fission_values[segment_count] = value[i + 1, 1]
-                segment_count += 1
-            elif not start_on_outer_side[i + 1] and value[i + 1, 0] > 0:
-                fission_segments[segment_count] = [intersects[i], intersects[i + 1]]
-                fission_values[segment_count] = value[i + 1, 0]
-                segment_count += 1
-        elif not start_on_outer_side[i] and value[i, 1] > 0:
-            if start_on_outer_side[i + 1] and value[i + 1, 1] > 0:
-                fission_segments[segment_count] = [intersects[i], intersects[i + 1]]
-                fission_values[segment_count] = value[i + 1, 1]
-                segment_count += 1
-            elif not start_on_outer_side[i + 1] and value[i + 1, 0] > 0:
-                fission_segments[segment_count] = [intersects[i], intersects[i + 1]]
-                fission_values[segment_count] = value[i + 1, 0]
-                segment_count += 1
-
-    # test if [intersect[-1], end] is fissionable path
-    if start_on_outer_side[-1] and value[-1, 0] > 0:
-        fission_segments[segment_count] = [intersects[-1], end]
-        fission_values[segment_count] = value[-1, 0]
-        segment_count += 1
-    elif not start_on_outer_side[-1] and value[-1, 1] > 0:
-        fission_segments[segment_count] = [intersects[-1], end]
-        fission_values[segment_count] = value[-1, 1]
-        segment_count += 1
+    segment_count = fission_c.find_fission_segments(np.ascontiguousarray(start, dtype=np.double),
+                                                    np.ascontiguousarray(end, dtype=np.double),
+                                                    flat_geom.segments, flat_geom.fission, transmission._cache,
+                                                    fission_segments, fission_values,
+                                                    *transmission._bvh_arrays(bvh), compiled)
 
     return fission_segments[:segment_count], fission_values[:segment_count]
 
 
+def find_fission_segments_bulk(starts, ends, flat_geom, bvh=None, compiled=None):
+    """Fission segments of many paths as (offsets, segments, values), path i owns offsets[i]:offsets[i + 1]."""
+    return fission_c.find_fission_segments_bulk(np.ascontiguousarray(starts, dtype=np.double),
+                                                np.ascontiguousarray(ends, dtype=np.double),
+                                                flat_geom.segments, flat_geom.fission,
+                                                *transmission._bvh_arrays(bvh), compiled)
+
+
+def _field_arrays(field):
+    if field is None:
+        return None, None
+    return field.bounds, field.values
+
+
+def build_detector_field(flat_geom, detector_segments, shape=(64, 64), bounds=None, compiled=None):
+    """Sample the detection probability of a fission neutron over the geometry extent (or bounds)."""
+    if shape[0] < 2 or shape[1] < 2:
+        raise ValueError(f'detector field needs at least 2 x 2 samples, got {shape}')
+    if bounds is None:
+        points = flat_geom.segments.reshape(-1, 2)
+        bounds = np.concatenate((points.min(axis=0), points.max(axis=0)))
+    bounds = np.ascontiguousarray(bounds, dtype=np.double)
+    transmission._check_compiled(compiled, flat_geom.absorbance)
+
+    xs = np.linspace(bounds[0], bounds[2], shape[0])
+    ys = np.linspace(bounds[1], bounds[3], shape[1])
+    values = np.zeros(shape, dtype=np.double)
+    fission_c.probability_detect_image(values, xs, ys, flat_geom.absorbance, flat_geom.segments,
+                                       np.ascontiguousarray(detector_segments, dtype=np.double), 0.0,
+                                       transmission._cache, _array1D_cache, compiled)
+
+    return DetectorField(bounds, values)
+
+
+def detector_field(flat_geom, detector_segments, shape=(64, 64), bounds=None, compiled=None):
+    """build_detector_field, cached on the geometry and detector configuration."""
+    key = (flat_geom.segments.tobytes(), flat_geom.absorbance.tobytes(), np.asarray(detector_segments).tobytes(),
+           tuple(shape), None if bounds is None else tuple(bounds), compiled is not None and compiled.single)
+
+    field = _detector_fields.get(key)
+    if field is None:
+        field = build_detector_field(flat_geom, detector_segments, shape, bounds, compiled)
+        _detector_fields[key] = field
+        if len(_detector_fields) > _detector_fields_size:
+            _detector_fields.popitem(last=False)
+    else:
+        _detector_fields.move_to_end(key)
+
+    return field
+
+
+def gauss_legendre(order):
+    """Nodes and weights of the order point Gauss-Legendre rule on [0, 1]"""
+    rule = _gauss_legendre_rules.get(order)
+    if rule is None:
+        nodes, weights = np.polynomial.legendre.leggauss(order)
+        rule = (nodes + 1) / 2, weights / 2
+        _gauss_legendre_rules[order] = rule
+    return rule
+
+
+def binomial_table(n):
+    """(n, n) table of binom(i, k), zero for k > i"""
+    table = _binomial_tables.get(n)
+    if table is None:
+        table = np.zeros((n, n), dtype=np.double)
+        table[:, 0] = 1
+        for i in range(1, n):
+            table[i, 1:] = table[i - 1, 1:] + table[i - 1, :-1]
+        _binomial_tables[n] = table
+    return table
+
+
+def adaptive_quadrature(integrate, tolerance=1e-4, order=3, max_depth=8):
+    """Integrate over [0, 1] by adaptive subdivision with Gauss-Legendre rules.
+
+    integrate(nodes, weights) returns the weighted sum of the integrand at nodes, a scalar or an array. Each interval
+    is integrated with the order and order + 1 point rules and split in half until the two agree to tolerance times
+    the current estimate of the whole integral, shared out by interval width, or max_depth halvings are reached. The
+    estimate is refined as intervals split, so a first estimate near zero does not force every interval down to
+    max_depth. Returns the integral and the number of integrand evaluations.
+    """
+    low_nodes, low_weights = gauss_legendre(order)
+    high_nodes, high_weights = gauss_legendre(order + 1)
+
+    def rules(a, b):
+        return (integrate(a + (b - a) * low_nodes, (b - a) * low_weights),
+                integrate(a + (b - a) * high_nodes, (b - a) * high_weights))
+
+    low, high = rules(0., 1.)
+    total, evaluations, estimate = 0., 2 * order + 1, high
+    intervals = [(0., 1., 0, low, high)]
+    while intervals:
+        a, b, depth, low, high = intervals.pop()
+        if np.max(np.abs(high - low)) <= tolerance * np.max(np.abs(estimate)) * (b - a) or depth >= max_depth:
+            total += high
+        else:
+            middle = (a + b) / 2
+            left, right = rules(a, middle), rules(middle, b)
+            evaluations += 2 * (2 * order + 1)
+            estimate = estimate - high + left[1] + right[1]
+            intervals.append((middle, b, depth + 1) + right)
+            intervals.append((a, middle, depth + 1) + left)
+    return total, evaluations
+
+
 def probability_segment_neutron_c(source, fission_segment, mu_fission, flat_geom, detector_segments, k, nu_dist,
-                                  num_segment_points=5):
+                                  num_segment_points=5, field=None, compiled=None):
     return fission_c.probability_segment_neutron(flat_geom.segments, flat_geom.absorbance, fission_segment,
                                                  detector_segments,
                                                  0.0, num_segment_points, source, k, nu_dist, mu_fission,
-                                                 transmission._intersect_cache,
-                                                 transmission._index_cache, _array1D_cache)
+                                                 transmission._cache, _array1D_cache, *_field_arrays(field),
+                                                 compiled)
 
 
 def probability_segment_neutron_grid_c(source, fission_segment, flat_geom, detector_segments, k, nu_dist,
-                                       num_segment_points=5):
+                                       num_segment_points=5, field=None, compiled=None):
     return fission_c.probability_segment_neutron_grid(flat_geom.segments, flat_geom.absorbance, fission_segment,
                                                       detector_segments,
                                                       0.0, num_segment_points, source, k, nu_dist,
-                                                      transmission._intersect_cache,
-                                                      transmission._index_cache, _array1D_cache)
-
+                                                      transmission._cache, _array1D_cache, *_field_arrays(field),
+                                                      compiled)
+
+
+def probability_segment_neutron_adaptive(source, fission_segment, mu_fission, flat_geom, detector_segments, k,
+                                         nu_dist, tolerance=1e-4, order=3, field=None, compiled=None):
+    """probability_segment_neutron_c by adaptive_quadrature, returns the probability and the number of evaluations"""
+    def integrate(nodes, weights):
+        return fission_c.probability_segment_neutron(flat_geom.segments, flat_geom.absorbance, fission_segment,
+                                                     detector_segments, 0.0, 0, source, k, nu_dist, mu_fission,
+                                                     transmission._cache, _array1D_cache, *_field_arrays(field),
+                                                     compiled, nodes, weights)
+
+    return adaptive_quadrature(integrate, tolerance, order)
+
+
+def probability_segment_neutron_grid_adaptive(source, fission_segment, flat_geom, detector_segments, k, nu_dist,
+                                              tolerance=1e-4, order=3, field=None, compiled=None):
+    """probability_segment_neutron_grid_c by adaptive_quadrature, returns the probability and the number of
+    evaluations"""
+    def integrate(nodes, weights):
+        return fission_c.probability_segment_neutron_grid(flat_geom.segments, flat_geom.absorbance, fission_segment,
+                                                          detector_segments, 0.0, 0, source, k, nu_dist,
+                                                          transmission._cache, _array1D_cache,
+                                                          *_field_arrays(field), compiled, nodes, weights)
+
+    return adaptive_quadrature(integrate, tolerance, order)
+
+
+def probability_path_neutron_adaptive(start, end, flat_geom, detector_segments, k, matrix, p_range, tolerance=1e-4,
+                                      order=3, field=None, compiled=None):
+    """probability_path_neutron integrating each fission segment by adaptive_quadrature to the relative tolerance,
+    returns the probability, an array for an array of multiplicities k, and the number of point evaluations"""
+    multiple = np.ndim(k) > 0
+    if multiple:
+        k = np.ascontiguousarray(k, dtype=np.int32)
+        binomials = binomial_table(np.size(matrix, 1))
+    nudists = np.empty((order + 1, np.size(matrix, 1)), dtype=np.double)
+    fission_segments, fission_values = find_fission_segments(start, end, flat_geom, compiled=compiled)
+
+    prob, evaluations = 0., 0
+    for (fission_segment, fission_value) in zip(fission_segments, fission_values):
+        segment_vector = fission_segment[1] - fission_segment[0]
+        segment_length = np.sqrt(segment_vector[0] * segment_vector[0] + segment_vector[1] * segment_vector[1])
+
+        def integrate(nodes, weights):
+            points = fission_segment[0] + nodes[:, None] * segment_vector
+            p_values = [chain.p_at_point(point, flat_geom) for point in points]
+            point_nudists = chain.interpolate_p_batch(matrix, p_values, p_range, out=nudists[:len(nodes)])
+
+            total = np.zeros(len(k)) if multiple else 0.
+            for point, nudist, weight in zip(points, point_nudists, weights):
+                _array1D_cache[:2] = point
+                if multiple:
+                    fission_c.probability_point_neutron_multi(flat_geom.segments, flat_geom.absorbance,
+                                                              _array1D_cache, detector_segments, 0.0, start, k,
+                                                              nudist, fission_value, transmission._cache,
+                                                              binomials, weight, total, *_field_arrays(field),
+                                                              compiled)
+                    continue
+                total += weight * fission_c.probability_point_neutron(flat_geom.segments, flat_geom.absorbance,
+                                                                      _array1D_cache, detector_segments, 0.0,
+                                                                      start, k, nudist, fission_value,
+                                                                      transmission._cache, *_field_arrays(field),
+                                                                      compiled)
+            return total * segment_length
+
+        segment_prob, segment_evaluations = adaptive_quadrature(integrate, tolerance, order)
+        prob += segment_prob
+        evaluations += segment_evaluations
+    return prob, evaluations
+
+
+def probability_path_neutron(start, end, flat_geom, detector_segments, k, matrix, p_range, field=None,
+                             compiled=None, tolerance=None):
+    """Fission detection probability of the neutron path start -> end, tolerance integrates fission segments with
+    probability_path_neutron_adaptive instead of the five point midpoint rule. An array of multiplicities k returns
+    the probability of each, see probability_path_neutron_multi"""
+    if tolerance is not None:
+        return probability_path_neutron_adaptive(start, end, flat_geom, detector_segments, k, matrix, p_range,
+                                                 tolerance, field=field, compiled=compiled)[0]
+    if np.ndim(k) > 0:
+        return probability_path_neutron_multi(start, end, flat_geom, detector_segments, k, matrix, p_range, field,
+                                              compiled)
 
-def probability_path_neutron(start, end, flat_geom, detector_segments, k, matrix, p_range):
     num_segment_points = 5
-    point = _array1D_cache[:2]
-
-    nudist_arr = np.zeros((21), dtype=np.double)
+    point_fractions = (np.arange(1, num_segment_points + 1) - 0.5)[:, None]
+    nudists = np.empty((num_segment_points, np.size(matrix, 1)), dtype=np.double)
 
-    fission_segments, fission_values = find_fission_segments(start, end, flat_geom)
+    fission_segments, fission_values = find_fission_segments(start, end, flat_geom, compiled=compiled)
 
     prob = 0
     for (fission_segment, fission_value) in zip(fission_segments, fission_values):
@@ -125,28 +289,48 @@ def probability_path_neutron(start, end, flat_geom, detector_segments, k, matrix
                           (fission_segment[0, 1] - fission_segment[1, 1])
         segment_length = np.sqrt(segment_length)
 
-        for i in range(1, num_segment_points + 1):
-            _array1D_cache[0] = fission_segment[0, 0] + \
-                                (i - 0.5) * (fission_segment[1, 0] - fission_segment[0, 0]) / num_segment_points
-            _array1D_cache[1] = fission_segment[0, 1] + \
-                                (i - 0.5) * (fission_segment[1, 1] - fission_segment[0, 1]) / num_segment_points
+        points = fission_segment[0] + point_fractions * (fission_segment[1] - fission_segment[0]) / num_segment_points
+        p_values = [chain.p_at_point(point, flat_geom) for point in points]
+        chain.interpolate_p_batch(matrix, p_values, p_range, out=nudists)
 
-            # calc p at point
-            p_value = chain.p_at_point(_array1D_cache, flat_geom)
-            # p_value = p_at_point(_array1D_cache[0], _array1D_cache[1], flat_geom.segments,
-            #                      flat_geom.pfuncrefs, flat_geom.pfuncs)
+        segment_prob = 0
+        for point, nudist in zip(points, nudists):
+            _array1D_cache[:2] = point
+            segment_prob += fission_c.probability_point_neutron(flat_geom.segments, flat_geom.absorbance,
+                                                                _array1D_cache, detector_segments,
+                                                                0.0, start, k, nudist, fission_value,
+                                                                transmission._cache, *_field_arrays(field), compiled)
 
-            nudist_interp = chain.interpolate_p(matrix, p_value, p_range, method='linear', log_interpolate=False)
-            # nudist_arr = nudist_interp[0]
-            nudist_arr = nudist_interp
+        prob += segment_prob * segment_length / num_segment_points
+    return prob
 
-            prob += fission_c.probability_point_neutron(flat_geom.segments, flat_geom.absorbance, _array1D_cache,
-                                                        detector_segments,
-                                                        0.0, start, k, nudist_arr, fission_value,
-                                                        transmission._intersect_cache,
-                                                        transmission._index_cache)
 
-        prob *= segment_length / num_segment_points
-    return prob
+def probability_path_neutron_multi(start, end, flat_geom, detector_segments, ks, matrix, p_range, field=None,
+                                   compiled=None):
+    """probability_path_neutron for every multiplicity of ks, returns a (len(ks),) array. The path trace, detection
+    probability and nu distribution of each point are shared by all of them"""
+    num_segment_points = 5
+    point_fractions = (np.arange(1, num_segment_points + 1) - 0.5)[:, None]
+    nudists = np.empty((num_segment_points, np.size(matrix, 1)), dtype=np.double)
+    ks = np.ascontiguousarray(ks, dtype=np.int32)
+    binomials = binomial_table(np.size(matrix, 1))
 
+    fission_segments, fission_values = find_fission_segments(start, end, flat_geom, compiled=compiled)
 
+    probs = np.zeros(len(ks), dtype=np.double)
+    for (fission_segment, fission_value) in zip(fission_segments, fission_values):
+        segment_vector = fission_segment[1] - fission_segment[0]
+        segment_length = np.sqrt(segment_vector[0] * segment_vector[0] + segment_vector[1] * segment_vector[1])
+
+        points = fission_segment[0] + point_fractions * segment_vector / num_segment_points
+        p_values = [chain.p_at_point(point, flat_geom) for point in points]
+        chain.interpolate_p_batch(matrix, p_values, p_range, out=nudists)
+
+        for point, nudist in zip(points, nudists):
+            _array1D_cache[:2] = point
+            fission_c.probability_point_neutron_multi(flat_geom.segments, flat_geom.absorbance, _array1D_cache,
+                                                      detector_segments, 0.0, start, ks, nudist, fission_value,
+                                                      transmission._cache, binomials,
+                                                      segment_length / num_segment_points, probs,
+                                                      *_field_arrays(field), compiled)
+    return probs
@@ -2,10 +2,12 @@
 import numpy as np
 
 cimport numpy as np
-from pytracer.transmission_c cimport absorbance, absorbance_at_point
+from pytracer.transmission_c cimport absorbance, absorbance_at_point, IntersectionCache, c_trace, \
+    CompiledGeometry, SegmentArrays, compiled_arrays
 from pytracer.geometry_c cimport solid_angle
 from cython cimport cdivision, boundscheck, wraparound
 from libc.math cimport sqrt, acos, fabs, M_PI, exp, pow
+from libc.stdlib cimport malloc, realloc, free
 
 
 cpdef unsigned int binom(unsigned int n, unsigned int k):
@@ -28,10 +30,206 @@ cpdef unsigned int binom(unsigned int n, unsigned int k):
     return ans
 
 
+cdef inline double sign_line(double x, double y, double x1, double y1, double x2, double y2) nogil:
+    return (x - x1) * (y1 - y2) + (y - y1) * (x2 - x1)
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef inline bint start_on_outer_side(double start_x, double start_y, double[:, :, ::1] segments, int i) nogil:
+    return sign_line(start_x, start_y, segments[i, 0, 0], segments[i, 0, 1], segments[i, 1, 0], segments[i, 1, 1]) > 0
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef inline void emit_fission_segment(double[:, :, ::1] fission_segments, double[::1] fission_values, int n,
+                                      double x0, double y0, double x1, double y1, double value) nogil:
+    fission_segments[n, 0, 0] = x0
+    fission_segments[n, 0, 1] = y0
+    fission_segments[n, 1, 0] = x1
+    fission_segments[n, 1, 1] = y1
+    fission_values[n] = value
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_find_fission_segments(double start_x, double start_y, double end_x, double end_y,
+                                 double[:, :, ::1] segments, double[:, ::1] fission,
+                                 double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes, int[::1] bvh_order, bint use_bvh,
+                                 double[:, ::1] intersect_cache, int[::1] index_cache,
+                                 double[:, :, ::1] fission_segments, double[::1] fission_values,
+                                 int *required, SegmentArrays *compiled) nogil:
+    """ Split [start, end] at its crossings and keep the pieces inside fissionable material
+
+    If the caches or outputs are too small required is set to the number of crossings + 1 and 0 is returned.
+    """
+    cdef:
+        int i, j, n, count = 0, index
+        double x, y, distance
+        double *value_0
+        double *value_1
+
+    required[0] = 0
+    n = c_trace(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                intersect_cache, index_cache, False, compiled)
+    if n > intersect_cache.shape[0] or n > index_cache.shape[0] or \
+            n + 1 > fission_segments.shape[0] or n + 1 > fission_values.shape[0]:
+        required[0] = n + 1
+        return 0
+
+    if n == 0:
+        return 0
+
+    # sort intercepts by distance, stable so equal distances keep segment order
+    for i in range(1, n):
+        x, y, index = intersect_cache[i, 0], intersect_cache[i, 1], index_cache[i]
+        distance = (x - start_x) * (x - start_x) + (y - start_y) * (y - start_y)
+        j = i
+        while j > 0 and (intersect_cache[j - 1, 0] - start_x) * (intersect_cache[j - 1, 0] - start_x) + \
+                (intersect_cache[j - 1, 1] - start_y) * (intersect_cache[j - 1, 1] - start_y) > distance:
+            intersect_cache[j, 0] = intersect_cache[j - 1, 0]
+            intersect_cache[j, 1] = intersect_cache[j - 1, 1]
+            index_cache[j] = index_cache[j - 1]
+            j -= 1
+        intersect_cache[j, 0], intersect_cache[j, 1], index_cache[j] = x, y, index
+
+    # test if [start, intersect[0]] is fissionable path
+    index = index_cache[0]
+    if start_on_outer_side(start_x, start_y, segments, index) and fission[index, 1] > 0:
+        emit_fission_segment(fission_segments, fission_values, count, start_x, start_y,
+                             intersect_cache[0, 0], intersect_cache[0, 1], fission[index, 0])
+        count += 1
+    elif not start_on_outer_side(start_x, start_y, segments, index) and fission[index, 0] > 0:
+        emit_fission_segment(fission_segments, fission_values, count, start_x, start_y,
+                             intersect_cache[0, 0], intersect_cache[0, 1], fission[index, 1])
+        count += 1
+
+    # test all intervening segments
+    for i in range(n - 1):
+        index = index_cache[i]
+        j = index_cache[i + 1]
+        if (start_on_outer_side(start_x, start_y, segments, index) and fission[index, 0] > 0) or \
+                (not start_on_outer_side(start_x, start_y, segments, index) and fission[index, 1] > 0):
+            if start_on_outer_side(start_x, start_y, segments, j) and fission[j, 1] > 0:
+                emit_fission_segment(fission_segments, fission_values, count, intersect_cache[i, 0],
+                                     intersect_cache[i, 1], intersect_cache[i + 1, 0], intersect_cache[i + 1, 1],
+                                     fission[j, 1])
+                count += 1
+            elif not start_on_outer_side(start_x, start_y, segments, j) and fission[j, 0] > 0:
+                emit_fission_segment(fission_segments, fission_values, count, intersect_cache[i, 0],
+                                     intersect_cache[i, 1], intersect_cache[i + 1, 0], intersect_cache[i + 1, 1],
+                                     fission[j, 0])
+                count += 1
+
+    # test if [intersect[-1], end] is fissionable path
+    index = index_cache[n - 1]
+    if start_on_outer_side(start_x, start_y, segments, index) and fission[index, 0] > 0:
+        emit_fission_segment(fission_segments, fission_values, count, intersect_cache[n - 1, 0],
+                             intersect_cache[n - 1, 1], end_x, end_y, fission[index, 0])
+        count += 1
+    elif not start_on_outer_side(start_x, start_y, segments, index) and fission[index, 1] > 0:
+        emit_fission_segment(fission_segments, fission_values, count, intersect_cache[n - 1, 0],
+                             intersect_cache[n - 1, 1], end_x, end_y, fission[index, 1])
+        count += 1
+
+    return count
+
+
+cpdef int find_fission_segments(double[::1] start, double[::1] end, double[:, :, ::1] segments,
+                                double[:, ::1] fission, IntersectionCache trace_cache,
+                                double[:, :, ::1] fission_segments, double[::1] fission_values,
+                                double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None,
+                                int[::1] bvh_order=None, CompiledGeometry compiled=None) except -1:
+    cdef:
+        int count, required = 0
+        bint use_bvh = bvh_bounds is not None
+        SegmentArrays *arrays = compiled_arrays(compiled, segments)
+
+    count = c_find_fission_segments(start[0], start[1], end[0], end[1], segments, fission, bvh_bounds, bvh_nodes,
+                                    bvh_order, use_bvh, trace_cache.intersects, trace_cache.indexes,
+                                    fission_segments, fission_values, &required, arrays)
+    if required > trace_cache.capacity:
+        trace_cache.reserve(required)
+        count = c_find_fission_segments(start[0], start[1], end[0], end[1], segments, fission, bvh_bounds,
+                                        bvh_nodes, bvh_order, use_bvh, trace_cache.intersects, trace_cache.indexes,
+                                        fission_segments, fission_values, &required, arrays)
+    if required > 0:
+        raise ValueError(f'fission segment caches need room for {required} segments')
+    return count
+
+
+@boundscheck(False)
+@wraparound(False)
+def find_fission_segments_bulk(double[:, ::1] starts, double[:, ::1] ends, double[:, :, ::1] segments,
+                               double[:, ::1] fission, double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None,
+                               int[::1] bvh_order=None, CompiledGeometry compiled=None):
+    """ Fission segments of many paths in CSR layout, path i owns rows offsets[i]:offsets[i + 1] """
+    cdef:
+        int i, j, count, required, total = 0, num_segments = max(segments.shape[0], 1)
+        size_t capacity = max(starts.shape[0], 16)
+        bint use_bvh = bvh_bounds is not None, out_of_memory = False
+        # a path crosses each segment at most once, so these can never be too small
+        double[:, ::1] intersect_cache = np.empty((num_segments, 2), dtype=np.double)
+        int[::1] index_cache = np.empty(num_segments, dtype=np.int32)
+        double[:, :, ::1] path_segments = np.empty((num_segments + 1, 2, 2), dtype=np.double)
+        double[::1] path_values = np.empty(num_segments + 1, dtype=np.double)
+        int[::1] offsets = np.zeros(starts.shape[0] + 1, dtype=np.int32)
+        double *all_segments = <double *>malloc(capacity * 4 * sizeof(double))
+        double *all_values = <double *>malloc(capacity * sizeof(double))
+        double *grown
+        SegmentArrays *arrays = compiled_arrays(compiled, segments)
+
+    try:
+        if all_segments == NULL or all_values == NULL:
+            raise MemoryError()
+
+        with nogil:
+            for i in range(starts.shape[0]):
+                count = c_find_fission_segments(starts[i, 0], starts[i, 1], ends[i, 0], ends[i, 1], segments,
+                                                fission, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                                                intersect_cache, index_cache, path_segments, path_values,
+                                                &required, arrays)
+                if total + count > capacity:
+                    capacity = max(2 * capacity, total + count)
+                    grown = <double *>realloc(all_segments, capacity * 4 * sizeof(double))
+                    if grown == NULL:
+                        out_of_memory = True
+                        break
+                    all_segments = grown
+                    grown = <double *>realloc(all_values, capacity * sizeof(double))
+                    if grown == NULL:
+                        out_of_memory = True
+                        break
+                    all_values = grown
+
+                for j in range(count):
+                    all_segments[4 * (total + j)] = path_segments[j, 0, 0]
+                    all_segments[4 * (total + j) + 1] = path_segments[j, 0, 1]
+                    all_segments[4 * (total + j) + 2] = path_segments[j, 1, 0]
+                    all_segments[4 * (total + j) + 3] = path_segments[j, 1, 1]
+                    all_values[total + j] = path_values[j]
+                total += count
+                offsets[i + 1] = total
+
+        if out_of_memory:
+            raise MemoryError()
+
+        fission_segments = np.empty((total, 2, 2), dtype=np.double)
+        fission_values = np.empty(total, dtype=np.double)
+        if total > 0:
+            fission_segments.ravel()[:] = <double[:4 * total]>all_segments
+            fission_values[:] = <double[:total]>all_values
+    finally:
+        free(all_segments)
+        free(all_values)
+
+    return np.asarray(offsets), fission_segments, fission_values
+
+
 cpdef double probability_detect(double[::1] position, double[:, ::1] absorbances,
                                 double[:, :, ::1] segments, double[:, :, ::1] detector_segments,
-                                double universe_absorption, double[:, ::1] intersect_cache,
-                                int[::1] index_cache, double[::1] cache):
+                                double universe_absorption, IntersectionCache trace_cache, double[::1] cache,
+                                CompiledGeometry compiled=None) except *:
     cdef:
         double prob_detect = 0
         double absorb
@@ -44,8 +242,8 @@ cpdef double probability_detect(double[::1] position, double[:, ::1] absorbances
         cache[1] = (detector_segments[i, 0, 1] + detector_segments[i, 1, 1]) / 2.
 
 
-        absorb = absorbance(position, cache[:2], segments, absorbances, universe_absorption,
-                           intersect_cache, index_cache)
+        absorb = absorbance(position, cache[:2], segments, absorbances, universe_absorption, trace_cache,
+                            None, None, None, compiled)
         exit_prob = exp(-absorb)
 
         prob_solid_angle = solid_angle(detector_segments[i], position) / (2 * M_PI)
@@ -53,12 +251,56 @@ cpdef double probability_detect(double[::1] position, double[:, ::1] absorbances
 
     return prob_detect
 
+
+cpdef void probability_detect_image(double[:, ::1] image, double[::1] xs, double[::1] ys,
+                                    double[:, ::1] absorbances, double[:, :, ::1] segments,
+                                    double[:, :, ::1] detector_segments, double universe_absorption,
+                                    IntersectionCache trace_cache, double[::1] cache,
+                                    CompiledGeometry compiled=None) except *:
+    cdef:
+        int i, j
+
+    for i in range(xs.shape[0]):
+        for j in range(ys.shape[0]):
+            cache[0] = xs[i]
+            cache[1] = ys[j]
+            image[i, j] = probability_detect(cache[:2], absorbances, segments, detector_segments,
+                                             universe_absorption, trace_cache, cache[2:], compiled)
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cpdef double interpolate_field(double px, double py, double[::1] field_bounds, double[:, ::1] field) nogil:
+    """Bilinear interpolation of field sampled on a regular grid spanning field_bounds, clamped at the edges."""
+    cdef:
+        int ix, iy
+        double fx, fy
+
+    fx = (px - field_bounds[0]) / (field_bounds[2] - field_bounds[0]) * (field.shape[0] - 1)
+    fy = (py - field_bounds[1]) / (field_bounds[3] - field_bounds[1]) * (field.shape[1] - 1)
+    fx = min(max(fx, 0.), field.shape[0] - 1.)
+    fy = min(max(fy, 0.), field.shape[1] - 1.)
+
+    ix = min(<int>fx, field.shape[0] - 2)
+    iy = min(<int>fy, field.shape[1] - 2)
+    fx -= ix
+    fy -= iy
+
+    return (1 - fx) * (1 - fy) * field[ix, iy] + fx * (1 - fy) * field[ix + 1, iy] + \
+           (1 - fx) * fy * field[ix, iy + 1] + fx * fy * field[ix + 1, iy + 1]
+
+
 cpdef double probability_segment_neutron(double[:, :, ::1] segments, double[:, ::1] absorbances,
                                          double[:, ::1] fission_segment, double[:, :, ::1] detector_segments,
                                          double universe_absorption, int num_segment_points,
                                          double[::1] source, int k, double[::1] nu_dist, double mu_fission,
-                                         double[:, ::1] intersect_cache,
-                                         int[::1] index_cache, double[::1] cache):
+                                         IntersectionCache trace_cache, double[::1] cache,
+                                         double[::1] field_bounds=None, double[:, ::1] field=None,
+                                         CompiledGeometry compiled=None, double[::1] nodes=None,
+                                         double[::1] weights=None) except *:
+    """ Midpoint rule with num_segment_points points, or the quadrature rule nodes, weights on [0, 1] along the
+    segment if given """
     cdef:
         int i, j
         double prob_ds, segment_probability = 0, segment_length
@@ -68,13 +310,23 @@ cpdef double probability_segment_neutron(double[:, :, ::1] segments, double[:, :
     segment_length += (fission_segment[0, 1] - fission_segment[1, 1]) * (fission_segment[0, 1] - fission_segment[1, 1])
     segment_length = sqrt(segment_length)
 
+    if nodes is not None:
+        for i in range(nodes.shape[0]):
+            cache[0] = fission_segment[0, 0] + nodes[i] * (fission_segment[1, 0] - fission_segment[0, 0])
+            cache[1] = fission_segment[0, 1] + nodes[i] * (fission_segment[1, 1] - fission_segment[0, 1])
+            segment_probability += weights[i] * probability_point_neutron(
+                segments, absorbances, cache, detector_segments, universe_absorption, source, k, nu_dist,
+                mu_fission, trace_cache, field_bounds, field, compiled)
+
+        return segment_probability * segment_length
+
     for i in range(1, num_segment_points + 1):
         cache[0] = fission_segment[0, 0] + (i - 0.5) * (fission_segment[1, 0] - fission_segment[0, 0]) / num_segment_points
         cache[1] = fission_segment[0, 1] + (i - 0.5) * (fission_segment[1, 1] - fission_segment[0, 1]) / num_segment_points
 
         segment_probability += probability_point_neutron(segments, absorbances, cache, detector_segments,
                                                          universe_absorption, source, k, nu_dist, mu_fission,
-                                                         intersect_cache, index_cache)
+                                                         trace_cache, field_bounds, field, compiled)
 
     segment_probability *= segment_length / num_segment_points
 
@@ -84,16 +336,23 @@ cpdef double probability_segment_neutron(double[:, :, ::1] segments, double[:, :
 cpdef double probability_point_neutron(double[:, :, ::1] segments, double [:, ::1] absorbances,
                                        double[::1] cache, double[:, :, ::1] detector_segments,
                                        double universe_absorption, double[::1] source, int k, double[::1] nu_dist,
-                                       double mu_fission, double[:, ::1] intersect_cache, int[::1] index_cache):
+                                       double mu_fission, IntersectionCache trace_cache,
+                                       double[::1] field_bounds=None, double[:, ::1] field=None,
+                                       CompiledGeometry compiled=None) except *:
     cdef:
         int i
         double prob_ds, point_probability = 0
         double prob_in, prob_out, absorb
 
-    absorb = absorbance(source, cache[:2], segments, absorbances, universe_absorption, intersect_cache, index_cache)
+    absorb = absorbance(source, cache[:2], segments, absorbances, universe_absorption, trace_cache,
+                        None, None, None, compiled)
     prob_in = exp(-absorb)
 
-    prob_detect = probability_detect(cache[:2], absorbances, segments, detector_segments, universe_absorption, intersect_cache, index_cache, cache[3:])
+    if field is None:
+        prob_detect = probability_detect(cache[:2], absorbances, segments, detector_segments, universe_absorption,
+                                         trace_cache, cache[3:], compiled)
+    else:
+        prob_detect = interpolate_field(cache[0], cache[1], field_bounds, field)
     prob_out = 0.0
 
     for i in range(np.size(nu_dist)):
@@ -104,36 +363,95 @@ cpdef double probability_point_neutron(double[:, :, ::1] segments, double [:, ::
     return point_probability
 
 
+@boundscheck(False)
+@wraparound(False)
+cdef inline void detect_multiplicities(double prob_detect, double[::1] nu_dist, int[::1] ks,
+                                       double[:, ::1] binomials, double scale, double[::1] out):
+    """ out[m] += scale * sum of binom(i, k) * nu_dist[i] * pd^k * (1 - pd)^(i - k) over i for k = ks[m], by Horner
+    in 1 - pd with binomials[i, k] = binom(i, k) """
+    cdef:
+        int i, k, m
+        double total, prob_miss = 1. - prob_detect
+
+    for m in range(ks.shape[0]):
+        k = ks[m]
+        total = 0.
+        for i in range(nu_dist.shape[0] - 1, k - 1, -1):
+            total = total * prob_miss + binomials[i, k] * nu_dist[i]
+        out[m] += scale * total * pow(prob_detect, k)
+
+
+cpdef void probability_point_neutron_multi(double[:, :, ::1] segments, double [:, ::1] absorbances,
+                                           double[::1] cache, double[:, :, ::1] detector_segments,
+                                           double universe_absorption, double[::1] source, int[::1] ks,
+                                           double[::1] nu_dist, double mu_fission, IntersectionCache trace_cache,
+                                           double[:, ::1] binomials, double weight, double[::1] out,
+                                           double[::1] field_bounds=None, double[:, ::1] field=None,
+                                           CompiledGeometry compiled=None) except *:
+    """ probability_point_neutron for every k of ks sharing prob_in and prob_detect, adds weight times each to out """
+    cdef:
+        double prob_in, prob_detect, absorb
+
+    absorb = absorbance(source, cache[:2], segments, absorbances, universe_absorption, trace_cache,
+                        None, None, None, compiled)
+    prob_in = exp(-absorb)
+
+    if field is None:
+        prob_detect = probability_detect(cache[:2], absorbances, segments, detector_segments, universe_absorption,
+                                         trace_cache, cache[3:], compiled)
+    else:
+        prob_detect = interpolate_field(cache[0], cache[1], field_bounds, field)
+
+    detect_multiplicities(prob_detect, nu_dist, ks, binomials, weight * prob_in * mu_fission, out)
+
+
 cpdef double probability_segment_neutron_grid(double[:, :, ::1] segments, double[:, ::1] absorbances,
                                               double[:, ::1] fission_segment, double[:, :, ::1] detector_segments,
                                               double universe_absorption, int num_segment_points,
                                               double[::1] source, int k, double[::1] nu_dist,
-                                              double[:, ::1] intersect_cache,
-                                              int[::1] index_cache, double[::1] cache):
+                                              IntersectionCache trace_cache, double[::1] cache,
+                                              double[::1] field_bounds=None, double[:, ::1] field=None,
+                                              CompiledGeometry compiled=None, double[::1] nodes=None,
+                                              double[::1] weights=None) except *:
+    """ Midpoint rule with num_segment_points points, or the quadrature rule nodes, weights on [0, 1] along the
+    segment if given """
     cdef:
-        int i, j
+        int i, j, num_points = num_segment_points
         double prob_ds, segment_probability = 0, segment_length
-        double prob_in, prob_out, absorb, mu_fission
+        double prob_in, prob_out, absorb, mu_fission, weight
         double point_absorbance
 
     segment_length = (fission_segment[0, 0] - fission_segment[1, 0]) * (fission_segment[0, 0] - fission_segment[1, 0])
     segment_length += (fission_segment[0, 1] - fission_segment[1, 1]) * (fission_segment[0, 1] - fission_segment[1, 1])
     segment_length = sqrt(segment_length)
+    if nodes is not None:
+        num_points = nodes.shape[0]
+
+    for i in range(1, num_points + 1):
+        if nodes is None:
+            cache[0] = fission_segment[0, 0] + (i - 0.5) * (fission_segment[1, 0] - fission_segment[0, 0]) / num_segment_points
+            cache[1] = fission_segment[0, 1] + (i - 0.5) * (fission_segment[1, 1] - fission_segment[0, 1]) / num_segment_points
+            weight = segment_length / num_segment_points
+        else:
+            cache[0] = fission_segment[0, 0] + nodes[i - 1] * (fission_segment[1, 0] - fission_segment[0, 0])
+            cache[1] = fission_segment[0, 1] + nodes[i - 1] * (fission_segment[1, 1] - fission_segment[0, 1])
+            weight = weights[i - 1] * segment_length
 
-    for i in range(1, num_segment_points + 1):
-        cache[0] = fission_segment[0, 0] + (i - 0.5) * (fission_segment[1, 0] - fission_segment[0, 0]) / num_segment_points
-        cache[1] = fission_segment[0, 1] + (i - 0.5) * (fission_segment[1, 1] - fission_segment[0, 1]) / num_segment_points
-
-        absorb = absorbance(source, cache[:2], segments, absorbances, universe_absorption, intersect_cache, index_cache)
+        absorb = absorbance(source, cache[:2], segments, absorbances, universe_absorption, trace_cache,
+                            None, None, None, compiled)
         prob_in = exp(-absorb)
 
         mu_fission = absorbance_at_point(cache[0], cache[1], segments, absorbances)
 
-        prob_detect = probability_detect(cache[:2], absorbances, segments, detector_segments, universe_absorption, intersect_cache, index_cache, cache[3:])
+        if field is None:
+            prob_detect = probability_detect(cache[:2], absorbances, segments, detector_segments, universe_absorption,
+                                         trace_cache, cache[3:], compiled)
+        else:
+            prob_detect = interpolate_field(cache[0], cache[1], field_bounds, field)
         prob_out = 0.
         for j in range(np.size(nu_dist)):
             prob_out += binom(j, k) * nu_dist[j] * pow(prob_detect, k) * pow(1. - prob_detect, j - k)
 
-        segment_probability += prob_in * mu_fission * prob_out * segment_length / num_segment_points
+        segment_probability += prob_in * mu_fission * prob_out * weight
 
     return segment_probability
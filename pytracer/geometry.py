@@ -2,6 +2,7 @@ import numpy as np
 from collections import namedtuple
 import matplotlib.pyplot as plt
 from . import geometry_c as geo_c
+from . import transmission_c as trans_c
 
 _array1D_cache = np.empty(300, dtype=np.double)
 
@@ -183,16 +184,25 @@ def create_hollow(outer_segments, inner_segments):
     return np.concatenate((outer_segments, inner_segments))
 
 
-def parallel_beam_paths(height, num_projections, offset, radians, extent=False):
-    scan_line = center(create_vertical_line(height, num_projections))
+def _parallel_scan_line(height, num_projections, offset):
+    scan_line = center(create_vertical_line(height, num_projections)).astype(np.double)
     scan_line[:, 0] += offset
-    start, end = np.zeros((len(scan_line), len(radians), 2)), np.zeros((len(scan_line), len(radians), 2))
+    return scan_line
+
+
+def _parallel_beam_block(scan_line, radians):
+    # scan line rotated by rotation_matrix(radian) for every radian in one broadcast, end mirrors start
+    cos, sin = np.cos(radians), np.sin(radians)
+    start = np.empty((len(scan_line), len(radians), 2), dtype=np.double)
+    start[..., 0] = scan_line[:, 0, None] * cos + scan_line[:, 1, None] * sin
+    start[..., 1] = scan_line[:, 0, None] * -sin + scan_line[:, 1, None] * cos
+    end = np.negative(start[::-1])
+
+    return start, end
+
 
-    for i, radian in enumerate(radians):
-        rot = rotation_matrix(radian)
-        start[:, i, 0] = scan_line[:, 0] * rot[0, 0] + scan_line[:, 1] * rot[0, 1]
-        start[:, i, 1] = scan_line[:, 0] * rot[1, 0] + scan_line[:, 1] * rot[1, 1]
-    end = -start[::-1]
+def parallel_beam_paths(height, num_projections, offset, radians, extent=False):
+    start, end = _parallel_beam_block(_parallel_scan_line(height, num_projections, offset), radians)
 
     if extent:
         return start, end, [radians[0], radians[-1], -height / 2, height / 2]
@@ -200,22 +210,31 @@ def parallel_beam_paths(height, num_projections, offset, radians, extent=False):
         return start, end
 
 
-def fan_beam_paths(diameter, arc_radians, radians, extent=False):
-    start = np.zeros((np.size(arc_radians, 0), np.size(radians, 0), 2))
-    end = np.zeros(start.shape)
+def parallel_beam_path_blocks(height, num_projections, offset, radians, block_size=16):
+    """Lazily yield (angle offset, start, end) of parallel_beam_paths for block_size angles at a time."""
+    scan_line = _parallel_scan_line(height, num_projections, offset)
+    for begin in range(0, len(radians), block_size):
+        yield (begin,) + _parallel_beam_block(scan_line, radians[begin:begin + block_size])
+
+
+def _fan_beam_block(diameter, arc_radians, radians):
+    start = np.empty((np.size(arc_radians, 0), np.size(radians, 0), 2), dtype=np.double)
+    start[..., 0] = np.cos(np.pi - radians) * diameter / 2
+    start[..., 1] = np.sin(np.pi - radians) * diameter / 2
+
+    arc_x = (np.cos(arc_radians) * diameter)[:, None]
+    arc_y = (np.sin(arc_radians) * diameter)[:, None]
+    cos, sin = np.cos(radians), np.sin(radians)
 
-    start[:, :, 0] = (np.cos(np.pi - radians) * diameter / 2)[:np.newaxis]
-    start[:, :, 1] = (np.sin(np.pi - radians) * diameter / 2)[:np.newaxis]
+    end = np.empty(start.shape, dtype=np.double)
+    end[..., 0] = start[..., 0] + arc_x * cos + arc_y * sin
+    end[..., 1] = start[..., 1] - arc_x * sin + arc_y * cos
 
-    arc_points = np.zeros((np.size(arc_radians, 0), 2))
-    arc_points[:, 0] = np.cos(arc_radians) * diameter
-    arc_points[:, 1] = np.sin(arc_radians) * diameter
+    return start, end
 
-    for i, radian in enumerate(radians):
-        end[:, i, 0] = start[:, i, 0] + arc_points[:, 0] * np.cos(radian) + arc_points[:, 1] * np.sin(
-            radian)
-        end[:, i, 1] = start[:, i, 1] - arc_points[:, 0] * np.sin(radian) + arc_points[:, 1] * np.cos(
-            radian)
+
+def fan_beam_paths(diameter, arc_radians, radians, extent=False):
+    start, end = _fan_beam_block(diameter, arc_radians, radians)
 
     if extent:
         return start, end, [radians[0], radians[-1], arc_radians[0], arc_radians[-1]]
@@ -223,9 +242,18 @@ def fan_beam_paths(diameter, arc_radians, radians, extent=False):
         return start, end
 
 
+def fan_beam_path_blocks(diameter, arc_radians, radians, block_size=16):
+    """Lazily yield (angle offset, start, end) of fan_beam_paths for block_size angles at a time."""
+    for begin in range(0, len(radians), block_size):
+        yield (begin,) + _fan_beam_block(diameter, arc_radians, radians[begin:begin + block_size])
+
+
 Material = namedtuple('Material', 'color absorbance fission p')
 Solid = namedtuple('Solid', 'segments in_material out_material')
-FlatGeometry = namedtuple('FlatGeometry', 'segments absorbance fission pfuncrefs pfuncs')
+FlatGeometry = namedtuple('FlatGeometry', 'segments absorbance fission pfuncrefs pfuncs materialrefs materials '
+                                         'solid_bounds solid_ranges')
+BVH = namedtuple('BVH', 'bounds nodes order')
+SegmentGrid = namedtuple('SegmentGrid', 'bounds shape offsets indexes')
 
 
 def draw(solids, show_normals=False, fill=True):
@@ -254,11 +282,22 @@ def flatten(solids):
                              absorbance=np.zeros((num_total_segments, 2)),
                              fission=np.zeros((num_total_segments, 2)),
                              pfuncrefs=np.zeros((num_total_segments, 2), dtype=np.int32),
-                             pfuncs=[None])
+                             pfuncs=[None],
+                             materialrefs=np.zeros((num_total_segments, 2), dtype=np.int32),
+                             materials=[],
+                             solid_bounds=np.zeros((len(solids), 4)),
+                             solid_ranges=np.zeros((len(solids), 2), dtype=np.int32))
 
     index = 0
-    for solid in solids:
+    for n, solid in enumerate(solids):
         solid_slice = slice(index, index + len(solid.segments))
+        # box (xmin, ymin, xmax, ymax) and segment range of every solid, so tracing can skip whole solids
+        flat_geom.solid_ranges[n] = [index, index + len(solid.segments)]
+        if len(solid.segments):
+            flat_geom.solid_bounds[n] = np.concatenate((solid.segments.min(axis=(0, 1)),
+                                                        solid.segments.max(axis=(0, 1))))
+        else:
+            flat_geom.solid_bounds[n] = [np.inf, np.inf, -np.inf, -np.inf]
         flat_geom.segments[solid_slice] = solid.segments
         flat_geom.absorbance[solid_slice] = [solid.in_material.absorbance, solid.out_material.absorbance]
         flat_geom.fission[solid_slice] = [solid.in_material.fission, solid.out_material.fission]
@@ -273,11 +312,157 @@ def flatten(solids):
         flat_geom.pfuncrefs[solid_slice] = [flat_geom.pfuncs.index(solid.in_material.p),
                                             flat_geom.pfuncs.index(solid.out_material.p)]
 
+        # same for the materials themselves
+        for material in (solid.in_material, solid.out_material):
+            if material not in flat_geom.materials:
+                flat_geom.materials.append(material)
+        flat_geom.materialrefs[solid_slice] = [flat_geom.materials.index(solid.in_material),
+                                               flat_geom.materials.index(solid.out_material)]
+
         index += len(solid.segments)
 
     return flat_geom
 
 
+def build_bvh(flat_geom, leaf_size=4):
+    """Builds a bounding volume hierarchy over the segments of a flattened geometry.
+
+    Nodes are stored depth first, the left child of node i is node i + 1. For leaves nodes[i] holds
+    (offset, count) into order, for internal nodes (right child index, -1). Bounds are (xmin, ymin, xmax, ymax).
+    """
+    segments = flat_geom.segments
+    num_segments = np.size(segments, 0)
+
+    lower = np.min(segments, axis=1)
+    upper = np.max(segments, axis=1)
+    centers = (lower + upper) / 2
+
+    # pad boxes so rounding in the slab test never rejects a crossing on a box edge
+    pad = 1e-9 * max(np.max(np.abs(segments)) if num_segments else 0., 1.)
+    lower -= pad
+    upper += pad
+
+    order = np.arange(num_segments, dtype=np.int32)
+    bounds = []
+    nodes = []
+
+    def build(first, last):
+        index = len(nodes)
+        node_order = order[first:last]
+        if last == first:
+            bounds.append(np.zeros(4))
+        else:
+            bounds.append(np.concatenate((lower[node_order].min(axis=0), upper[node_order].max(axis=0))))
+        nodes.append([first, last - first])
+        if last - first <= leaf_size:
+            return index
+
+        # median split along the longest axis of the segment centers
+        axis = np.argmax(np.ptp(centers[node_order], axis=0))
+        middle = (first + last) // 2
+        order[first:last] = node_order[np.argpartition(centers[node_order, axis], middle - first)]
+
+        build(first, middle)
+        nodes[index] = [build(middle, last), -1]
+        return index
+
+    build(0, num_segments)
+
+    return BVH(bounds=np.ascontiguousarray(bounds, dtype=np.double),
+               nodes=np.ascontiguousarray(nodes, dtype=np.int32), order=order)
+
+
+def build_segment_grid(flat_geom, segments_per_cell=2):
+    """Bins the segments of a flattened geometry into a uniform grid for nearest segment lookups.
+
+    Every segment is listed in each cell its bounding box overlaps, indexes[offsets[c]:offsets[c + 1]] are the
+    segments of cell c = iy * nx + ix. Bounds are (xmin, ymin, xmax, ymax), shape is (nx, ny).
+    """
+    segments = flat_geom.segments
+    num_segments = np.size(segments, 0)
+
+    lower = np.min(segments, axis=1)
+    upper = np.max(segments, axis=1)
+    if num_segments > 0:
+        bounds = np.concatenate((lower.min(axis=0), upper.max(axis=0)))
+    else:
+        bounds = np.array([0., 0., 1., 1.])
+
+    width, height = bounds[2] - bounds[0], bounds[3] - bounds[1]
+    num_cells = max(num_segments / segments_per_cell, 1)
+    if width > 0 and height > 0:
+        cell_size = np.sqrt(width * height / num_cells)
+    else:
+        cell_size = max(width, height, 1.) / num_cells
+
+    shape = np.array([max(int(np.ceil(width / cell_size)), 1), max(int(np.ceil(height / cell_size)), 1)],
+                     dtype=np.int32)
+    bounds[2] = bounds[0] + shape[0] * cell_size
+    bounds[3] = bounds[1] + shape[1] * cell_size
+
+    # range of cells covered by each segment bounding box
+    ix = np.clip(((np.stack((lower[:, 0], upper[:, 0])) - bounds[0]) / cell_size).astype(np.int32), 0, shape[0] - 1)
+    iy = np.clip(((np.stack((lower[:, 1], upper[:, 1])) - bounds[1]) / cell_size).astype(np.int32), 0, shape[1] - 1)
+    count_x = ix[1] - ix[0] + 1
+    counts = count_x * (iy[1] - iy[0] + 1)
+
+    segment_ids = np.repeat(np.arange(num_segments, dtype=np.int32), counts)
+    local = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cells = (iy[0, segment_ids] + local // count_x[segment_ids]) * shape[0] + \
+        ix[0, segment_ids] + local % count_x[segment_ids]
+
+    order = np.argsort(cells, kind='stable')
+    offsets = np.zeros(shape[0] * shape[1] + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength=shape[0] * shape[1]))
+
+    return SegmentGrid(bounds=bounds, shape=shape, offsets=offsets,
+                       indexes=np.ascontiguousarray(segment_ids[order], dtype=np.int32))
+
+
+def compile_geometry(flat_geom, dtype=np.double):
+    """Structure of arrays layout of a flattened geometry for the tracing kernels, see transmission_c.CompiledGeometry.
+
+    Segment i starts at (x0[i], y0[i]) with direction (dx[i], dy[i]), bounds are its (xmin, ymin, xmax, ymax) box and
+    materials its (inside, outside) flat_geom.materialrefs. dtype=np.float32
+    halves the coordinate memory the crossing tests stream through, at single precision crossings. Solid boxes
+    enclose the segment boxes of flat_geom.solid_ranges.
+
+    The result is a snapshot of flat_geom, segments and absorbances included. Compile again after changing the
+    geometry, the kernels only check that the segment counts match and the scans that the absorbances do.
+    """
+    segments = flat_geom.segments
+    dtype = np.dtype(dtype)
+
+    # directions from the rounded end points, so segments sharing a vertex still meet after rounding to float32
+    points = segments.astype(dtype)
+    x0 = np.ascontiguousarray(points[:, 0, 0])
+    y0 = np.ascontiguousarray(points[:, 0, 1])
+    dx = np.ascontiguousarray(points[:, 1, 0] - points[:, 0, 0])
+    dy = np.ascontiguousarray(points[:, 1, 1] - points[:, 0, 1])
+
+    # boxes of the stored segments, padded and rounded outward so the box test never rejects a crossing
+    x1, y1 = x0.astype(np.double) + dx, y0.astype(np.double) + dy
+    pad = 1e-9 * max(np.max(np.abs(segments)) if len(segments) else 0., 1.)
+    lower = np.stack((np.minimum(x0, x1), np.minimum(y0, y1)), axis=1) - pad
+    upper = np.stack((np.maximum(x0, x1), np.maximum(y0, y1)), axis=1) + pad
+    bounds = np.concatenate((np.nextafter(lower.astype(dtype), dtype.type(-np.inf)),
+                             np.nextafter(upper.astype(dtype), dtype.type(np.inf))), axis=1)
+
+    solid_bounds = np.empty((len(flat_geom.solid_ranges), 4))
+    for n, (first, last) in enumerate(flat_geom.solid_ranges):
+        if last > first:
+            solid_bounds[n, :2] = bounds[first:last, :2].min(axis=0)
+            solid_bounds[n, 2:] = bounds[first:last, 2:].max(axis=0)
+        else:
+            solid_bounds[n] = [np.inf, np.inf, -np.inf, -np.inf]
+
+    return trans_c.CompiledGeometry(x0, y0, dx, dy, np.ascontiguousarray(bounds),
+                                    np.ascontiguousarray(flat_geom.materialrefs, dtype=np.int32),
+                                    np.array([material.absorbance for material in flat_geom.materials],
+                                             dtype=np.double), solid_bounds,
+                                    np.ascontiguousarray(flat_geom.solid_ranges, dtype=np.int32))
+
+
 class Grid(object):
     def __init__(self, width, height, num_x, num_y):
         xs = np.linspace(-width / 2, width / 2, num_x + 1)
@@ -297,6 +482,10 @@ class Grid(object):
     def num_cells(self):
         return self.num_x * self.num_y
 
+    @property
+    def extent(self):
+        return [self.points[0, 0, 0], self.points[0, -1, 0], self.points[-1, 0, 1], self.points[0, 0, 1]]
+
     def cell(self, i):
         if i > self.num_cells - 1:
             raise IndexError
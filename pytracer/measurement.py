@@ -1,3 +1,10 @@
+import contextlib
+import functools
+import hashlib
+import os
+import types
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 
 from . import transmission as trans
@@ -5,25 +12,303 @@ from . import geometry as geo
 from . import fission
 
 
-def transmission_scan(flat_geom, start, end):
+def transmission_scan(flat_geom, start, end, bvh=None, num_threads=1, compiled=None):
+    num_threads = trans._num_threads(num_threads)
     absorb = np.zeros((start.shape[:-1]), dtype=np.double)
     flat_start = start.reshape(-1, start.shape[-1])
     flat_end = end.reshape(-1, end.shape[-1])
 
-    trans.absorbances(flat_start, flat_end, flat_geom.segments, flat_geom.absorbance, 0, absorbance_cache=absorb.ravel())
+    trans.absorbances(flat_start, flat_end, flat_geom.segments, flat_geom.absorbance, 0,
+                      absorbance_cache=absorb.ravel(), bvh=bvh, num_threads=num_threads, compiled=compiled)
 
     return absorb
 
 
-# TODO Cython
-def fission_scan(source, neutron_paths, detector_points, flat_geom, k, matrix, p_range):
-    probs = np.zeros((np.size(source, 0), np.size(neutron_paths, 0)), dtype=np.double)
+def material_transmission_scan(response, shape, absorbances, universe_absorbance=0.0):
+    """transmission_scan of the rays of a response.transmission_material_response for new material absorbances.
+
+    absorbances holds one value per flat_geom.materials, or an (materials, K) array of K parameter sets giving K
+    scans stacked along the last axis.
+    """
+    absorbances = np.asarray(absorbances, dtype=np.double)
+    universe = np.broadcast_to(universe_absorbance, absorbances.shape[1:])
+    weights = np.concatenate((absorbances, universe[np.newaxis]))
+
+    return (response @ weights).reshape(tuple(shape) + absorbances.shape[1:])
+
+
+def _done_path(path):
+    return os.path.splitext(path)[0] + '.done.npy'
+
+
+def _key_path(path):
+    return os.path.splitext(path)[0] + '.key'
+
+
+def _update_key(key, value):
+    if isinstance(value, np.ndarray):
+        key.update(f'{value.dtype.str} {value.shape}'.encode())
+        key.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        key.update(f'{type(value).__name__} {len(value)}'.encode())
+        for item in value:
+            _update_key(key, item)
+    elif isinstance(value, types.CodeType):
+        key.update(value.co_code)
+        _update_key(key, value.co_consts)
+        _update_key(key, value.co_names)
+    elif isinstance(value, functools.partial):
+        _update_key(key, [value.func, value.args, sorted(value.keywords.items())])
+    elif callable(value):
+        name = getattr(value, '__qualname__', type(value).__qualname__)
+        key.update(f'{getattr(value, "__module__", None)}.{name}'.encode())
+        # lambdas share a qualname, so functions are also told apart by their code, defaults and closure contents
+        if hasattr(value, '__code__'):
+            _update_key(key, value.__code__)
+            _update_key(key, value.__defaults__)
+            _update_key(key, [cell.cell_contents for cell in value.__closure__ or ()])
+    else:
+        key.update(repr(value).encode())
+    key.update(b'|')
+
+
+def scan_key(*inputs):
+    """Hash identifying a scan by the inputs it was computed from, arrays by content and functions by name and code.
+
+    Module globals a function reads are not part of its key, a scan of a function whose globals changed needs a new
+    path.
+    """
+    key = hashlib.sha256()
+    for value in inputs:
+        _update_key(key, value)
+    return key.hexdigest()
+
+
+def open_scan(path, shape, key=None):
+    """Open the on-disk scan at path (an .npy file) for writing, creating it if missing.
+
+    Returns (values, done), both np.memmap of shape, done flags the entries already written by an earlier or running
+    scan so an interrupted scan resumes where it stopped. key, see scan_key, is stored next to the scan and a scan
+    stored under a different key is started over instead of resumed.
+    """
+    shape = tuple(shape)
+    done_path, key_path = _done_path(path), _key_path(path)
+    stored_key = None
+    if key is not None and os.path.exists(key_path):
+        with open(key_path) as f:
+            stored_key = f.read().strip()
+
+    if os.path.exists(path) and os.path.exists(done_path) and stored_key == key:
+        values = np.lib.format.open_memmap(path, mode='r+')
+        done = np.lib.format.open_memmap(done_path, mode='r+')
+        if values.shape != shape or done.shape != shape:
+            raise ValueError(f'scan {path} has shape {values.shape}, expected {shape}')
+    else:
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        values = np.lib.format.open_memmap(path, mode='w+', dtype=np.double, shape=shape)
+        done = np.lib.format.open_memmap(done_path, mode='w+', dtype=np.bool_, shape=shape)
+        # written last, a scan interrupted while being created has no key and is started over
+        if key is not None:
+            with open(key_path, 'w') as f:
+                f.write(key)
+
+    return values, done
+
+
+def read_scan(path):
+    """Read only view (values, done) of a scan, safe to call while the scan is still being written."""
+    return np.load(path, mmap_mode='r'), np.load(_done_path(path), mmap_mode='r')
+
+
+def _stream_blocks(values, done, blocks, scan_block, progress):
+    """Fill values[block] = scan_block(block) for every block (an index) not yet marked done."""
+    for n, block in enumerate(blocks, 1):
+        if not done[block].all():
+            values[block] = scan_block(block)
+            # values reach the disk before they are marked done, a crash never leaves a stale block marked done
+            values.flush()
+            done[block] = True
+            done.flush()
+        if progress is not None:
+            progress(n, len(blocks))
+
+
+def stream_transmission_scan(path, flat_geom, start, end, block_size=65536, bvh=None, num_threads=1,
+                             progress=None, compiled=None):
+    """transmission_scan written block_size rays at a time into the on-disk scan at path, see open_scan."""
+    num_threads = trans._num_threads(num_threads)
+    trans._check_compiled(compiled, flat_geom.absorbance)
+    key = scan_key('transmission', flat_geom.segments, flat_geom.absorbance, start, end,
+                   None if compiled is None else (compiled.single, compiled.absorbance, compiled.materials))
+    values, done = open_scan(path, start.shape[:-1], key)
+    flat_start = start.reshape(-1, start.shape[-1])
+    flat_end = end.reshape(-1, end.shape[-1])
+
+    def scan_block(block):
+        return trans.absorbances(np.ascontiguousarray(flat_start[block], dtype=np.double),
+                                 np.ascontiguousarray(flat_end[block], dtype=np.double),
+                                 flat_geom.segments, flat_geom.absorbance, 0, bvh=bvh, num_threads=num_threads,
+                                 compiled=compiled)
+
+    blocks = [slice(b, b + block_size) for b in range(0, len(flat_start), block_size)]
+    _stream_blocks(values.reshape(-1), done.reshape(-1), blocks, scan_block, progress)
+    return values
+
+
+def print_progress(done, total):
+    print(f'\r  {done} / {total}', end='' if done < total else '\n', flush=True)
+
+
+def _fission_scan_source(i, source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, probs,
+                         detector_field_shape=None, compiled=None, tolerance=None):
+    detector_segments = geo.convert_points_to_segments(detector_points[:, i])
+    field = None
+    if detector_field_shape is not None:
+        field = fission.detector_field(flat_geom, detector_segments, detector_field_shape, compiled=compiled)
+
+    for j in range(np.size(neutron_paths, 0)):
+        probs[..., i, j] = fission.probability_path_neutron(source[i], neutron_paths[j, i], flat_geom,
+                                                            detector_segments, k, matrix, p_range, field, compiled,
+                                                            tolerance)
+
+
+# state of a fission scan worker process, arrays live in shared memory blocks owned by the parent
+_worker_state = {}
+
+
+def _init_fission_worker(specs, geom_fields, k, detector_field_shape, compiled, tolerance):
+    arrays = {}
+    blocks = []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    for name in geo.FlatGeometry._fields:
+        if 'geom_' + name in arrays:
+            geom_fields[name] = arrays['geom_' + name]
+
+    _worker_state.update(blocks=blocks, arrays=arrays, flat_geom=geo.FlatGeometry(**geom_fields), k=k,
+                         detector_field_shape=detector_field_shape, compiled=compiled, tolerance=tolerance)
+
+
+def _fission_scan_worker(i):
+    arrays = _worker_state['arrays']
+    _fission_scan_source(i, arrays['source'], arrays['neutron_paths'], arrays['detector_points'],
+                         _worker_state['flat_geom'], _worker_state['k'], arrays['matrix'], arrays['p_range'],
+                         arrays['probs'], _worker_state['detector_field_shape'], _worker_state['compiled'],
+                         _worker_state['tolerance'])
+    return i
+
+
+@contextlib.contextmanager
+def _fission_pool(source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, num_workers,
+                  detector_field_shape, compiled, tolerance):
+    """Process pool sharing the scan inputs and results through shared memory for as long as the context is open.
+
+    Yields scan_sources(sources, progress=None) returning the probabilities of the sources slice, so a streamed scan
+    starts the workers and copies the geometry once rather than once per block.
+    """
+    probs_shape = np.shape(k) + (np.size(source, 0), np.size(neutron_paths, 0))
+    arrays = dict(source=source, neutron_paths=neutron_paths, detector_points=detector_points, matrix=matrix,
+                  p_range=p_range, probs=np.zeros(probs_shape, dtype=np.double))
+    # geometry arrays are shared, anything else (pfuncs) is pickled to the workers once
+    geom_fields = {}
+    for name, value in flat_geom._asdict().items():
+        if isinstance(value, np.ndarray):
+            arrays['geom_' + name] = value
+        else:
+            geom_fields[name] = value
+
+    blocks = {}
+    specs = {}
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks[name] = block
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs[name] = (block.name, array.shape, array.dtype.str)
+
+        with ProcessPoolExecutor(num_workers, initializer=_init_fission_worker,
+                                 initargs=(specs, geom_fields, k, detector_field_shape, compiled,
+                                           tolerance)) as pool:
+            def scan_sources(sources, progress=None):
+                indices = range(probs_shape[-2])[sources]
+                for done, _ in enumerate(pool.map(_fission_scan_worker, indices), 1):
+                    if progress is not None:
+                        progress(done, len(indices))
+                probs = np.ndarray(probs_shape, dtype=np.double, buffer=blocks['probs'].buf)
+                return probs[..., sources, :].copy()
+
+            yield scan_sources
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+
+def fission_scan(source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, num_workers=1,
+                 progress=None, detector_field_shape=None, compiled=None, tolerance=None):
+    """Fission detection probability of every neutron path of every source.
+
+    num_workers > 1 splits sources over a process pool sharing the geometry through shared memory, None uses every
+    core. pfuncs must then be picklable. progress(done, total) is called as sources finish, see print_progress.
+    detector_field_shape, e.g. (64, 64), interpolates detection probabilities from a cached fission.detector_field
+    per source instead of tracing every point to every detector. compiled is a geometry.compile_geometry of flat_geom.
+    tolerance integrates fission segments adaptively, see fission.probability_path_neutron_adaptive.
+    k may be a sequence of multiplicities, e.g. [1, 2] for singles and doubles, computed together from one trace of
+    every point and returned as a (len(k), sources, paths) array.
+    """
+    trans._check_compiled(compiled, flat_geom.absorbance)
+    probs = np.zeros(np.shape(k) + (np.size(source, 0), np.size(neutron_paths, 0)), dtype=np.double)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    if num_workers > 1:
+        with _fission_pool(source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, num_workers,
+                           detector_field_shape, compiled, tolerance) as scan_sources:
+            probs[...] = scan_sources(slice(None), progress)
+        return probs
+
     for i in range(np.size(source, 0)):
-        print(f'\r  {i} / {np.size(source, 0)-1}', end='', flush=True)
-        detector_segments = geo.convert_points_to_segments(detector_points[:, i])
-        for j in range(np.size(neutron_paths, 0)):
-            probs[i, j] = fission.probability_path_neutron(source[i], neutron_paths[j, i], flat_geom, detector_segments,
-                                                           k, matrix, p_range)
-    print()
+        _fission_scan_source(i, source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, probs,
+                             detector_field_shape, compiled, tolerance)
+        if progress is not None:
+            progress(i + 1, np.size(source, 0))
 
     return probs
+
+
+def stream_fission_scan(path, source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, block_size=None,
+                        num_workers=1, progress=None, detector_field_shape=None, compiled=None, tolerance=None):
+    """fission_scan written block_size sources at a time into the on-disk scan at path, see open_scan.
+
+    One process pool serves every block, block_size defaults to 8 sources per worker.
+    """
+    num_sources, num_paths = np.size(source, 0), np.size(neutron_paths, 0)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if block_size is None:
+        block_size = 8 * num_workers
+    trans._check_compiled(compiled, flat_geom.absorbance)
+    key = scan_key('fission', source, neutron_paths, detector_points, flat_geom, k, matrix, p_range,
+                   detector_field_shape, None if compiled is None else (compiled.single, compiled.absorbance,
+                                                                        compiled.materials), tolerance)
+    values, done = open_scan(path, np.shape(k) + (num_sources, num_paths), key)
+    blocks = [(Ellipsis, slice(b, b + block_size), slice(None)) for b in range(0, num_sources, block_size)]
+
+    if num_workers > 1 and not done.all():
+        with _fission_pool(source, neutron_paths, detector_points, flat_geom, k, matrix, p_range, num_workers,
+                           detector_field_shape, compiled, tolerance) as scan_sources:
+            _stream_blocks(values, done, blocks, lambda block: scan_sources(block[1]), progress)
+        return values
+
+    def scan_block(block):
+        sources = block[1]
+        return fission_scan(source[sources], neutron_paths[:, sources], detector_points[:, sources], flat_geom, k,
+                            matrix, p_range, 1, None, detector_field_shape, compiled, tolerance)
+
+    _stream_blocks(values, done, blocks, scan_block, progress)
+    return values
@@ -2,10 +2,14 @@
 Fix the p_range size issue with the matrix,
 """
 
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import mpmath as mp
-import os
 from . import neutron_chain_c as nchain_c
+from . import transmission
 
 # Nuclear Data
 nu_u235_induced = \
@@ -103,26 +107,183 @@ def ndist_noonan_deriv(p, nudist, max_n, dps=None, delta=0.001):
     return ns
 
 
-def generate_p_matrix(nu_dist, max_n=100, p_range=100, deriv=False):
+def _noonan_fft(p, nudist, max_n, deriv=False):
+    """Noonan distribution from FFT samples of its generating function on a circle
+
+    The generating function H(x) of the number of neutrons escaping the chain solves H = (1 - p) x + p G(H), with G the
+    generating function of nudist. H is found by Newton's method at every sample point, H(0) is calc_h0. For deriv the
+    samples are dH/dp = (G(H) - x) / (1 - p G'(H)). Sampling inside the unit circle keeps the samples away from the
+    branch point at x = 1 when p is critical, the radius and sample count bound aliasing to ~1e-16 and roundoff to
+    ~1e-13.
+    """
+    num_samples = 1 << int(np.ceil(np.log2(8 * (max_n + 1))))
+    radius = 10 ** (-3 / max(max_n, 1))
+    x = radius * np.exp(2j * np.pi * np.arange(num_samples) / num_samples)
+
+    nudist_deriv = np.polynomial.polynomial.polyder(nudist)
+    h = np.full(num_samples, calc_h0(nudist, p), dtype=np.complex128)
+    for _ in range(100):
+        step = (h - (1 - p) * x - p * np.polynomial.polynomial.polyval(h, nudist)) / \
+               (1 - p * np.polynomial.polynomial.polyval(h, nudist_deriv))
+        h -= step
+        if np.max(np.abs(step)) < 1e-15:
+            break
+
+    if deriv:
+        h = (np.polynomial.polynomial.polyval(h, nudist) - x) / \
+            (1 - p * np.polynomial.polynomial.polyval(h, nudist_deriv))
+
+    return np.fft.fft(h)[:max_n + 1].real / num_samples / radius ** np.arange(max_n + 1)
+
+
+def ndist_noonan_fft(p, nudist, max_n):
+    ns = np.zeros(max_n + 1)
+    if p <= 0.0:
+        ns[0] = 1
+        return ns
+
+    return _noonan_fft(p, nudist, max_n)
+
+
+def ndist_noonan_deriv_fft(p, nudist, max_n):
+    ns = np.zeros(max_n + 1)
+    if p <= 0.0:
+        ns[0] = 1
+        return ns
+
+    ns = _noonan_fft(p, nudist, max_n, deriv=True)
+    # calc_term_noonan_deriv integrates (1 - p) times the p-derivative of the n > 0 terms, keep the same scale
+    ns[1:] *= 1 - p
+    return ns
+
+
+def _p_range(nu_dist, p_range):
     if type(p_range) is int:
         crit_value = critical_p(nu_dist)
         p_range = np.linspace(0, crit_value, p_range)
+    return np.asarray(p_range, dtype=np.double)
+
+
+def _p_matrix_row(i, p, nu_dist, max_n, deriv, method):
+    if method == 'fft':
+        row = ndist_noonan_deriv_fft(p, nu_dist, max_n) if deriv else ndist_noonan_fft(p, nu_dist, max_n)
+    else:
+        row = ndist_noonan_deriv(p, nu_dist, max_n) if deriv else ndist_noonan(p, nu_dist, max_n)
+    return i, row
+
 
+def _p_matrix_rows(rows, p_range, nu_dist, max_n, deriv, method, num_workers):
+    """Yield (i, row) for every row index as it is computed, in a process pool if num_workers != 1."""
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    if num_workers == 1:
+        for i in rows:
+            yield _p_matrix_row(i, p_range[i], nu_dist, max_n, deriv, method)
+        return
+
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = [pool.submit(_p_matrix_row, i, p_range[i], nu_dist, max_n, deriv, method) for i in rows]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # an interrupted run should not wait on rows nobody will store
+            for future in futures:
+                future.cancel()
+
+
+def generate_p_matrix(nu_dist, max_n=100, p_range=100, deriv=False, method='fft', num_workers=1, progress=None):
+    """Noonan distribution (or its p-derivative) for each p in p_range, method is 'fft' or the 'mpmath' reference.
+
+    num_workers != 1 computes rows in a process pool (None for every core), progress(done, total) is called per row.
+    """
+    if method not in ('fft', 'mpmath'):
+        raise ValueError(f'unknown method {method}')
+
+    p_range = _p_range(nu_dist, p_range)
     n_p = len(p_range)
     matrix = np.zeros((n_p, max_n + 1))
 
-    for i in range(n_p):
-        p = p_range[i]
-        print(f'\r  {i} / {n_p-1}', end='', flush=True)
-        if deriv:
-            matrix[i] = ndist_noonan_deriv(p, nu_dist, max_n)
-        else:
-            matrix[i] = ndist_noonan(p, nu_dist, max_n)
-    print()
+    rows = _p_matrix_rows(range(n_p), p_range, nu_dist, max_n, deriv, method, num_workers)
+    for done, (i, row) in enumerate(rows, 1):
+        matrix[i] = row
+        if progress is not None:
+            progress(done, n_p)
+
+    return matrix, p_range
+
+
+def p_matrix_key(nu_dist, max_n=100, p_range=100, deriv=False, method='fft'):
+    """Hash identifying a p matrix by the nuclear data and parameters it was generated from."""
+    key = hashlib.sha256()
+    key.update(np.ascontiguousarray(nu_dist, dtype=np.double).tobytes())
+    key.update(_p_range(nu_dist, p_range).tobytes())
+    key.update(f'{max_n} {bool(deriv)} {method}'.encode())
+    return key.hexdigest()
+
+
+def _save_npz(path, **arrays):
+    # write then rename so an interrupted save never leaves a truncated file behind
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def cached_p_matrix(directory, nu_dist, max_n=100, p_range=100, deriv=False, method='fft', num_workers=1,
+                    progress=None):
+    """generate_p_matrix stored in directory under p_matrix_key.
+
+    Finished rows are checkpointed to a .partial.npz file as they complete, so an interrupted run resumes where it
+    stopped. A finished matrix is loaded straight from disk.
+    """
+    if method not in ('fft', 'mpmath'):
+        raise ValueError(f'unknown method {method}')
+
+    p_range = _p_range(nu_dist, p_range)
+    key = p_matrix_key(nu_dist, max_n, p_range, deriv, method)
+    path = os.path.join(directory, f'p_matrix_{key[:16]}.npz')
+    partial_path = os.path.join(directory, f'p_matrix_{key[:16]}.partial.npz')
+
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            if str(stored['key']) == key:
+                return stored['matrix'], stored['p_range']
+
+    n_p = len(p_range)
+    matrix = np.zeros((n_p, max_n + 1))
+    done = np.zeros(n_p, dtype=bool)
+    if os.path.exists(partial_path):
+        with np.load(partial_path) as stored:
+            if str(stored['key']) == key:
+                matrix[:] = stored['matrix']
+                done[:] = stored['done']
+
+    os.makedirs(directory, exist_ok=True)
+    rows = _p_matrix_rows(np.flatnonzero(~done), p_range, nu_dist, max_n, deriv, method, num_workers)
+    for i, row in rows:
+        matrix[i] = row
+        done[i] = True
+        _save_npz(partial_path, key=key, matrix=matrix, done=done)
+        if progress is not None:
+            progress(np.count_nonzero(done), n_p)
+
+    _save_npz(path, key=key, matrix=matrix, p_range=p_range)
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
 
     return matrix, p_range
 
 
+def noonan_fft_deviation(nu_dist, max_n=100, p_range=100, deriv=False):
+    """Maximum absolute deviation of the fft p matrix from the mpmath reference, returned with both matrices."""
+    fft_matrix, p_range = generate_p_matrix(nu_dist, max_n, p_range, deriv, method='fft')
+    mpmath_matrix, _ = generate_p_matrix(nu_dist, max_n, p_range, deriv, method='mpmath')
+
+    return np.max(np.abs(fft_matrix - mpmath_matrix)), fft_matrix, mpmath_matrix
+
+
 def interpolate_p(matrix, p_value, p_range, method='linear', log_interpolate=False):
     if method == 'linear':
         low_index = int(np.digitize(p_value, p_range)) - 1
@@ -141,18 +302,42 @@ def interpolate_p(matrix, p_value, p_range, method='linear', log_interpolate=Fal
             return matrix[low_index] + (matrix[high_index] - matrix[low_index]) * t
 
 
-def pfuncref_image(xs, ys, flat_geom):
-    image = np.zeros((np.size(xs, 0), np.size(ys, 0)), dtype=np.int)
+def interpolate_p_batch(matrix, p_values, p_range, out=None, log_interpolate=False):
+    """interpolate_p for an array of p values, row i of the (len(p_values), max_n + 1) result is at p_values[i]."""
+    p_values = np.ascontiguousarray(p_values, dtype=np.double).reshape(-1)
+    p_range = np.ascontiguousarray(p_range, dtype=np.double)
+    if out is None:
+        out = np.empty((len(p_values), np.size(matrix, 1)), dtype=np.double)
+    elif out.shape != (len(p_values), np.size(matrix, 1)) or out.dtype != np.double or not out.flags.c_contiguous:
+        raise ValueError(f'out must be a C-contiguous float64 array of shape {(len(p_values), np.size(matrix, 1))}, '
+                         f'got {out.dtype} {out.shape}')
+
+    steps = np.diff(p_range)
+    uniform = np.allclose(steps, steps[0], rtol=1e-12, atol=0)
+    nchain_c.interpolate_p_batch(np.ascontiguousarray(matrix, dtype=np.double), p_values, p_range, out,
+                                 log_interpolate, uniform)
+    return out
+
+
+def pfuncref_image(xs, ys, flat_geom, grid=None, scanline=False, bvh=None):
+    image = np.zeros((np.size(xs, 0), np.size(ys, 0)), dtype=np.int32)
     extent = [xs[0], xs[-1], ys[0], ys[-1]]
 
-    nchain_c.pfuncref_image(image, xs, ys, flat_geom.segments, flat_geom.pfuncrefs)
+    if scanline:
+        transmission._check_scanline(xs)
+        nchain_c.pfuncref_image_scanline(image, xs, ys, flat_geom.segments, flat_geom.pfuncrefs,
+                                         *transmission._bvh_arrays(bvh), *transmission._grid_arrays(grid))
+    else:
+        nchain_c.pfuncref_image(image, xs, ys, flat_geom.segments, flat_geom.pfuncrefs,
+                                *transmission._grid_arrays(grid))
 
     # not sure why I need to transpose it
     return image.T, extent
 
 
-def p_at_point(point, flat_geom):
-    pfuncref_out = nchain_c.pfuncref_at_point(point[0], point[1], flat_geom.segments, flat_geom.pfuncrefs)
+def p_at_point(point, flat_geom, grid=None):
+    pfuncref_out = nchain_c.pfuncref_at_point(point[0], point[1], flat_geom.segments, flat_geom.pfuncrefs,
+                                              *transmission._grid_arrays(grid))
     pfunc = flat_geom.pfuncs[pfuncref_out]
     if pfunc is not None:
         return float(pfunc(point[0], point[1]))
@@ -160,8 +345,8 @@ def p_at_point(point, flat_geom):
         return 0.0
 
 
-def p_image(xs, ys, flat_geom):
-    pfuncref_im, extent = pfuncref_image(xs, ys, flat_geom)
+def p_image(xs, ys, flat_geom, grid=None, scanline=False, bvh=None):
+    pfuncref_im, extent = pfuncref_image(xs, ys, flat_geom, grid, scanline, bvh)
     p_im = np.zeros(pfuncref_im.shape)
     for i in range(len(flat_geom.pfuncs)):
         mask = pfuncref_im == i
@@ -3,19 +3,11 @@ import numpy as np
 
 cimport numpy as np
 from cython cimport cdivision, boundscheck, wraparound
-from libc.math cimport sqrt, acos, fabs, M_PI, exp, pow
+from libc.math cimport sqrt, acos, fabs, M_PI, exp, pow, log10, floor
+from libc.stdlib cimport malloc, free
+from pytracer.transmission_c cimport c_nearest_segment, c_scanline_row, Crossing
 
 
-cdef inline double distance(double x1, double y1, double x2, double y2):
-    cdef:
-        double tmp = 0
-
-    tmp = (x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2)
-    return sqrt(tmp)
-
-cdef inline double sign_line(double x, double y, double x1, double y1, double x2, double y2):
-    return (x - x1) * (y1 - y2) + (y - y1) * (x2 - x1)
-
 @cdivision(True)
 cpdef point_segment_distance(double px, double py, double x0, double x1, double y0, double y1):
     cdef:
@@ -40,38 +32,126 @@ cpdef point_segment_distance(double px, double py, double x0, double x1, double
     return distance
 
 
-@cdivision(True)
-@boundscheck(False)
-cpdef int pfuncref_at_point(double point_x, double point_y, double[:, :, ::1] segments, int[:, ::1] pfuncrefs):
+cpdef int pfuncref_at_point(double point_x, double point_y, double[:, :, ::1] segments, int[:, ::1] pfuncrefs,
+                            double[::1] grid_bounds=None, int[::1] grid_shape=None, int[::1] grid_offsets=None,
+                            int[::1] grid_indexes=None):
     """ Based on looking at segment with smallest distance """
+    return c_pfuncref_at_point(point_x, point_y, segments, pfuncrefs, grid_bounds, grid_shape, grid_offsets,
+                               grid_indexes, grid_bounds is not None)
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_pfuncref_at_point(double point_x, double point_y, double[:, :, ::1] segments, int[:, ::1] pfuncrefs,
+                             double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets,
+                             int[::1] grid_indexes, bint use_grid) nogil:
     cdef:
-        double min_distance = 1.0e19
-        double distance = 2.0e19
         double is_outer
-        int pfuncref_out, pfuncref_in
-        int pfuncref_point = -1
-
-    for i in range(segments.shape[0]):
-        distance = point_segment_distance(point_x, point_y, segments[i, 0, 0], segments[i, 1, 0],
-                                          segments[i, 0, 1], segments[i, 1, 1])
-        if distance < min_distance:
-            min_distance = distance
-            is_outer = sign_line(point_x, point_y, segments[i, 0, 0], segments[i, 0, 1],
-                                 segments[i, 1, 0], segments[i, 1, 1])
-
-            if is_outer > 0:
-                pfuncref_point = pfuncrefs[i, 1]
-            else:
-                pfuncref_point = pfuncrefs[i, 0]
+        int i
 
-    return pfuncref_point
+    i = c_nearest_segment(point_x, point_y, segments, grid_bounds, grid_shape, grid_offsets, grid_indexes,
+                          use_grid, &is_outer)
+    return side_pfuncref(pfuncrefs, i, is_outer)
 
 
-@cdivision(True)
-# @boundscheck(False)
+cdef inline int side_pfuncref(int[:, ::1] pfuncrefs, int i, double is_outer) nogil:
+    if i < 0:
+        return -1
+    if is_outer > 0:
+        return pfuncrefs[i, 1]
+    return pfuncrefs[i, 0]
+
+
+@boundscheck(False)
+@wraparound(False)
 cpdef void pfuncref_image(int[:, ::1] image, double[::1] xs, double[::1] ys,
-                     double[:, :, ::1] segments, int[:, ::1] pfuncrefs):
+                          double[:, :, ::1] segments, int[:, ::1] pfuncrefs, double[::1] grid_bounds=None,
+                          int[::1] grid_shape=None, int[::1] grid_offsets=None, int[::1] grid_indexes=None):
+    cdef:
+        int i, j
+        bint use_grid = grid_bounds is not None
 
     for i in range(xs.shape[0]):
         for j in range(ys.shape[0]):
-            image[i, j] = pfuncref_at_point(xs[i], ys[j], segments, pfuncrefs)
+            image[i, j] = c_pfuncref_at_point(xs[i], ys[j], segments, pfuncrefs, grid_bounds, grid_shape,
+                                              grid_offsets, grid_indexes, use_grid)
+
+
+@boundscheck(False)
+@wraparound(False)
+cpdef void pfuncref_image_scanline(int[:, ::1] image, double[::1] xs, double[::1] ys,
+                                   double[:, :, ::1] segments, int[:, ::1] pfuncrefs,
+                                   double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None,
+                                   int[::1] bvh_order=None, double[::1] grid_bounds=None,
+                                   int[::1] grid_shape=None, int[::1] grid_offsets=None,
+                                   int[::1] grid_indexes=None):
+    cdef:
+        int i, j, num_segments = max(segments.shape[0], 1)
+        bint use_bvh = bvh_bounds is not None, use_grid = grid_bounds is not None
+        double[:, ::1] intersect_cache = np.empty((num_segments, 2), dtype=np.double)
+        int[::1] index_cache = np.empty(num_segments, dtype=np.int32)
+        int[::1] row_segments = np.empty(xs.shape[0], dtype=np.int32)
+        double[::1] row_sides = np.empty(xs.shape[0], dtype=np.double)
+        Crossing *crossings = <Crossing *>malloc(num_segments * sizeof(Crossing))
+
+    if crossings == NULL:
+        raise MemoryError()
+
+    try:
+        for j in range(ys.shape[0]):
+            c_scanline_row(ys[j], xs, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh, grid_bounds, grid_shape,
+                           grid_offsets, grid_indexes, use_grid, intersect_cache, index_cache, crossings,
+                           row_segments, row_sides)
+            for i in range(xs.shape[0]):
+                image[i, j] = side_pfuncref(pfuncrefs, row_segments[i], row_sides[i])
+    finally:
+        free(crossings)
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cdef inline int p_index_search(double p, double[::1] p_range) nogil:
+    """ Last index with p_range[index] <= p, as np.digitize(p, p_range) - 1 """
+    cdef:
+        int low = 0, high = p_range.shape[0], middle
+
+    while low < high:
+        middle = (low + high) // 2
+        if p_range[middle] <= p:
+            low = middle + 1
+        else:
+            high = middle
+    return low - 1
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cpdef void interpolate_p_batch(double[:, ::1] matrix, double[::1] p_values, double[::1] p_range,
+                               double[:, ::1] out, bint log_interpolate=False, bint uniform=False) nogil:
+    """ Linear interpolation of matrix rows at every p value into out, p outside p_range is extrapolated from the
+    end intervals. uniform assumes evenly spaced p_range and finds the interval arithmetically. """
+    cdef:
+        int i, j, low_index, n_p = p_range.shape[0]
+        double t, low, high
+
+    for i in range(p_values.shape[0]):
+        if uniform:
+            low_index = <int>floor((p_values[i] - p_range[0]) / (p_range[n_p - 1] - p_range[0]) * (n_p - 1))
+        else:
+            low_index = p_index_search(p_values[i], p_range)
+        if low_index > n_p - 2:
+            low_index = n_p - 2
+        if low_index < 0:
+            low_index = 0
+
+        t = (p_values[i] - p_range[low_index]) / (p_range[low_index + 1] - p_range[low_index])
+
+        for j in range(matrix.shape[1]):
+            low = matrix[low_index, j]
+            high = matrix[low_index + 1, j]
+            if log_interpolate:
+                out[i, j] = pow(10.0, log10(low) + (log10(high) - log10(low)) * t)
+            else:
+                out[i, j] = low + (high - low) * t
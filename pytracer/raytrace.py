@@ -1,6 +1,5 @@
 import numpy as np
-import pyximport; pyximport.install(setup_args={'include_dirs': np.get_include()})
-from raytrace_c import c_raytrace_fast, c_raytrace_fast_bulk
+from .raytrace_c import c_raytrace_fast, c_raytrace_fast_bulk
 
 _cache = np.zeros((10000), dtype=np.double)
 
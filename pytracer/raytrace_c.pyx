@@ -1,184 +1,242 @@
 cimport cython
 
-from libc.math cimport floor, ceil
-from numpy.math cimport INFINITY
-
-cpdef double c_raytrace_fast(double[::1] line, double ex1, double ex2, double ey1, double ey2, double[:, ::1] pixels):
-    # Fixed issue, alphax[0] in Filip Jacob's paper means first alphax in siddon array, not alphax at zero.
+import numpy as np
+from cython.parallel cimport prange, threadid
+from libc.math cimport floor, sqrt, INFINITY
+from libc.stdlib cimport malloc, realloc, free
+
+
+@cython.cdivision(True)
+cdef inline int clamp_index(double value, int size) nogil:
+    cdef int index = <int>floor(value)
+    if index < 0:
+        return 0
+    if index > size - 1:
+        return size - 1
+    return index
+
+
+@cython.cdivision(True)
+cdef int c_siddon(double p1x, double p1y, double p2x, double p2y, double ex1, double ex2, double ey1, double ey2,
+                  int nx, int ny, int *pixels, double *lengths) nogil:
+    """ Siddon traversal of the line p1 -> p2 through an nx by ny pixel grid spanning the extent
+
+    Writes the flat pixel index i * ny + j (i along x from ex1, j along y from ey1) and intersection length of every
+    pixel crossed, returns the count which is at most nx + ny - 1.
+    """
     cdef:
-        double d12 = 0
-        double alphaxmin, alphaxmax
-        double alphaymin, alphaymax
-        double p1x, p1y, p2x, p2y
-        double bx, by
-        int Nx, Ny
-        double dx, dy
-        double alphax, alphay
-        double alphamid
-        int i, j, iu, ju
-        int imax, imin, jmax, jmin
-        int Np
-
-    p1x = line[0]
-    p1y = line[1]
-    p2x = line[2]
-    p2y = line[3]
-    bx, by = ex1, ey1
-    Nx, Ny = pixels.shape[0] + 1, pixels.shape[1] + 1
-    dx, dy = (ex2 - ex1) / pixels.shape[0], (ey2 - ey1) / pixels.shape[1]
-
-    if p1x == p2x:
-        alphaxmin = 0
-        alphaxmax = 0
-    else:
-        alphaxmin = min(((bx + 0 * dx) - p1x) / (p2x - p1x),
-                        ((bx + (Nx - 1) * dx) - p1x) / (p2x - p1x))
-        alphaxmax = max(((bx + 0 * dx) - p1x) / (p2x - p1x),
-                        ((bx + (Nx - 1) * dx) - p1x) / (p2x - p1x))
-
-    if p1y == p2y:
-        alphaymin = 0
-        alphaymax = 0
-    else:
-        alphaymin = min(((by + 0 * dy) - p1y) / (p2y - p1y),
-                        ((by + (Ny - 1) * dy) - p1y) / (p2y - p1y))
-        alphaymax = max(((by + 0 * dy) - p1y) / (p2y - p1y),
-                        ((by + (Ny - 1) * dy) - p1y) / (p2y - p1y))
-
-    if p1x == p2x:
-        alphamin = max(0, alphaymin)
-        alphamax = min(1, alphaymax)
-    elif p1y == p2y:
-        alphamin = max(0, alphaxmin)
-        alphamax = min(1, alphaxmax)
-    else:
-        alphamin = max(0, alphaxmin, alphaymin)
-        alphamax = min(1, alphaxmax, alphaymax)
-
-    if p1x < p2x:
-        if alphamin == alphaxmin:
-            imin = 1
-        else:
-            imin = <int>ceil(((p1x + alphamin * (p2x - p1x)) - bx) / dx)
-
-        if alphamax == alphaxmax:
-            imax = Nx - 1
-        else:
-            imax = <int>floor(((p1x + alphamax * (p2x - p1x)) - bx) / dx)
+        double dx = (ex2 - ex1) / nx, dy = (ey2 - ey1) / ny
+        double alphamin = 0, alphamax = 1, alpha0, alpha1
+        double alphax, alphay, alphac, alphanext
+        double line_length
+        int i, j, iu, ju, count = 0
+
+    # clip the parametric line to the grid extent
+    if p1x != p2x:
+        alpha0 = (ex1 - p1x) / (p2x - p1x)
+        alpha1 = (ex2 - p1x) / (p2x - p1x)
+        alphamin = max(alphamin, min(alpha0, alpha1))
+        alphamax = min(alphamax, max(alpha0, alpha1))
+    elif p1x < ex1 or p1x > ex2:
+        return 0
+    if p1y != p2y:
+        alpha0 = (ey1 - p1y) / (p2y - p1y)
+        alpha1 = (ey2 - p1y) / (p2y - p1y)
+        alphamin = max(alphamin, min(alpha0, alpha1))
+        alphamax = min(alphamax, max(alpha0, alpha1))
+    elif p1y < ey1 or p1y > ey2:
+        return 0
+    if alphamin >= alphamax:
+        return 0
+
+    line_length = sqrt((p2x - p1x) * (p2x - p1x) + (p2y - p1y) * (p2y - p1y))
+    if line_length == 0:
+        return 0
+
+    # a start on a pixel edge picks the pixel on either side, a wrong pick only costs a zero length step
+    i = clamp_index((p1x + alphamin * (p2x - p1x) - ex1) / dx, nx)
+    j = clamp_index((p1y + alphamin * (p2y - p1y) - ey1) / dy, ny)
+
+    iu = 1 if p2x > p1x else (-1 if p2x < p1x else 0)
+    ju = 1 if p2y > p1y else (-1 if p2y < p1y else 0)
 
-        if p1x == p2x:
+    alphac = alphamin
+    while 0 <= i < nx and 0 <= j < ny:
+        # next pixel edge crossings, recomputed from the edge position so error does not accumulate
+        if iu == 0:
             alphax = INFINITY
         else:
-            alphax = ((bx + imin * dx) - p1x) / (p2x - p1x)
-
-    else:
-        if alphamin == alphaxmin:
-            imax = Nx - 2
-        else:
-            imax = <int>floor(((p1x + alphamin * (p2x - p1x)) - bx) / dx)
-
-        if alphamax == alphaxmax:
-            imin = 0
+            alphax = (ex1 + (i + (iu > 0)) * dx - p1x) / (p2x - p1x)
+        if ju == 0:
+            alphay = INFINITY
         else:
-            imin = <int>ceil(((p1x + alphamax * (p2x - p1x)) - bx) / dx)
+            alphay = (ey1 + (j + (ju > 0)) * dy - p1y) / (p2y - p1y)
 
-        if p1x == p2x:
-            alphax = INFINITY
-        else:
-            alphax = ((bx + imax * dx) - p1x) / (p2x - p1x)
+        alphanext = min(alphax, alphay)
+        if alphanext >= alphamax:
+            pixels[count] = i * ny + j
+            lengths[count] = (alphamax - alphac) * line_length
+            count += 1
+            break
 
-    if p1y < p2y:
-        if alphamin == alphaymin:
-            jmin = 1
-        else:
-            jmin = <int>ceil(((p1y + alphamin * (p2y - p1y)) - by) / dy)
+        if alphanext > alphac:
+            pixels[count] = i * ny + j
+            lengths[count] = (alphanext - alphac) * line_length
+            count += 1
+            alphac = alphanext
 
-        if alphamax == alphaymax:
-            jmax = Ny - 1
+        if alphax < alphay:
+            i += iu
         else:
-            jmax = <int>floor(((p1y + alphamax * (p2y - p1y)) - by) / dy)
+            j += ju
 
-        if p1y == p2y:
-            alphay =  INFINITY
-        else:
-            alphay = ((by + jmin * dy) - p1y) / (p2y - p1y)
+    return count
 
-    else:
-        if alphamin == alphaymin:
-            jmax = Ny - 2
-        else:
-            jmax = <int>floor(((p1y + alphamin * (p2y - p1y)) - by) / dy)
 
-        if alphamax == alphaymax:
-            jmin = 0
-        else:
-            jmin = <int>ceil(((p1y + alphamax * (p2y - p1y)) - by) / dy)
+cpdef double c_raytrace_fast(double[::1] line, double ex1, double ex2, double ey1, double ey2, double[:, ::1] pixels):
+    cdef:
+        double d12 = 0
+        int k, count, nx = pixels.shape[0], ny = pixels.shape[1]
+        int *pixel_cache = <int *>malloc((nx + ny) * sizeof(int))
+        double *length_cache = <double *>malloc((nx + ny) * sizeof(double))
 
-        if p1y == p2y:
-            alphay = INFINITY
-        else:
-            alphay = ((by + jmax * dy) - p1y) / (p2y - p1y)
+    if pixel_cache == NULL or length_cache == NULL:
+        free(pixel_cache)
+        free(length_cache)
+        raise MemoryError()
 
-    Np = (imax - imin + 1) + (jmax - jmin + 1)
+    count = c_siddon(line[0], line[1], line[2], line[3], ex1, ex2, ey1, ey2, nx, ny, pixel_cache, length_cache)
+    for k in range(count):
+        d12 += length_cache[k] * pixels[pixel_cache[k] // ny, pixel_cache[k] % ny]
 
-    alphamid = (min(alphax, alphay) + alphamin) / 2
+    free(pixel_cache)
+    free(length_cache)
+    return d12
 
-    i = <int>floor(((p1x + alphamid * (p2x - p1x)) - bx) / dx)
-    j = <int>floor(((p1y + alphamid * (p2y - p1y)) - by) / dy)
 
-    if p1x == p2x:
-        alphaxu = 0
-    else:
-        alphaxu = dx / abs(p2x - p1x)
-    if p1y == p2y:
-        alphayu = 0
-    else:
-        alphayu = dy / abs(p2y - p1y)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void c_raytrace_fast_bulk(double[:, ::1] lines, double ex1, double ex2, double ey1, double ey2, double[:, ::1] pixels, double[::1] cache):
+    cdef:
+        int i
 
-    dconv = ((p2x - p1x)**2 + (p2y - p1y)**2)**0.5
-    alphac = alphamin
+    for i in range(lines.shape[0]):
+        cache[i] = c_raytrace_fast(lines[i], ex1, ex2, ey1, ey2, pixels)
 
-    if p1x < p2x:
-        iu = 1
-    else:
-        iu = -1
 
-    if p1y < p2y:
-        ju = 1
-    else:
-        ju = -1
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def siddon_matrix(double[:, ::1] lines, double ex1, double ex2, double ey1, double ey2, int nx, int ny):
+    """ Intersection lengths of every line with every pixel in CSR layout, line i owns entries
+    offsets[i]:offsets[i + 1] of pixels and lengths """
+    cdef:
+        int i, k, count
+        size_t total = 0, capacity = max(lines.shape[0], 16) * 4
+        bint out_of_memory = False
+        long long[::1] offsets = np.zeros(lines.shape[0] + 1, dtype=np.int64)
+        int *line_pixels = <int *>malloc((nx + ny) * sizeof(int))
+        double *line_lengths = <double *>malloc((nx + ny) * sizeof(double))
+        int *all_pixels = <int *>malloc(capacity * sizeof(int))
+        double *all_lengths = <double *>malloc(capacity * sizeof(double))
+        void *grown
+
+    try:
+        if line_pixels == NULL or line_lengths == NULL or all_pixels == NULL or all_lengths == NULL:
+            raise MemoryError()
+
+        with nogil:
+            for i in range(lines.shape[0]):
+                count = c_siddon(lines[i, 0], lines[i, 1], lines[i, 2], lines[i, 3], ex1, ex2, ey1, ey2, nx, ny,
+                                 line_pixels, line_lengths)
+                if total + count > capacity:
+                    capacity = max(2 * capacity, total + count)
+                    grown = realloc(all_pixels, capacity * sizeof(int))
+                    if grown == NULL:
+                        out_of_memory = True
+                        break
+                    all_pixels = <int *>grown
+                    grown = realloc(all_lengths, capacity * sizeof(double))
+                    if grown == NULL:
+                        out_of_memory = True
+                        break
+                    all_lengths = <double *>grown
+
+                for k in range(count):
+                    all_pixels[total + k] = line_pixels[k]
+                    all_lengths[total + k] = line_lengths[k]
+                total += count
+                offsets[i + 1] = total
+
+        if out_of_memory:
+            raise MemoryError()
+
+        pixels = np.empty(total, dtype=np.int32)
+        lengths = np.empty(total, dtype=np.double)
+        if total > 0:
+            pixels[:] = <int[:total]>all_pixels
+            lengths[:] = <double[:total]>all_lengths
+    finally:
+        free(line_pixels)
+        free(line_lengths)
+        free(all_pixels)
+        free(all_lengths)
+
+    return np.asarray(offsets), pixels, lengths
+
+
+cdef int check_scratch(int num_threads, Py_ssize_t pixel_rows, Py_ssize_t length_rows,
+                       Py_ssize_t image_rows) except -1:
+    if num_threads < 1:
+        raise ValueError(f'num_threads must be at least 1, got {num_threads}')
+    if pixel_rows < num_threads or length_rows < num_threads or image_rows < num_threads:
+        raise ValueError(f'scratch arrays need a row for each of {num_threads} threads')
+    return 0
 
-    for k in range(Np):
 
-        if alphax < alphay:
-            lij = (alphax - alphac) * dconv
-            d12 = d12 + lij * pixels[i, j]
-            i = i + iu
-            alphac = alphax
-            alphax = alphax + alphaxu
-        else:
-            lij = (alphay - alphac) * dconv
-            d12 = d12 + lij * pixels[i, j]
-            j = j + ju
-            alphac = alphay
-            alphay = alphay + alphayu
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void project(double[:, ::1] lines, double ex1, double ex2, double ey1, double ey2, int nx, int ny,
+                   int[::1] pixel_map, double[::1] image, double[::1] projection, int[:, ::1] pixel_scratch,
+                   double[:, ::1] length_scratch, int num_threads) except *:
+    """ projection[i] = sum of intersection length times image[pixel_map[pixel]] along line i
 
-    # have to think about this for case of line in and outside of image
-    # alphamax == 1 means last point is in image
-    # alphamin == 0 means first point is in image
-    # print(alphamax, alphamin, alphaxmin, alphaxmax)
-    if alphamax == 1:
+    pixel_scratch and length_scratch hold nx + ny entries for each of num_threads threads
+    """
+    cdef:
+        int i, k, count, thread
+        double value
 
-        lij = (alphamax - alphac) * dconv
-        d12 = d12 + lij * pixels[i, j]
+    check_scratch(num_threads, pixel_scratch.shape[0], length_scratch.shape[0], num_threads)
+    for i in prange(lines.shape[0], nogil=True, num_threads=num_threads, schedule='dynamic', chunksize=64):
+        thread = threadid()
+        count = c_siddon(lines[i, 0], lines[i, 1], lines[i, 2], lines[i, 3], ex1, ex2, ey1, ey2, nx, ny,
+                         &pixel_scratch[thread, 0], &length_scratch[thread, 0])
+        value = 0
+        for k in range(count):
+            value = value + length_scratch[thread, k] * image[pixel_map[pixel_scratch[thread, k]]]
+        projection[i] = value
 
-    return d12
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef void c_raytrace_fast_bulk(double[:, ::1] lines, double ex1, double ex2, double ey1, double ey2, double[:, ::1] pixels, double[::1] cache):
+cpdef void backproject(double[:, ::1] lines, double ex1, double ex2, double ey1, double ey2, int nx, int ny,
+                       int[::1] pixel_map, double[::1] projection, double[::1] image, int[:, ::1] pixel_scratch,
+                       double[:, ::1] length_scratch, double[:, ::1] image_scratch, int num_threads) except *:
+    """ Adjoint of project, image_scratch holds one image per thread so lines scatter without races """
     cdef:
-        int i
-
-    for i in range(lines.shape[0]):
-        cache[i] = c_raytrace_fast(lines[i], ex1, ex2, ey1, ey2, pixels)
\ No newline at end of file
+        int i, k, count, thread, pixel
+
+    check_scratch(num_threads, pixel_scratch.shape[0], length_scratch.shape[0], image_scratch.shape[0])
+    image_scratch[:num_threads, :] = 0
+    for i in prange(lines.shape[0], nogil=True, num_threads=num_threads, schedule='dynamic', chunksize=64):
+        thread = threadid()
+        count = c_siddon(lines[i, 0], lines[i, 1], lines[i, 2], lines[i, 3], ex1, ex2, ey1, ey2, nx, ny,
+                         &pixel_scratch[thread, 0], &length_scratch[thread, 0])
+        for k in range(count):
+            pixel = pixel_map[pixel_scratch[thread, k]]
+            image_scratch[thread, pixel] = image_scratch[thread, pixel] + length_scratch[thread, k] * projection[i]
+
+    for pixel in prange(image.shape[0], nogil=True, num_threads=num_threads, schedule='static'):
+        image[pixel] = 0
+        for thread in range(num_threads):
+            image[pixel] = image[pixel] + image_scratch[thread, pixel]
@@ -1,6 +1,10 @@
+
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
 
 from . import geometry as geo
+from . import raytrace_c
 from . import transmission as transmission
 from . import neutron_chain as chain
 from . import fission
@@ -27,28 +31,142 @@ def transmission_grid_response(flat_geom, grid, start, end):
     return response.reshape(response_shape)
 
 
+def grid_cells_from_pixels(grid, pixels):
+    """Convert siddon_matrix pixel indexes (x major, y up) to Grid cell indexes (rows from the top)."""
+    ix, iy = np.divmod(pixels, grid.num_y)
+    return (grid.num_y - 1 - iy) * grid.num_x + ix
+
+
+def transmission_grid_response_sparse(grid, start, end):
+    """Intersection length of every ray with every grid cell as a (rays, cells) CSR matrix.
+
+    Rays are start.shape[:-1] flattened, so this is transmission_grid_response(...).reshape(grid.num_cells, -1).T
+    computed with one Siddon traversal per ray.
+    """
+    lines = np.ascontiguousarray(np.concatenate((start.reshape(-1, start.shape[-1]),
+                                                 end.reshape(-1, end.shape[-1])), axis=1), dtype=np.double)
+    extent = grid.extent
+
+    offsets, pixels, lengths = raytrace_c.siddon_matrix(lines, extent[0], extent[1], extent[2], extent[3],
+                                                        grid.num_x, grid.num_y)
+    cells = grid_cells_from_pixels(grid, pixels).astype(np.int32)
+
+    return sparse.csr_matrix((lengths, cells, offsets), shape=(len(lines), grid.num_cells))
+
+
+def transmission_material_response(flat_geom, start, end, bvh=None, compiled=None):
+    """Path length of every ray through every flat_geom.materials as a (rays, materials + 1) CSR matrix.
+
+    The last column is the universe material. Rays are start.shape[:-1] flattened and traced once, the absorbances
+    transmission_scan gives for any material absorbances then take one sparse product, see
+    measurement.material_transmission_scan.
+    """
+    offsets, materials, lengths = transmission.trans_c.path_length_matrix(
+        np.ascontiguousarray(start.reshape(-1, start.shape[-1]), dtype=np.double),
+        np.ascontiguousarray(end.reshape(-1, end.shape[-1]), dtype=np.double),
+        flat_geom.segments, flat_geom.materialrefs, len(flat_geom.materials), *transmission._bvh_arrays(bvh),
+        compiled)
+
+    return sparse.csr_matrix((lengths, materials, offsets), shape=(len(offsets) - 1, len(flat_geom.materials) + 1))
+
+
+class GridProjector(LinearOperator):
+    """Matrix-free transmission_grid_response_sparse, G @ m forward projects and G.T @ d backprojects.
+
+    Rays are traced again on every product, so nothing of size rays x cells is stored. project and backproject take
+    an out array, the per-thread scratch is allocated once here. num_threads=None uses every core.
+    """
+
+    def __init__(self, grid, start, end, num_threads=1):
+        self.grid = grid
+        self.lines = np.ascontiguousarray(np.concatenate((start.reshape(-1, start.shape[-1]),
+                                                          end.reshape(-1, end.shape[-1])), axis=1), dtype=np.double)
+        self.num_threads = transmission._num_threads(num_threads)
+        super().__init__(np.double, (len(self.lines), grid.num_cells))
+
+        self._extent = [float(e) for e in grid.extent]
+        self._pixel_map = grid_cells_from_pixels(grid, np.arange(grid.num_cells)).astype(np.int32)
+        self._pixel_scratch = np.empty((self.num_threads, grid.num_x + grid.num_y), dtype=np.int32)
+        self._length_scratch = np.empty((self.num_threads, grid.num_x + grid.num_y), dtype=np.double)
+        self._image_scratch = np.empty((self.num_threads, grid.num_cells), dtype=np.double)
+
+    @staticmethod
+    def _checked(values, size, name):
+        values = np.ascontiguousarray(values, dtype=np.double).reshape(-1)
+        if len(values) != size:
+            raise ValueError(f'{name} has {len(values)} entries, expected {size}')
+        return values
+
+    @staticmethod
+    def _checked_out(out, size):
+        if out is None:
+            return np.empty(size, dtype=np.double)
+        if out.shape != (size,) or out.dtype != np.double or not out.flags.c_contiguous:
+            raise ValueError(f'out must be a C-contiguous float64 array of shape {(size,)}, '
+                             f'got {out.dtype} {out.shape}')
+        return out
+
+    def project(self, image, out=None):
+        image = self._checked(image, self.shape[1], 'image')
+        out = self._checked_out(out, self.shape[0])
+        raytrace_c.project(self.lines, *self._extent, self.grid.num_x, self.grid.num_y, self._pixel_map, image, out,
+                           self._pixel_scratch, self._length_scratch, self.num_threads)
+        return out
+
+    def backproject(self, projection, out=None):
+        projection = self._checked(projection, self.shape[0], 'projection')
+        out = self._checked_out(out, self.shape[1])
+        raytrace_c.backproject(self.lines, *self._extent, self.grid.num_x, self.grid.num_y, self._pixel_map,
+                               projection, out, self._pixel_scratch, self._length_scratch, self._image_scratch,
+                               self.num_threads)
+        return out
+
+    def rows(self, subset):
+        """Projector restricted to the rays selected by subset, as G[subset, :]."""
+        return GridProjector(self.grid, self.lines[subset, :2], self.lines[subset, 2:], self.num_threads)
+
+    def tocsr(self):
+        return transmission_grid_response_sparse(self.grid, self.lines[:, :2], self.lines[:, 2:])
+
+    def _matvec(self, x):
+        return self.project(x)
+
+    def _rmatvec(self, x):
+        return self.backproject(x)
+
+
 # TODO Cython
-def fission_grid_response(source, neutron_paths, detector_points, grid, flat_geom, k_, matrix, p_range, p_model):
+def fission_grid_response(source, neutron_paths, detector_points, grid, flat_geom, k_, matrix, p_range, p_model,
+                          detector_field_shape=None):
     # unit_m used for finding fission segments, not in fission prob calculation
     unit_m = geo.Material('black', 1, 1, 0)
     vacuum = geo.Material('white', 0, 0, 0)
 
     response = np.zeros((grid.num_cells, np.size(source, 0), np.size(neutron_paths, 0)), dtype=np.double)
 
+    nu_dists = chain.interpolate_p_batch(matrix, p_model, p_range)
+
+    # detectors and detector fields depend only on the source, built once rather than per cell
+    detector_segments = [geo.convert_points_to_segments(detector_points[:, j]) for j in range(np.size(source, 0))]
+    fields = [None] * np.size(source, 0)
+    if detector_field_shape is not None:
+        fields = [fission.build_detector_field(flat_geom, segments, detector_field_shape)
+                  for segments in detector_segments]
+
     for i in range(grid.num_cells):
         print(i, ' / ', grid.num_cells)
         cell_geom = [geo.Solid(geo.convert_points_to_segments(grid.cell(i), circular=True), unit_m, vacuum)]
         cell_flat = geo.flatten(cell_geom)
 
-        nu_dist = chain.interpolate_p(matrix, p_model[i], p_range, method='linear', log_interpolate=False)
+        nu_dist = nu_dists[i]
 
         for j in range(np.size(source, 0)):
-            detector_segments = geo.convert_points_to_segments(detector_points[:, j])
             for k in range(np.size(neutron_paths, 0)):
                 segment, val = fission.find_fission_segments(source[j], neutron_paths[k, j], cell_flat)
                 if len(segment) != 0:
                     segment = segment[0]
                     response[i, j, k] = fission.probability_segment_neutron_grid_c(source[j], segment, flat_geom,
-                                                                                   detector_segments, k_, nu_dist)
+                                                                                   detector_segments[j], k_,
+                                                                                   nu_dist, field=fields[j])
 
     return response
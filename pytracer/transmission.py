@@ -1,68 +1,118 @@
+import os
 import numpy as np
 from . import transmission_c as trans_c
 from . import geometry as geo
 
-_intersect_cache = np.empty((100, 2), dtype=np.double)
-_index_cache = np.empty(100, dtype=np.int)
+IntersectionCache = trans_c.IntersectionCache
 
+_cache = IntersectionCache(100)
 
-def absorbance_at_point(point, flat_geom):
-    return trans_c.absorbance_at_point(point[0], point[1], flat_geom.segments, flat_geom.absorbance)
 
+def _num_threads(num_threads):
+    """num_threads with None resolved to every core"""
+    if num_threads is None:
+        return os.cpu_count()
+    if num_threads < 1:
+        raise ValueError(f'num_threads must be at least 1, got {num_threads}')
+    return num_threads
 
-def absorbance_image(xs, ys, flat_geom):
+
+def _bvh_arrays(bvh):
+    if bvh is None:
+        return None, None, None
+    return bvh.bounds, bvh.nodes, bvh.order
+
+
+def _grid_arrays(grid):
+    if grid is None:
+        return None, None, None, None
+    return grid.bounds, grid.shape, grid.offsets, grid.indexes
+
+
+def absorbance_at_point(point, flat_geom, grid=None):
+    return trans_c.absorbance_at_point(point[0], point[1], flat_geom.segments, flat_geom.absorbance,
+                                       *_grid_arrays(grid))
+
+
+def _check_scanline(xs):
+    if np.any(np.diff(xs) <= 0):
+        raise ValueError('scanline images need strictly increasing xs')
+
+
+def absorbance_image(xs, ys, flat_geom, grid=None, scanline=False, bvh=None):
+    """scanline fills each image row from one ray traced across it instead of a lookup per pixel."""
     image = np.zeros((np.size(xs, 0), np.size(ys, 0)), dtype=np.double)
     extent = [xs[0], xs[-1], ys[0], ys[-1]]
 
-    trans_c.absorbance_image(image, xs, ys, flat_geom.segments, flat_geom.absorbance)
+    if scanline:
+        _check_scanline(xs)
+        trans_c.absorbance_image_scanline(image, xs, ys, flat_geom.segments, flat_geom.absorbance,
+                                          *_bvh_arrays(bvh), *_grid_arrays(grid))
+    else:
+        trans_c.absorbance_image(image, xs, ys, flat_geom.segments, flat_geom.absorbance, *_grid_arrays(grid))
 
     return image.T, extent
 
 
-def intersections(start, end, segments, intersect_cache=None, index_cache=None, ray=False):
-    if intersect_cache is None:
-        intersect_cache = _intersect_cache
-    if index_cache is None:
-        index_cache = _index_cache
+def intersections(start, end, segments, cache=None, ray=False, bvh=None, compiled=None):
+    """Returned arrays are views into cache, valid until its next use.
+
+    compiled, a geometry.compile_geometry of the same segments, traces with its structure of arrays layout.
+    """
+    if cache is None:
+        cache = _cache
+
+    num_intersects = trans_c.intersections(start, end, segments, cache, ray, *_bvh_arrays(bvh), compiled)
+
+    return np.asarray(cache.intersects)[:num_intersects], np.asarray(cache.indexes)[:num_intersects]
 
-    num_intersects = trans_c.intersections(start, end, segments, intersect_cache, index_cache, ray)
 
-    return intersect_cache[:num_intersects], index_cache[:num_intersects]
+def _check_compiled(compiled, seg_absorbance):
+    """compiled traces with the material absorbances it was compiled with, which must be seg_absorbance"""
+    if compiled is not None and len(compiled) == len(seg_absorbance) and \
+            not np.array_equal(compiled.absorbance[compiled.materials], seg_absorbance):
+        raise ValueError('seg_absorbance differs from the absorbances compiled in, compile the geometry again')
 
 
-def absorbance(start, end, segments, seg_absorbance, universe_absorbance=0.0,
-               intersect_cache=None, index_cache=None):
-    if intersect_cache is None:
-        intersect_cache = _intersect_cache
-    if index_cache is None:
-        index_cache = _index_cache
+def absorbance(start, end, segments, seg_absorbance, universe_absorbance=0.0, cache=None, bvh=None, compiled=None):
+    if cache is None:
+        cache = _cache
+    _check_compiled(compiled, seg_absorbance)
 
-    return trans_c.absorbance(start, end, segments, seg_absorbance, universe_absorbance,
-                              intersect_cache, index_cache)
+    return trans_c.absorbance(start, end, segments, seg_absorbance, universe_absorbance, cache, *_bvh_arrays(bvh),
+                              compiled)
 
 
-def attenuation(start, end, segments, seg_absorbance, universe_absorbance=0.0,
-                intersect_cache=None, index_cache=None):
+def attenuation(start, end, segments, seg_absorbance, universe_absorbance=0.0, cache=None, bvh=None, compiled=None):
     return np.exp(-absorbance(**locals()))
 
 
 def absorbances(start, end, segments, seg_absorbance, universe_absorbance=0.0,
-                intersect_cache=None, index_cache=None, absorbance_cache=None):
-    if intersect_cache is None:
-        intersect_cache = _intersect_cache
-    if index_cache is None:
-        index_cache = _index_cache
+                cache=None, absorbance_cache=None, bvh=None, num_threads=1, compiled=None):
+    """num_threads other than 1 traces rays with OpenMP, None uses every core.
+
+    compiled, a geometry.compile_geometry of the same segments, replaces the per segment tests. Its material
+    absorbances must match seg_absorbance.
+    """
+    if cache is None:
+        cache = _cache
     if absorbance_cache is None:
         absorbance_cache = np.zeros(len(start), dtype=np.double)
+    num_threads = _num_threads(num_threads)
+    _check_compiled(compiled, seg_absorbance)
 
-    trans_c.absorbances(start, end, segments, seg_absorbance, universe_absorbance,
-                        intersect_cache, index_cache, absorbance_cache)
+    if num_threads == 1:
+        trans_c.absorbances(start, end, segments, seg_absorbance, universe_absorbance,
+                            cache, absorbance_cache, *_bvh_arrays(bvh), compiled)
+    else:
+        trans_c.absorbances_parallel(start, end, segments, seg_absorbance, universe_absorbance,
+                                     absorbance_cache, num_threads, *_bvh_arrays(bvh), compiled)
 
     return absorbance_cache
 
 
 def attenuations(start, end, segments, seg_absorbance, universe_absorbance=0.0,
-                 intersect_cache=None, index_cache=None, absorbance_cache=None):
+                 cache=None, absorbance_cache=None, bvh=None, num_threads=1, compiled=None):
     absorb = absorbances(**locals())
     np.exp(-absorb, absorb)
     return absorb
@@ -1,20 +1,92 @@
-cpdef point_segment_distance(double px, double py, double x0, double x1, double y0, double y1)
+cdef struct Crossing:
+    double x
+    int index
 
-cpdef absorbance_at_point(double point_x, double point_y, double[:, :, ::1] segments,
-                          double[:, ::1] absorbance)
 
-cpdef absorbance_image(double[:, ::1] image, double[::1] xs, double[::1] ys,
-                       double[:, :, ::1] segments, double[:, ::1] absorbance)
+cdef struct SegmentArrays:
+    int count
+    bint single
+    # float or double coordinate arrays, segment i runs from (x0[i], y0[i]) to (x0[i] + dx[i], y0[i] + dy[i])
+    void *x0
+    void *y0
+    void *dx
+    void *dy
+    # (count, 4) boxes xmin, ymin, xmax, ymax
+    void *bounds
+    # (count, 2) inside and outside material of every segment, indexes into absorbance
+    int *materials
+    double *absorbance
+    # (num_solids, 4) solid boxes and (num_solids, 2) segment ranges, in segment order
+    int num_solids
+    double *solid_bounds
+    int *solid_ranges
+
+
+cdef class IntersectionCache:
+    cdef readonly double[:, ::1] intersects
+    cdef readonly int[::1] indexes
+
+    cpdef void reserve(self, int capacity)
+
+
+cdef class CompiledGeometry:
+    cdef readonly object x0, y0, dx, dy, bounds, materials, absorbance, solid_bounds, solid_ranges
+    cdef SegmentArrays arrays
+
+
+cdef SegmentArrays *compiled_arrays(CompiledGeometry compiled, double[:, :, ::1] segments) except? NULL
+
+
+cpdef double point_segment_distance(double px, double py, double x0, double x1, double y0, double y1) nogil
+
+cdef int c_nearest_segment(double point_x, double point_y, double[:, :, ::1] segments,
+                           double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets,
+                           int[::1] grid_indexes, bint use_grid, double *side) nogil
+
+cdef int c_trace(double start_x, double start_y, double end_x, double end_y,
+                 double[:, :, ::1] segments, double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes,
+                 int[::1] bvh_order, bint use_bvh, double[:, ::1] intersect_cache, int[::1] index_cache,
+                 bint ray, SegmentArrays *compiled=*) nogil
+
+cdef void c_scanline_row(double y, double[::1] xs, double[:, :, ::1] segments,
+                         double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes, int[::1] bvh_order, bint use_bvh,
+                         double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets, int[::1] grid_indexes,
+                         bint use_grid, double[:, ::1] intersect_cache, int[::1] index_cache, Crossing *crossings,
+                         int[::1] row_segments, double[::1] row_sides) nogil
+
+cpdef double absorbance_at_point(double point_x, double point_y, double[:, :, ::1] segments,
+                                 double[:, ::1] absorbance, double[::1] grid_bounds=*, int[::1] grid_shape=*,
+                                 int[::1] grid_offsets=*, int[::1] grid_indexes=*)
+
+cpdef void absorbance_image(double[:, ::1] image, double[::1] xs, double[::1] ys,
+                            double[:, :, ::1] segments, double[:, ::1] absorbance, double[::1] grid_bounds=*,
+                            int[::1] grid_shape=*, int[::1] grid_offsets=*, int[::1] grid_indexes=*)
+
+cpdef void absorbance_image_scanline(double[:, ::1] image, double[::1] xs, double[::1] ys,
+                                     double[:, :, ::1] segments, double[:, ::1] absorbance,
+                                     double[:, ::1] bvh_bounds=*, int[:, ::1] bvh_nodes=*, int[::1] bvh_order=*,
+                                     double[::1] grid_bounds=*, int[::1] grid_shape=*, int[::1] grid_offsets=*,
+                                     int[::1] grid_indexes=*)
 
 cpdef int intersections(double[::1] start, double[::1] end, double[:, :, ::1] segments,
-                        double[:, ::1] intersect_cache, int[::1] index_cache, bint ray)
+                        IntersectionCache cache, bint ray,
+                        double[:, ::1] bvh_bounds=*, int[:, ::1] bvh_nodes=*, int[::1] bvh_order=*,
+                        CompiledGeometry compiled=*) except *
 
 cpdef double absorbance(double[::1] start, double[::1] end,
                         double[:, :, ::1] segments, double[:, ::1] seg_absorption,
-                        double universe_absorption, double[:, ::1] intersect_cache,
-                        int[::1] index_cache)
+                        double universe_absorption, IntersectionCache cache,
+                        double[:, ::1] bvh_bounds=*, int[:, ::1] bvh_nodes=*, int[::1] bvh_order=*,
+                        CompiledGeometry compiled=*) except *
 
 cpdef void absorbances(double[:, ::1] start, double[:, ::1] end,
                        double[:, :, ::1] segments, double[:, ::1] seg_absorption,
-                       double universe_absorption, double[:, ::1] intersects_cache,
-                       int[::1] indexes_cache, double[:] absorbance_cache)
+                       double universe_absorption, IntersectionCache cache,
+                       double[:] absorbance_cache, double[:, ::1] bvh_bounds=*,
+                       int[:, ::1] bvh_nodes=*, int[::1] bvh_order=*, CompiledGeometry compiled=*) except *
+
+cpdef void absorbances_parallel(double[:, ::1] start, double[:, ::1] end,
+                                double[:, :, ::1] segments, double[:, ::1] seg_absorption,
+                                double universe_absorption, double[:] absorbance_cache, int num_threads,
+                                double[:, ::1] bvh_bounds=*, int[:, ::1] bvh_nodes=*, int[::1] bvh_order=*,
+                                CompiledGeometry compiled=*) except *
@@ -3,20 +3,28 @@ import numpy as np
 
 cimport numpy as np
 from cython cimport cdivision, boundscheck, wraparound
-from libc.math cimport sqrt
+from cython.parallel cimport prange, threadid
+from libc.math cimport sqrt, fabs, INFINITY
+from libc.stdlib cimport malloc, free, qsort
 
-cdef inline double distance(double x1, double y1, double x2, double y2):
+DEF BVH_MAX_DEPTH = 128
+
+ctypedef fused coordinate:
+    float
+    double
+
+cdef inline double distance(double x1, double y1, double x2, double y2) nogil:
     cdef:
         double tmp = 0
 
     tmp = (x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2)
     return sqrt(tmp)
 
-cdef inline double sign_line(double x, double y, double x1, double y1, double x2, double y2):
+cdef inline double sign_line(double x, double y, double x1, double y1, double x2, double y2) nogil:
     return (x - x1) * (y1 - y2) + (y - y1) * (x2 - x1)
 
 @cdivision(True)
-cpdef point_segment_distance(double px, double py, double x0, double x1, double y0, double y1):
+cpdef double point_segment_distance(double px, double py, double x0, double x1, double y0, double y1) nogil:
     cdef:
         double length_sq, t, projection_x, projection_y, distance
 
@@ -39,135 +47,817 @@ cpdef point_segment_distance(double px, double py, double x0, double x1, double
     return distance
 
 
+@boundscheck(False)
+@wraparound(False)
+cdef inline void nearest_candidate(double point_x, double point_y, double[:, :, ::1] segments, int i,
+                                   double *min_distance, int *nearest) nogil:
+    cdef double distance
+
+    distance = point_segment_distance(point_x, point_y, segments[i, 0, 0], segments[i, 1, 0],
+                                      segments[i, 0, 1], segments[i, 1, 1])
+    # ties go to the lowest segment index, as in a plain scan over all segments
+    if distance < min_distance[0] or (distance == min_distance[0] and i < nearest[0]):
+        min_distance[0] = distance
+        nearest[0] = i
+
+
 @cdivision(True)
 @boundscheck(False)
-cpdef absorbance_at_point(double point_x, double point_y, double[:, :, ::1] segments, double[:, ::1] absorbance):
-    """ Based on looking at segment with smallest distance """
+@wraparound(False)
+cdef int c_nearest_segment_grid(double point_x, double point_y, double[:, :, ::1] segments,
+                                double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets,
+                                int[::1] grid_indexes) nogil:
+    """ Search rings of grid cells outward from the point until no unvisited cell can hold a closer segment """
+    cdef:
+        int nx = grid_shape[0], ny = grid_shape[1]
+        double cell_x = (grid_bounds[2] - grid_bounds[0]) / nx
+        double cell_y = (grid_bounds[3] - grid_bounds[1]) / ny
+        double min_cell = min(cell_x, cell_y)
+        double min_distance = INFINITY
+        int nearest = -1
+        int ci, cj, i, j, k, r, i_step
+
+    ci = min(max(<int>((point_x - grid_bounds[0]) / cell_x), 0), nx - 1)
+    cj = min(max(<int>((point_y - grid_bounds[1]) / cell_y), 0), ny - 1)
+
+    for r in range(max(nx, ny)):
+        for j in range(max(cj - r, 0), min(cj + r, ny - 1) + 1):
+            # full rows on the top and bottom of the ring, only the two side cells in between
+            i_step = 1 if (j == cj - r or j == cj + r or r == 0) else 2 * r
+            i = ci - r
+            while i <= ci + r:
+                if 0 <= i < nx:
+                    for k in range(grid_offsets[j * nx + i], grid_offsets[j * nx + i + 1]):
+                        nearest_candidate(point_x, point_y, segments, grid_indexes[k], &min_distance, &nearest)
+                i += i_step
+
+        # every cell outside ring r is at least r cells away from the point
+        if nearest >= 0 and min_distance < r * min_cell:
+            break
+
+    return nearest
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_nearest_segment(double point_x, double point_y, double[:, :, ::1] segments,
+                           double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets,
+                           int[::1] grid_indexes, bint use_grid, double *side) nogil:
+    """ Index of the segment closest to the point (-1 if there are none), side is its sign_line value """
+    cdef:
+        double min_distance = INFINITY
+        int i, nearest = -1
+
+    if use_grid:
+        nearest = c_nearest_segment_grid(point_x, point_y, segments, grid_bounds, grid_shape, grid_offsets,
+                                         grid_indexes)
+    else:
+        for i in range(segments.shape[0]):
+            nearest_candidate(point_x, point_y, segments, i, &min_distance, &nearest)
+
+    if nearest >= 0:
+        side[0] = sign_line(point_x, point_y, segments[nearest, 0, 0], segments[nearest, 0, 1],
+                            segments[nearest, 1, 0], segments[nearest, 1, 1])
+    return nearest
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cdef inline double side_value(double[:, ::1] values, int i, double is_outer) nogil:
+    if i < 0:
+        return 0
+    if is_outer == 0:
+        return (values[i, 1] + values[i, 0]) / 2
+    elif is_outer > 0:
+        return values[i, 1]
+    return values[i, 0]
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cdef double c_absorbance_at_point(double point_x, double point_y, double[:, :, ::1] segments,
+                                  double[:, ::1] absorbance, double[::1] grid_bounds, int[::1] grid_shape,
+                                  int[::1] grid_offsets, int[::1] grid_indexes, bint use_grid) nogil:
     cdef:
-        double min_distance = 1e99
-        double distance
         double is_outer
-        double point_absorbance = 0
+        int i
 
-    for i in range(segments.shape[0]):
-        distance = point_segment_distance(point_x, point_y, segments[i, 0, 0], segments[i, 1, 0],
-                                          segments[i, 0, 1], segments[i, 1, 1])
-        if distance < min_distance:
-            min_distance = distance
-            is_outer = sign_line(point_x, point_y, segments[i, 0, 0], segments[i, 0, 1],
-                                 segments[i, 1, 0], segments[i, 1, 1])
-            if is_outer == 0:
-                point_absorbance = (absorbance[i, 1] + absorbance[i, 0]) / 2
-            elif is_outer > 0:
-                point_absorbance = absorbance[i, 1]
-            else:
-                point_absorbance = absorbance[i, 0]
-    return point_absorbance
+    i = c_nearest_segment(point_x, point_y, segments, grid_bounds, grid_shape, grid_offsets, grid_indexes,
+                          use_grid, &is_outer)
+    return side_value(absorbance, i, is_outer)
+
+
+cpdef double absorbance_at_point(double point_x, double point_y, double[:, :, ::1] segments,
+                                 double[:, ::1] absorbance, double[::1] grid_bounds=None, int[::1] grid_shape=None,
+                                 int[::1] grid_offsets=None, int[::1] grid_indexes=None):
+    """ Based on looking at segment with smallest distance """
+    return c_absorbance_at_point(point_x, point_y, segments, absorbance, grid_bounds, grid_shape, grid_offsets,
+                                 grid_indexes, grid_bounds is not None)
 
 
 @cdivision(True)
-# @boundscheck(False)
-cpdef absorbance_image(double[:, ::1] image, double[::1] xs, double[::1] ys,
-                       double[:, :, ::1] segments, double[:, ::1] absorbance):
+@boundscheck(False)
+@wraparound(False)
+cpdef void absorbance_image(double[:, ::1] image, double[::1] xs, double[::1] ys,
+                            double[:, :, ::1] segments, double[:, ::1] absorbance, double[::1] grid_bounds=None,
+                            int[::1] grid_shape=None, int[::1] grid_offsets=None, int[::1] grid_indexes=None):
+    cdef:
+        int i, j
+        bint use_grid = grid_bounds is not None
 
     for i in range(xs.shape[0]):
         for j in range(ys.shape[0]):
-            image[i, j] = absorbance_at_point(xs[i], ys[j], segments, absorbance)
+            image[i, j] = c_absorbance_at_point(xs[i], ys[j], segments, absorbance, grid_bounds, grid_shape,
+                                                grid_offsets, grid_indexes, use_grid)
 
 
-# TODO Make this more safe if intersects or indexes isn't passed correctly
 @cdivision(True)
 @boundscheck(False)
-cpdef int intersections(double[::1] start, double[::1] end, double[:, :, ::1] segments,
-                        double[:, ::1] intersect_cache, int[::1] index_cache, bint ray):
+@wraparound(False)
+cdef inline bint segment_crossing(double[:, :, ::1] segments, int i, double start_x, double start_y,
+                                  double s_x, double s_y, bint ray, double *x, double *y) nogil:
     cdef:
-        int i, num_intersect = 0
         double r[2]
-        double s[2]
         double denom, t, u, epsilon = 1e-15
 
-    for i in range(segments.shape[0]):
-        r[0] = segments[i, 1, 0] - segments[i, 0, 0]
-        r[1] = segments[i, 1, 1] - segments[i, 0, 1]
-        s[0] = end[0] - start[0]
-        s[1] = end[1] - start[1]
+    r[0] = segments[i, 1, 0] - segments[i, 0, 0]
+    r[1] = segments[i, 1, 1] - segments[i, 0, 1]
+
+    denom = r[0] * s_y - r[1] * s_x
+    if denom == 0.:
+        return False
+
+    t = (start_x - segments[i, 0, 0]) * s_y - (start_y - segments[i, 0, 1]) * s_x
+    t = t / denom
+    u = (start_x - segments[i, 0, 0]) * r[1] - (start_y - segments[i, 0, 1]) * r[0]
+    u = u / denom
+
+    if -epsilon < t < 1. - epsilon:
+        if (ray) or 0. < u <= 1.:
+            x[0] = segments[i, 0, 0] + t * r[0]
+            y[0] = segments[i, 0, 1] + t * r[1]
+            return True
+    return False
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cdef inline bint box_crossing(double start_x, double start_y, double s_x, double s_y, double *box, bint ray) nogil:
+    """ Slab test of the ray / segment [start, start + s] against the box xmin, ymin, xmax, ymax """
+    cdef:
+        double t_min = 0., t_max = 1., t0, t1
+
+    if ray:
+        t_min = -INFINITY
+        t_max = INFINITY
+
+    if s_x == 0.:
+        if start_x < box[0] or start_x > box[2]:
+            return False
+    else:
+        t0 = (box[0] - start_x) / s_x
+        t1 = (box[2] - start_x) / s_x
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_min = max(t_min, t0)
+        t_max = min(t_max, t1)
+
+    if s_y == 0.:
+        if start_y < box[1] or start_y > box[3]:
+            return False
+    else:
+        t0 = (box[1] - start_y) / s_y
+        t1 = (box[3] - start_y) / s_y
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_min = max(t_min, t0)
+        t_max = min(t_max, t1)
+
+    return t_min <= t_max
+
+
+cdef inline bint crosses_line(coordinate *x0, coordinate *y0, coordinate *dx, coordinate *dy, int i,
+                              double start_x, double start_y, double s_x, double s_y) nogil:
+    """ False only if the segment clearly misses the line of the path, tested without dividing """
+    cdef:
+        double denom = dx[i] * s_y - dy[i] * s_x
+        double t = (start_x - x0[i]) * s_y - (start_y - y0[i]) * s_x
+
+    # t / denom is the position of the crossing along the segment, rejected well outside (-epsilon, 1 - epsilon)
+    return not (fabs(t) > 2 * fabs(denom) or ((t < 0) != (denom < 0) and fabs(t) > 1e-14 * fabs(denom)))
+
+
+@cdivision(True)
+cdef inline bint compiled_crossing(coordinate *x0, coordinate *y0, coordinate *dx, coordinate *dy, int i,
+                                   double start_x, double start_y, double s_x, double s_y, bint ray,
+                                   double *x, double *y) nogil:
+    """ segment_crossing on the structure of arrays layout of a CompiledGeometry """
+    cdef:
+        double r_x = dx[i], r_y = dy[i], q_x = start_x - x0[i], q_y = start_y - y0[i]
+        double denom, t, u, epsilon = 1e-15
+
+    denom = r_x * s_y - r_y * s_x
+    if denom == 0.:
+        return False
+
+    t = q_x * s_y - q_y * s_x
+    t = t / denom
+    u = q_x * r_y - q_y * r_x
+    u = u / denom
+
+    if -epsilon < t < 1. - epsilon:
+        if (ray) or 0. < u <= 1.:
+            x[0] = x0[i] + t * r_x
+            y[0] = y0[i] + t * r_y
+            return True
+    return False
 
-        denom = r[0] * s[1] - r[1] * s[0]
-        if denom == 0.:
-            continue
 
-        t = (start[0] - segments[i, 0, 0]) * s[1] - (start[1] - segments[i, 0, 1]) * s[0]
-        t = t / denom
-        u = (start[0] - segments[i, 0, 0]) * r[1] - (start[1] - segments[i, 0, 1]) * r[0]
-        u = u / denom
+@boundscheck(False)
+@wraparound(False)
+cdef inline bint traced_crossing(double[:, :, ::1] segments, SegmentArrays *compiled, int i, double start_x,
+                                 double start_y, double s_x, double s_y, bint ray, double *x, double *y) nogil:
+    if compiled == NULL:
+        return segment_crossing(segments, i, start_x, start_y, s_x, s_y, ray, x, y)
+    if compiled.single:
+        return compiled_crossing(<float *>compiled.x0, <float *>compiled.y0, <float *>compiled.dx,
+                                 <float *>compiled.dy, i, start_x, start_y, s_x, s_y, ray, x, y)
+    return compiled_crossing(<double *>compiled.x0, <double *>compiled.y0, <double *>compiled.dx,
+                             <double *>compiled.dy, i, start_x, start_y, s_x, s_y, ray, x, y)
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_intersections(double start_x, double start_y, double end_x, double end_y,
+                         double[:, :, ::1] segments, double[:, ::1] intersect_cache, int[::1] index_cache,
+                         bint ray) nogil:
+    cdef:
+        int i, num_intersect = 0
+        int capacity = min(intersect_cache.shape[0], index_cache.shape[0])
+        double s_x = end_x - start_x, s_y = end_y - start_y
+        double x, y
 
-        if -epsilon < t < 1. - epsilon:
-            if (ray) or 0. < u <= 1.:
-                intersect_cache[num_intersect, 0] = segments[i, 0, 0] + t * r[0]
-                intersect_cache[num_intersect, 1] = segments[i, 0, 1] + t * r[1]
+    for i in range(segments.shape[0]):
+        if segment_crossing(segments, i, start_x, start_y, s_x, s_y, ray, &x, &y):
+            if num_intersect < capacity:
+                intersect_cache[num_intersect, 0] = x
+                intersect_cache[num_intersect, 1] = y
                 index_cache[num_intersect] = i
+            num_intersect += 1
+
+    return num_intersect
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_intersections_compiled(double start_x, double start_y, double end_x, double end_y,
+                                  coordinate *x0, coordinate *y0, coordinate *dx, coordinate *dy,
+                                  coordinate *bounds, SegmentArrays *compiled, double[:, ::1] intersect_cache,
+                                  int[::1] index_cache, bint ray) nogil:
+    """ Same result and ordering as c_intersections, skipping whole solids whose box the path misses and then
+    segments that miss the line or box of the path """
+    cdef:
+        int i, solid, num_intersect = 0
+        int capacity = min(intersect_cache.shape[0], index_cache.shape[0])
+        double s_x = end_x - start_x, s_y = end_y - start_y
+        double xmin = min(start_x, end_x), xmax = max(start_x, end_x)
+        double ymin = min(start_y, end_y), ymax = max(start_y, end_y)
+        double x, y
+
+    for solid in range(compiled.num_solids):
+        if not box_crossing(start_x, start_y, s_x, s_y, &compiled.solid_bounds[4 * solid], ray):
+            continue
+
+        for i in range(compiled.solid_ranges[2 * solid], compiled.solid_ranges[2 * solid + 1]):
+            # most segments miss the line of the path entirely, the box test only runs for the few that do not
+            if not crosses_line(x0, y0, dx, dy, i, start_x, start_y, s_x, s_y):
+                continue
+            if not ray and (bounds[4 * i] > xmax or bounds[4 * i + 2] < xmin or
+                            bounds[4 * i + 1] > ymax or bounds[4 * i + 3] < ymin):
+                continue
+            if compiled_crossing(x0, y0, dx, dy, i, start_x, start_y, s_x, s_y, ray, &x, &y):
+                if num_intersect < capacity:
+                    intersect_cache[num_intersect, 0] = x
+                    intersect_cache[num_intersect, 1] = y
+                    index_cache[num_intersect] = i
                 num_intersect += 1
 
     return num_intersect
 
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_intersections_bvh(double start_x, double start_y, double end_x, double end_y,
+                             double[:, :, ::1] segments, double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes,
+                             int[::1] bvh_order, double[:, ::1] intersect_cache, int[::1] index_cache,
+                             bint ray, SegmentArrays *compiled) nogil:
+    """ Same result and ordering as c_intersections, only visiting leaves whose box the ray crosses """
+    cdef:
+        int i, j, k, node, num_intersect = 0, stack_size = 1
+        int capacity = min(intersect_cache.shape[0], index_cache.shape[0])
+        int stack[BVH_MAX_DEPTH]
+        double s_x = end_x - start_x, s_y = end_y - start_y
+        double x, y
+
+    stack[0] = 0
+    while stack_size > 0:
+        stack_size -= 1
+        node = stack[stack_size]
+        if not box_crossing(start_x, start_y, s_x, s_y, &bvh_bounds[node, 0], ray):
+            continue
+
+        if bvh_nodes[node, 1] >= 0:
+            for k in range(bvh_nodes[node, 0], bvh_nodes[node, 0] + bvh_nodes[node, 1]):
+                i = bvh_order[k]
+                if traced_crossing(segments, compiled, i, start_x, start_y, s_x, s_y, ray, &x, &y):
+                    if num_intersect >= capacity:
+                        num_intersect += 1
+                        continue
+                    # insertion by segment index keeps the brute force ordering
+                    j = num_intersect
+                    while j > 0 and index_cache[j - 1] > i:
+                        index_cache[j] = index_cache[j - 1]
+                        intersect_cache[j, 0] = intersect_cache[j - 1, 0]
+                        intersect_cache[j, 1] = intersect_cache[j - 1, 1]
+                        j -= 1
+                    index_cache[j] = i
+                    intersect_cache[j, 0] = x
+                    intersect_cache[j, 1] = y
+                    num_intersect += 1
+        else:
+            stack[stack_size] = bvh_nodes[node, 0]
+            stack[stack_size + 1] = node + 1
+            stack_size += 2
+
+    return num_intersect
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef int c_trace(double start_x, double start_y, double end_x, double end_y,
+                 double[:, :, ::1] segments, double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes,
+                 int[::1] bvh_order, bint use_bvh, double[:, ::1] intersect_cache, int[::1] index_cache,
+                 bint ray, SegmentArrays *compiled=NULL) nogil:
+    if use_bvh:
+        return c_intersections_bvh(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order,
+                                   intersect_cache, index_cache, ray, compiled)
+    if compiled != NULL and compiled.single:
+        return c_intersections_compiled(start_x, start_y, end_x, end_y, <float *>compiled.x0,
+                                        <float *>compiled.y0, <float *>compiled.dx, <float *>compiled.dy,
+                                        <float *>compiled.bounds, compiled, intersect_cache, index_cache, ray)
+    if compiled != NULL:
+        return c_intersections_compiled(start_x, start_y, end_x, end_y, <double *>compiled.x0,
+                                        <double *>compiled.y0, <double *>compiled.dx, <double *>compiled.dy,
+                                        <double *>compiled.bounds, compiled, intersect_cache, index_cache, ray)
+    return c_intersections(start_x, start_y, end_x, end_y, segments, intersect_cache, index_cache, ray)
+
+
+cdef class IntersectionCache:
+    """ Scratch space for the crossings along one ray, grows whenever a trace needs more room """
+
+    def __init__(self, int capacity=100):
+        self.intersects = np.empty((capacity, 2), dtype=np.double)
+        self.indexes = np.empty(capacity, dtype=np.int32)
+
+    @property
+    def capacity(self):
+        return self.indexes.shape[0]
+
+    cpdef void reserve(self, int capacity):
+        """ Grow to hold at least capacity crossings, doubling to amortize repeated growth """
+        if capacity <= self.indexes.shape[0]:
+            return
+        capacity = max(capacity, 2 * self.indexes.shape[0])
+        self.intersects = np.empty((capacity, 2), dtype=np.double)
+        self.indexes = np.empty(capacity, dtype=np.int32)
+
+
+cdef class CompiledGeometry:
+    """ Structure of arrays copy of a flattened geometry the tracing kernels read instead of segments
+
+    Coordinates and bounds are all float32 or all float64, built by geometry.compile_geometry. Tracing kernels
+    still take the (N, 2, 2) segments, only the per segment crossing tests and material lookups read from here.
+    Solid s owns segments solid_ranges[s, 0]:solid_ranges[s, 1] inside the float64 box solid_bounds[s].
+    """
+
+    def __init__(self, np.ndarray x0, np.ndarray y0, np.ndarray dx, np.ndarray dy, np.ndarray bounds,
+                 np.ndarray materials, np.ndarray absorbance, np.ndarray solid_bounds, np.ndarray solid_ranges):
+        cdef int count = x0.shape[0]
+
+        if x0.dtype not in (np.float32, np.float64):
+            raise TypeError(f'compiled coordinates must be float32 or float64, got {x0.dtype}')
+        for name, array in (('y0', y0), ('dx', dx), ('dy', dy), ('bounds', bounds)):
+            if array.dtype != x0.dtype or not array.flags.c_contiguous:
+                raise TypeError(f'compiled {name} must be C contiguous {x0.dtype}')
+        if np.shape(bounds) != (count, 4) or np.shape(materials) != (count, 2) or materials.dtype != np.int32 or \
+                not materials.flags.c_contiguous:
+            raise ValueError('compiled bounds and materials need a (N, 4) and C contiguous int32 (N, 2) array')
+        if absorbance.dtype != np.double or not absorbance.flags.c_contiguous or \
+                (count > 0 and materials.max() >= absorbance.shape[0]):
+            raise ValueError('compiled absorbance must be a C contiguous float64 entry for every material')
+        if solid_bounds.dtype != np.double or solid_ranges.dtype != np.int32 or \
+                not solid_bounds.flags.c_contiguous or not solid_ranges.flags.c_contiguous or \
+                np.shape(solid_ranges)[1:] != (2,) or np.shape(solid_bounds) != (len(solid_ranges), 4):
+            raise ValueError('compiled solids need C contiguous float64 (S, 4) bounds and int32 (S, 2) ranges')
+        # culling only ever visits segments inside a solid range
+        ranges = np.concatenate(([0], np.ravel(solid_ranges), [count]))
+        if np.any(ranges[::2] != ranges[1::2]) or np.any(np.diff(ranges) < 0):
+            raise ValueError('compiled solid ranges must cover every segment in order')
+
+        self.x0, self.y0, self.dx, self.dy = x0, y0, dx, dy
+        self.bounds, self.materials, self.absorbance = bounds, materials, absorbance
+        self.solid_bounds, self.solid_ranges = solid_bounds, solid_ranges
+
+        self.arrays.count = count
+        self.arrays.single = x0.dtype == np.float32
+        self.arrays.x0 = np.PyArray_DATA(x0)
+        self.arrays.y0 = np.PyArray_DATA(y0)
+        self.arrays.dx = np.PyArray_DATA(dx)
+        self.arrays.dy = np.PyArray_DATA(dy)
+        self.arrays.bounds = np.PyArray_DATA(bounds)
+        self.arrays.materials = <int *>np.PyArray_DATA(materials)
+        self.arrays.absorbance = <double *>np.PyArray_DATA(absorbance)
+        self.arrays.num_solids = solid_ranges.shape[0]
+        self.arrays.solid_bounds = <double *>np.PyArray_DATA(solid_bounds)
+        self.arrays.solid_ranges = <int *>np.PyArray_DATA(solid_ranges)
+
+    @property
+    def single(self):
+        return self.arrays.single
+
+    def __len__(self):
+        return self.arrays.count
+
+    def __reduce__(self):
+        return CompiledGeometry, (self.x0, self.y0, self.dx, self.dy, self.bounds, self.materials, self.absorbance,
+                                  self.solid_bounds, self.solid_ranges)
+
+
+cdef SegmentArrays *compiled_arrays(CompiledGeometry compiled, double[:, :, ::1] segments) except? NULL:
+    """ The arrays of compiled, which must be compiled from segments, NULL for None """
+    if compiled is None:
+        return NULL
+    if compiled.arrays.count != segments.shape[0]:
+        raise ValueError(f'compiled geometry has {compiled.arrays.count} segments, segments has {segments.shape[0]}')
+    return &compiled.arrays
+
+
+cpdef int intersections(double[::1] start, double[::1] end, double[:, :, ::1] segments,
+                        IntersectionCache cache, bint ray,
+                        double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None, int[::1] bvh_order=None,
+                        CompiledGeometry compiled=None) except *:
+    cdef:
+        int num_intersect
+        bint use_bvh = bvh_bounds is not None
+
+    num_intersect = c_trace(start[0], start[1], end[0], end[1], segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                            cache.intersects, cache.indexes, ray, compiled_arrays(compiled, segments))
+    if num_intersect > cache.capacity:
+        cache.reserve(num_intersect)
+        num_intersect = c_trace(start[0], start[1], end[0], end[1], segments, bvh_bounds, bvh_nodes, bvh_order,
+                                use_bvh, cache.intersects, cache.indexes, ray, compiled_arrays(compiled, segments))
+    return num_intersect
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef inline double side_absorption(double[:, ::1] seg_absorption, SegmentArrays *compiled, int i, int side) nogil:
+    if compiled == NULL:
+        return seg_absorption[i, side]
+    return compiled.absorbance[compiled.materials[2 * i + side]]
+
+
 @cdivision(True)
 @boundscheck(False)
 @wraparound(False)
-cpdef double absorbance(double[::1] start, double[::1] end,
-                        double[:, :, ::1] segments, double[:, ::1] seg_absorption,
-                        double universe_absorption, double[:, ::1] intersect_cache,
-                        int[::1] index_cache):
+cdef double c_absorbance(double start_x, double start_y, double end_x, double end_y,
+                         double[:, :, ::1] segments, double[:, ::1] seg_absorption, double universe_absorption,
+                         double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes, int[::1] bvh_order, bint use_bvh,
+                         double[:, ::1] intersect_cache, int[::1] index_cache, int *required,
+                         SegmentArrays *compiled) nogil:
+    """ If the caches are too small required is set to the number of crossings needed and 0 is returned """
     cdef:
         int num_intersect = 0
         double absorbance = 0
         double current_distance = 0, min_distance = 1e15
         double tmp, tmp2
-        int i, ci
+        int i, ci = 0
+        bint contained = False
 
-    num_intersect = intersections(start, end, segments, intersect_cache, index_cache, ray=False)
+    required[0] = 0
+    num_intersect = c_trace(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                            intersect_cache, index_cache, False, compiled)
 
     # If no intersection must determine what material we are within by tracing a ray
     if num_intersect == 0:
-        num_intersect = intersections(start, end, segments, intersect_cache, index_cache, ray=True)
+        contained = True
+        num_intersect = c_trace(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                                intersect_cache, index_cache, True, compiled)
+
+    if num_intersect > index_cache.shape[0] or num_intersect > intersect_cache.shape[0]:
+        required[0] = num_intersect
+        return 0
 
     # No intersection through a ray, must be outside the object, return absorbance from universe material
     if num_intersect == 0:
-        absorbance = distance(start[0], start[1], end[0], end[1]) * universe_absorption
+        absorbance = distance(start_x, start_y, end_x, end_y) * universe_absorption
         return absorbance
 
     for i in range(num_intersect):
-        current_distance = distance(intersect_cache[i, 0], intersect_cache[i, 1], start[0], start[1])
+        current_distance = distance(intersect_cache[i, 0], intersect_cache[i, 1], start_x, start_y)
         if current_distance < min_distance:
             ci = index_cache[i]
             min_distance = current_distance
 
-    tmp = sign_line(start[0], start[1], segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0], segments[ci, 1, 1])
+    tmp = sign_line(start_x, start_y, segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0], segments[ci, 1, 1])
 
     if tmp > 0:
-        absorbance = distance(start[0], start[1], end[0], end[1]) * seg_absorption[ci, 1]
+        absorbance = distance(start_x, start_y, end_x, end_y) * side_absorption(seg_absorption, compiled, ci, 1)
     else:
-        absorbance = distance(start[0], start[1], end[0], end[1]) * seg_absorption[ci, 0]
+        absorbance = distance(start_x, start_y, end_x, end_y) * side_absorption(seg_absorption, compiled, ci, 0)
+
+    # the ray crossings only located the material, none of them lie between start and end
+    if contained:
+        return absorbance
 
     # Had intersections, so add up all individual absorptions between start and end
     for i in range(num_intersect):
         ci = index_cache[i]
-        tmp = sign_line(start[0], start[1], segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0], segments[ci, 1, 1])
-        tmp2 = distance(intersect_cache[i, 0], intersect_cache[i, 1], end[0], end[1]) * (seg_absorption[ci, 0] - seg_absorption[ci, 1])
+        tmp = sign_line(start_x, start_y, segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0], segments[ci, 1, 1])
+        tmp2 = distance(intersect_cache[i, 0], intersect_cache[i, 1], end_x, end_y) * \
+            (side_absorption(seg_absorption, compiled, ci, 0) - side_absorption(seg_absorption, compiled, ci, 1))
         if tmp > 0:
             absorbance += tmp2
         else:
             absorbance -= tmp2
     return absorbance
 
+
+cpdef double absorbance(double[::1] start, double[::1] end,
+                        double[:, :, ::1] segments, double[:, ::1] seg_absorption,
+                        double universe_absorption, IntersectionCache cache,
+                        double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None, int[::1] bvh_order=None,
+                        CompiledGeometry compiled=None) except *:
+    cdef:
+        double result
+        int required = 0
+        bint use_bvh = bvh_bounds is not None
+
+    result = c_absorbance(start[0], start[1], end[0], end[1], segments, seg_absorption, universe_absorption,
+                          bvh_bounds, bvh_nodes, bvh_order, use_bvh, cache.intersects, cache.indexes, &required,
+                          compiled_arrays(compiled, segments))
+    if required > 0:
+        cache.reserve(required)
+        result = c_absorbance(start[0], start[1], end[0], end[1], segments, seg_absorption, universe_absorption,
+                              bvh_bounds, bvh_nodes, bvh_order, use_bvh, cache.intersects, cache.indexes, &required,
+                              compiled_arrays(compiled, segments))
+    return result
+
+
 @boundscheck(False)
 @wraparound(False)
 cpdef void absorbances(double[:, ::1] start, double[:, ::1] end,
                        double[:, :, ::1] segments, double[:, ::1] seg_absorption,
-                       double universe_absorption, double[:, ::1] intersects_cache,
-                       int[::1] indexes_cache, double[:] absorbance_cache):
+                       double universe_absorption, IntersectionCache cache,
+                       double[:] absorbance_cache, double[:, ::1] bvh_bounds=None,
+                       int[:, ::1] bvh_nodes=None, int[::1] bvh_order=None, CompiledGeometry compiled=None) except *:
     cdef:
-        int i
+        int i, required = 0
+        bint use_bvh = bvh_bounds is not None
+        SegmentArrays *arrays = compiled_arrays(compiled, segments)
 
     for i in range(start.shape[0]):
-        absorbance_cache[i] = absorbance(start[i], end[i], segments, seg_absorption, universe_absorption,
-                                         intersects_cache, indexes_cache)
+        absorbance_cache[i] = c_absorbance(start[i, 0], start[i, 1], end[i, 0], end[i, 1], segments, seg_absorption,
+                                           universe_absorption, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                                           cache.intersects, cache.indexes, &required, arrays)
+        if required > 0:
+            cache.reserve(required)
+            absorbance_cache[i] = c_absorbance(start[i, 0], start[i, 1], end[i, 0], end[i, 1], segments,
+                                               seg_absorption, universe_absorption, bvh_bounds, bvh_nodes,
+                                               bvh_order, use_bvh, cache.intersects, cache.indexes, &required,
+                                               arrays)
+
+
+@boundscheck(False)
+@wraparound(False)
+cpdef void absorbances_parallel(double[:, ::1] start, double[:, ::1] end,
+                                double[:, :, ::1] segments, double[:, ::1] seg_absorption,
+                                double universe_absorption, double[:] absorbance_cache, int num_threads,
+                                double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None,
+                                int[::1] bvh_order=None, CompiledGeometry compiled=None) except *:
+    """ OpenMP version of absorbances, every thread traces into its own intersection scratch space """
+    cdef:
+        int i, thread
+        bint use_bvh = bvh_bounds is not None
+        double[:, :, ::1] intersects_cache
+        int[:, ::1] indexes_cache
+        int[::1] required
+        SegmentArrays *arrays = compiled_arrays(compiled, segments)
+
+    if num_threads < 1:
+        raise ValueError(f'num_threads must be at least 1, got {num_threads}')
+    # a ray crosses each segment at most once, so a scratch row per segment can never overflow
+    intersects_cache = np.empty((num_threads, max(segments.shape[0], 1), 2), dtype=np.double)
+    indexes_cache = np.empty((num_threads, max(segments.shape[0], 1)), dtype=np.int32)
+    required = np.zeros(num_threads, dtype=np.int32)
+
+    for i in prange(start.shape[0], nogil=True, num_threads=num_threads, schedule='dynamic', chunksize=16):
+        thread = threadid()
+        absorbance_cache[i] = c_absorbance(start[i, 0], start[i, 1], end[i, 0], end[i, 1], segments, seg_absorption,
+                                           universe_absorption, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                                           intersects_cache[thread], indexes_cache[thread], &required[thread],
+                                           arrays)
+
+
+@cdivision(True)
+@boundscheck(False)
+@wraparound(False)
+cdef int c_path_lengths(double start_x, double start_y, double end_x, double end_y,
+                        double[:, :, ::1] segments, int[:, ::1] materialrefs, double[:, ::1] bvh_bounds,
+                        int[:, ::1] bvh_nodes, int[::1] bvh_order, bint use_bvh, double[:, ::1] intersect_cache,
+                        int[::1] index_cache, double[::1] lengths, SegmentArrays *compiled) nogil:
+    """ Length of the path through every material, the last entry of lengths is the universe
+
+    Every term of c_absorbance is split onto the material it multiplies, so lengths dotted with the material
+    absorbances (and the universe absorbance) is the absorbance. Returns the crossings needed if the caches are
+    too small, 0 otherwise.
+    """
+    cdef:
+        int i, ci = 0, num_intersect, universe = lengths.shape[0] - 1
+        double path_length, crossing_distance, min_distance = 1e15
+        bint contained = False
+
+    for i in range(lengths.shape[0]):
+        lengths[i] = 0
+
+    num_intersect = c_trace(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                            intersect_cache, index_cache, False, compiled)
+    if num_intersect == 0:
+        contained = True
+        num_intersect = c_trace(start_x, start_y, end_x, end_y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                                intersect_cache, index_cache, True, compiled)
+    if num_intersect > index_cache.shape[0] or num_intersect > intersect_cache.shape[0]:
+        return num_intersect
+
+    path_length = distance(start_x, start_y, end_x, end_y)
+    if num_intersect == 0:
+        lengths[universe] = path_length
+        return 0
+
+    for i in range(num_intersect):
+        crossing_distance = distance(intersect_cache[i, 0], intersect_cache[i, 1], start_x, start_y)
+        if crossing_distance < min_distance:
+            ci = index_cache[i]
+            min_distance = crossing_distance
+
+    if sign_line(start_x, start_y, segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0], segments[ci, 1, 1]) > 0:
+        lengths[materialrefs[ci, 1]] += path_length
+    else:
+        lengths[materialrefs[ci, 0]] += path_length
+    if contained:
+        return 0
+
+    for i in range(num_intersect):
+        ci = index_cache[i]
+        crossing_distance = distance(intersect_cache[i, 0], intersect_cache[i, 1], end_x, end_y)
+        if sign_line(start_x, start_y, segments[ci, 0, 0], segments[ci, 0, 1], segments[ci, 1, 0],
+                     segments[ci, 1, 1]) <= 0:
+            crossing_distance = -crossing_distance
+        lengths[materialrefs[ci, 0]] += crossing_distance
+        lengths[materialrefs[ci, 1]] -= crossing_distance
+
+    return 0
+
+
+@boundscheck(False)
+@wraparound(False)
+def path_length_matrix(double[:, ::1] starts, double[:, ::1] ends, double[:, :, ::1] segments,
+                       int[:, ::1] materialrefs, int num_materials, double[:, ::1] bvh_bounds=None,
+                       int[:, ::1] bvh_nodes=None, int[::1] bvh_order=None, CompiledGeometry compiled=None):
+    """ c_path_lengths of every path in CSR layout, path i owns entries offsets[i]:offsets[i + 1] of materials
+    and lengths, the universe is material num_materials """
+    cdef:
+        int i, m, num_segments = max(segments.shape[0], 1)
+        size_t total = 0
+        bint use_bvh = bvh_bounds is not None
+        SegmentArrays *arrays = compiled_arrays(compiled, segments)
+        # a path crosses each segment at most once, so these can never be too small
+        double[:, ::1] intersect_cache = np.empty((num_segments, 2), dtype=np.double)
+        int[::1] index_cache = np.empty(num_segments, dtype=np.int32)
+        double[::1] path_lengths = np.empty(num_materials + 1, dtype=np.double)
+        long long[::1] offsets = np.zeros(starts.shape[0] + 1, dtype=np.int64)
+        int[::1] materials = np.empty(starts.shape[0] * (num_materials + 1), dtype=np.int32)
+        double[::1] lengths = np.empty(starts.shape[0] * (num_materials + 1), dtype=np.double)
+
+    if segments.shape[0] > 0 and np.max(materialrefs) > num_materials - 1:
+        raise ValueError(f'materialrefs index past the {num_materials} materials')
+
+    with nogil:
+        for i in range(starts.shape[0]):
+            c_path_lengths(starts[i, 0], starts[i, 1], ends[i, 0], ends[i, 1], segments, materialrefs, bvh_bounds,
+                           bvh_nodes, bvh_order, use_bvh, intersect_cache, index_cache, path_lengths, arrays)
+            for m in range(num_materials + 1):
+                if path_lengths[m] != 0:
+                    materials[total] = m
+                    lengths[total] = path_lengths[m]
+                    total += 1
+            offsets[i + 1] = total
+
+    return np.asarray(offsets), np.array(materials[:total]), np.array(lengths[:total])
+
+
+cdef int compare_crossings(const void *a, const void *b) nogil:
+    cdef double difference = (<Crossing *>a).x - (<Crossing *>b).x
+    return (difference > 0) - (difference < 0)
+
+
+@boundscheck(False)
+@wraparound(False)
+cdef void c_scanline_row(double y, double[::1] xs, double[:, :, ::1] segments,
+                         double[:, ::1] bvh_bounds, int[:, ::1] bvh_nodes, int[::1] bvh_order, bint use_bvh,
+                         double[::1] grid_bounds, int[::1] grid_shape, int[::1] grid_offsets, int[::1] grid_indexes,
+                         bint use_grid, double[:, ::1] intersect_cache, int[::1] index_cache, Crossing *crossings,
+                         int[::1] row_segments, double[::1] row_sides) nogil:
+    """ Deciding segment and its sign_line value for every pixel of the row y, as c_nearest_segment gives
+
+    Crossings of the horizontal line through the row are sorted along x, the material between two crossings is
+    the side of the left crossing segment the pixels are on. Pixels sitting on a crossing and rows through a
+    segment end point (vertices, horizontal edges) fall back to the point lookup. xs must be increasing and the
+    caches must hold one entry per segment.
+    """
+    cdef:
+        int i, k = 0, num_crossings, nearest
+        bint degenerate = False
+        double side
+
+    num_crossings = c_trace(xs[0], y, xs[0] + 1., y, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh,
+                            intersect_cache, index_cache, True)
+
+    for i in range(num_crossings):
+        crossings[i].x = intersect_cache[i, 0]
+        crossings[i].index = index_cache[i]
+        if segments[index_cache[i], 0, 1] == y or segments[index_cache[i], 1, 1] == y:
+            degenerate = True
+
+    if num_crossings == 0 or degenerate:
+        if num_crossings == 0:
+            # nothing along the line changes material, one lookup holds for the whole row
+            nearest = c_nearest_segment(xs[0], y, segments, grid_bounds, grid_shape, grid_offsets, grid_indexes,
+                                        use_grid, &side)
+        for i in range(xs.shape[0]):
+            if degenerate:
+                nearest = c_nearest_segment(xs[i], y, segments, grid_bounds, grid_shape, grid_offsets,
+                                            grid_indexes, use_grid, &side)
+            row_segments[i] = nearest
+            row_sides[i] = side
+        return
+
+    qsort(crossings, num_crossings, sizeof(Crossing), compare_crossings)
+
+    for i in range(xs.shape[0]):
+        while k < num_crossings and crossings[k].x < xs[i]:
+            k += 1
+
+        if k < num_crossings and crossings[k].x == xs[i]:
+            row_segments[i] = c_nearest_segment(xs[i], y, segments, grid_bounds, grid_shape, grid_offsets,
+                                                grid_indexes, use_grid, &row_sides[i])
+            continue
+
+        nearest = crossings[max(k - 1, 0)].index
+        row_segments[i] = nearest
+        row_sides[i] = sign_line(xs[i], y, segments[nearest, 0, 0], segments[nearest, 0, 1],
+                                 segments[nearest, 1, 0], segments[nearest, 1, 1])
+
+
+@boundscheck(False)
+@wraparound(False)
+cpdef void absorbance_image_scanline(double[:, ::1] image, double[::1] xs, double[::1] ys,
+                                     double[:, :, ::1] segments, double[:, ::1] absorbance,
+                                     double[:, ::1] bvh_bounds=None, int[:, ::1] bvh_nodes=None,
+                                     int[::1] bvh_order=None, double[::1] grid_bounds=None,
+                                     int[::1] grid_shape=None, int[::1] grid_offsets=None,
+                                     int[::1] grid_indexes=None):
+    cdef:
+        int i, j, num_segments = max(segments.shape[0], 1)
+        bint use_bvh = bvh_bounds is not None, use_grid = grid_bounds is not None
+        double[:, ::1] intersect_cache = np.empty((num_segments, 2), dtype=np.double)
+        int[::1] index_cache = np.empty(num_segments, dtype=np.int32)
+        int[::1] row_segments = np.empty(xs.shape[0], dtype=np.int32)
+        double[::1] row_sides = np.empty(xs.shape[0], dtype=np.double)
+        Crossing *crossings = <Crossing *>malloc(num_segments * sizeof(Crossing))
+
+    if crossings == NULL:
+        raise MemoryError()
+
+    try:
+        for j in range(ys.shape[0]):
+            c_scanline_row(ys[j], xs, segments, bvh_bounds, bvh_nodes, bvh_order, use_bvh, grid_bounds, grid_shape,
+                           grid_offsets, grid_indexes, use_grid, intersect_cache, index_cache, crossings,
+                           row_segments, row_sides)
+            for i in range(xs.shape[0]):
+                image[i, j] = side_value(absorbance, row_segments[i], row_sides[i])
+    finally:
+        free(crossings)
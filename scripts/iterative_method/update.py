@@ -29,11 +29,12 @@ def initial_estimate():
 
     assembly = shielded_assembly()
     assembly_flat = geo.flatten(assembly)
+    assembly_bvh = geo.build_bvh(assembly_flat)
 
     # truth
-    mu_image, extent = transmission.absorbance_image(xs, ys, assembly_flat)
-    mu_f_image, extent = fission.fissionval_image(xs, ys, assembly_flat)
-    p_image, extent = neutron_chain.p_image(xs, ys, assembly_flat)
+    mu_image, extent = transmission.absorbance_image(xs, ys, assembly_flat, scanline=True, bvh=assembly_bvh)
+    mu_f_image, extent = fission.fissionval_image(xs, ys, assembly_flat, scanline=True, bvh=assembly_bvh)
+    p_image, extent = neutron_chain.p_image(xs, ys, assembly_flat, scanline=True, bvh=assembly_bvh)
 
     #
 
@@ -72,8 +73,8 @@ def update_estimate(data, estimate, n_iterations):
 if __name__ == '__main__':
     from scripts.utils import display_data, display_estimate, load_data
 
-    # deriv_data = create_data(load_p_matrix=True, deriv=True, data_filename='probs_deriv')
-    # data = create_data(load_p_matrix=True, data_filename='probs')
+    # deriv_data = create_data(deriv=True, data_filename='probs_deriv')
+    # data = create_data(data_filename='probs')
     deriv_data = load_data(data_filename='probs_deriv')
     data = load_data(data_filename='probs')
 
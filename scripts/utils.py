@@ -15,8 +15,7 @@ def load_data(directory=r'scripts\data', data_filename='probs'):
     return Data(data_probs['extent'], data_probs['trans'], data_probs['f_1'], data_probs['f_2'])
 
 
-def create_data(directory=r'scripts\data', p_matrix_name='nudist_matrix_pu239', load_p_matrix=True,
-                data_filename='probs', deriv=False):
+def create_data(directory=r'scripts\data', nu_dist=None, data_filename='probs', deriv=False, num_workers=None):
     import pathlib
     import numpy as np
     import pytracer.geometry as geo
@@ -26,19 +25,14 @@ def create_data(directory=r'scripts\data', p_matrix_name='nudist_matrix_pu239',
 
     path = pathlib.Path.cwd() / directory
 
+    if nu_dist is None:
+        nu_dist = neutron_chain.nu_pu239_induced
+
     print('Generating Fission Probability Distributions... ', flush=True)
-    if deriv:
-        p_matrix_path = path / (p_matrix_name + '_deriv.npz')
-    else:
-        p_matrix_path = path / (p_matrix_name + '.npz')
-    if load_p_matrix:
-        matrix_loaded = np.load(p_matrix_path)
-        matrix = matrix_loaded['matrix']
-        p_range = matrix_loaded['p_range']
-    else:
-        # TODO: Add option to change nuclear data
-        matrix, p_range = neutron_chain.generate_p_matrix(neutron_chain.nu_pu239_induced, max_n=20, p_range=20, deriv=deriv)
-        np.savez(p_matrix_path, matrix=matrix, p_range=p_range)
+    # cached by nuclear data and parameters, a changed nu_dist or size never loads a stale matrix
+    matrix, p_range = neutron_chain.cached_p_matrix(str(path / 'p_matrix'), nu_dist, max_n=20, p_range=20,
+                                                    deriv=deriv, num_workers=num_workers,
+                                                    progress=measure.print_progress)
     print('Done', flush=True)
 
     print('Generating Geometry... ', flush=True)
@@ -51,15 +45,18 @@ def create_data(directory=r'scripts\data', p_matrix_name='nudist_matrix_pu239',
     print('Done', flush=True)
 
     print('Generating Transmission Scan...', flush=True)
-    trans_probs = measure.transmission_scan(assembly_flat, source, detector_points)
-    print('Done', flush=True)
-
-    print('Generating Single Neutron Scan... ', flush=True)
-    single_probs = measure.fission_scan(source[0, :, :], detector_points, detector_points, assembly_flat, 1, matrix, p_range)
+    # scans stream to disk, an interrupted create_data resumes each scan where it stopped
+    scan_path = path / 'scans'
+    scan_path.mkdir(parents=True, exist_ok=True)
+    trans_probs = measure.stream_transmission_scan(str(scan_path / 'trans.npy'), assembly_flat, source,
+                                                   detector_points)
     print('Done', flush=True)
 
-    print('Generating Double Neutron Scan... ', flush=True)
-    double_probs = measure.fission_scan(source[0, :, :], detector_points, detector_points, assembly_flat, 2, matrix, p_range)
+    print('Generating Single and Double Neutron Scans... ', flush=True)
+    single_probs, double_probs = measure.stream_fission_scan(str(scan_path / 'fission.npy'), source[0, :, :],
+                                                             detector_points, detector_points, assembly_flat, [1, 2],
+                                                             matrix, p_range, num_workers=num_workers,
+                                                             progress=measure.print_progress)
     print('Done', flush=True)
 
     data_path = path / (data_filename + '.npz')
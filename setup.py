@@ -5,15 +5,24 @@ except ImportError:
     from distutils.core import setup
     from distutils.extension import Extension
 
+import sys
 from Cython.Build import cythonize
 import numpy
 
+if sys.platform == 'win32':
+    openmp_args = ['/openmp']
+else:
+    openmp_args = ['-fopenmp']
+
 setup(
     name='pytracer',
     version='0.1dev',
     package_dir={'pytracer': 'pytracer'},
     packages=['pytracer'],
-    ext_modules=cythonize(['pytracer/transmission_c.pyx', 'pytracer/geometry_c.pyx',
-                           'pytracer/fission_c.pyx', 'pytracer/neutron_chain_c.pyx']),
+    ext_modules=cythonize([Extension('pytracer.transmission_c', ['pytracer/transmission_c.pyx'],
+                                     extra_compile_args=openmp_args, extra_link_args=openmp_args),
+                           Extension('pytracer.raytrace_c', ['pytracer/raytrace_c.pyx'],
+                                     extra_compile_args=openmp_args, extra_link_args=openmp_args),
+                           'pytracer/geometry_c.pyx', 'pytracer/fission_c.pyx', 'pytracer/neutron_chain_c.pyx']),
     include_dirs=[numpy.get_include()]
 )
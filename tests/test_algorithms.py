@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from pytracer import algorithms as alg
+
+
+@pytest.fixture
+def problem():
+    rng = np.random.RandomState(0)
+    G = rng.rand(40, 25)
+    d = G @ rng.rand(25) + 0.01 * rng.randn(40)
+    return d, G, rng.rand(25)
+
+
+@pytest.mark.parametrize('alpha', [0, 0.5, 2.0])
+def test_lsqr_warm_start_matches_tikhonov(problem, alpha):
+    d, G, x0 = problem
+    expected = alg.solve_tikhonov(d, G, alpha)
+
+    for A in (G, sparse.csr_matrix(G)):
+        np.testing.assert_allclose(alg.solve_lsqr(d, A, alpha=alpha, tol=1e-14), expected, rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(alg.solve_lsqr(d, A, alpha=alpha, x0=x0, tol=1e-14), expected, rtol=1e-8,
+                                   atol=1e-10)
+
+
+def test_lsqr_warm_start_matches_higher_tikhonov(problem):
+    d, G, x0 = problem
+    L = alg.first_difference_operator((5, 5))
+    expected = alg.solve_higher_tikhonov(d, G, L.toarray(), 0.5)
+
+    np.testing.assert_allclose(alg.solve_lsqr(d, G, L, 0.5, x0=x0, tol=1e-14), expected, rtol=1e-8, atol=1e-10)